@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.async_database"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052301"
+
+import asyncio
+import pytest
+from sqlalchemy import create_engine
+from traceroute_history import database, models, crud, schemas
+
+pytest.importorskip('aiosqlite')
+
+
+def test_async_sessions_run_sync_crud(tmp_path, monkeypatch):
+    db_file = tmp_path / 'test.db'
+    models.init_db(create_engine('sqlite:///{0}'.format(db_file)))
+    config = {'TRACEROUTE_HISTORY': {'database_driver': 'sqlite', 'database_host': str(db_file)}}
+    monkeypatch.setattr(database, 'AsyncSessionLocal', None)
+    assert database.get_connection_string(config, db_driver='sqlite+aiosqlite') == \
+        'sqlite+aiosqlite:///{0}'.format(db_file)
+    session_factory = database.load_async_database(config)
+
+    async def _run():
+        async with session_factory() as db:
+            target = await db.run_sync(crud.create_target,
+                                       target=schemas.TargetCreate(name='target', address='10.0.0.9', groups=[]))
+            for index in range(5):
+                await db.run_sync(crud.create_target_traceroute, target_id=target.id,
+                                  traceroute=schemas.TracerouteCreate(raw_traceroute='No route {0}'.format(index)))
+            # Many sessions at once on the event loop, without any thread
+            names = await asyncio.gather(*[_read_target_name(target.id) for _ in range(50)])
+            assert set(names) == {'target'}
+
+            result = await db.stream(crud.get_traceroute_rows_statement(target_id=target.id, descending=False))
+            batches = []
+            async for rows in result.partitions(2):
+                batches.append([crud.decode_traceroute_row(row)[3] for row in rows])
+            return batches
+
+    async def _read_target_name(target_id):
+        async with session_factory() as db:
+            target = await db.run_sync(crud.get_target, id=target_id)
+            return target.name
+
+    assert asyncio.run(_run()) == [['No route 0', 'No route 1'], ['No route 2', 'No route 3'], ['No route 4']]
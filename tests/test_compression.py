@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.compression"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022051801"
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from traceroute_history import compression, models, crud
+
+TRACEROUTE = "traceroute to kernel.org (139.178.84.217), 30 hops max, 60 byte packets\n" + "".join(
+    " {0}  10.0.{0}.1 (10.0.{0}.1)  {0}.{1:03d} ms  {0}.{2:03d} ms  {0}.{3:03d} ms\n".format(
+        hop, hop * 7, hop * 11, hop * 13) for hop in range(1, 15)) + " 15  * * *\n"
+
+
+def test_roundtrip():
+    for codec in (compression.CODEC_PLAIN, compression.CODEC_ZLIB):
+        assert compression.decode(compression.encode(TRACEROUTE, codec=codec)) == TRACEROUTE
+    assert compression.decode(compression.encode('')) == ''
+    # Longer than the former 2048 characters column
+    long_traceroute = TRACEROUTE * 20
+    assert compression.decode(compression.encode(long_traceroute)) == long_traceroute
+
+    assert len(compression.encode(TRACEROUTE)) < len(TRACEROUTE) / 2.5
+
+
+def test_legacy_rows_migration():
+    engine = create_engine('sqlite://')
+    # Traceroute table as created by previous versions
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE traceroute (id INTEGER PRIMARY KEY, creation_date DATETIME, '
+                                'raw_traceroute VARCHAR(2048) NOT NULL, target_id INTEGER)'))
+        connection.execute(text('INSERT INTO traceroute (raw_traceroute, target_id) VALUES (:raw, 1)'),
+                           {'raw': TRACEROUTE})
+    models.init_db(engine)
+
+    db = Session(engine)
+    traceroute = db.query(models.Traceroute).one()
+    assert not traceroute.is_compressed
+    assert traceroute.raw_traceroute == TRACEROUTE
+
+    assert crud.compress_raw_traceroutes(db=db) == 1
+    assert crud.compress_raw_traceroutes(db=db) == 0
+    db.expunge_all()
+    traceroute = db.query(models.Traceroute).one()
+    assert traceroute.is_compressed
+    assert traceroute.legacy_raw_traceroute == ''
+    assert traceroute.raw_traceroute == TRACEROUTE
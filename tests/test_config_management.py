@@ -16,24 +16,155 @@ __copyright__ = "Copyright (C) 2022 Orsiris de Jong"
 __licence__ = "BSD 3 Clause"
 __build__ = "2022050501"
 
+import os
+import configparser
 from traceroute_history import config_management
 
 
+def _without_groups(targets):
+    return [{'address': target['address'], 'name': target['name']} for target in targets]
+
+
 def test_read_smokeping_config():
     conf_file = "tests/smokeping_example_configs/smokeping_example1.conf"
     targets = config_management.read_smokeping_config(conf_file)
-    print(targets)
-    assert targets == [{'target': 'localhost', 'name': 'The NOC@intERLab'}, {'target': 'pc1', 'name': 'pc1'}, {'target': 'pc2', 'name': 'pc2'}, {'target': 'pc3', 'name': 'pc3'}, {'target': 'pc4', 'name': 'pc4'}, {'target': 'pc5', 'name': 'pc5'}, {'target': 'pc6', 'name': 'pc6'}, {'target': 'pc7', 'name': 'pc7'}, {'target': 'pc8', 'name': 'pc8'}, {'target': 'pc9', 'name': 'pc9'}, {'target': 'pc10', 'name': 'pc10'}, {'target': 'pc11', 'name': 'pc11'}, {'target': 'pc12', 'name': 'pc12'}, {'target': 'pc13', 'name': 'pc13'}, {'target': 'pc14', 'name': 'pc14'}, {'target': 'pc15', 'name': 'pc15'}, {'target': 'localhost', 'name': 'Apache 2 Server for noc'}, {'target': 'pc1', 'name': 'Apache 2 Server for pc1'}, {'target': 'pc2', 'name': 'Apache 2 Server for pc2'}, {'target': 'pc3', 'name': 'Apache 2 Server for pc3'}, {'target': 'pc4', 'name': 'Apache 2 Server for pc4'}, {'target': 'pc5', 'name': 'Apache 2 Server for pc5'}, {'target': 'pc6', 'name': 'Apache 2 Server for pc6'}, {'target': 'pc7', 'name': 'Apache 2 Server for pc7'}, {'target': 'pc8', 'name': 'Apache 2 Server for pc8'}, {'target': 'pc9', 'name': 'Apache 2 Server for pc9'}, {'target': 'pc10', 'name': 'Apache 2 Server for pc10'}, {'target': 'pc11', 'name': 'Apache 2 Server for pc11'}, {'target': 'pc12', 'name': 'Apache 2 Server for pc12'}, {'target': 'pc13', 'name': 'Apache 2 Server for pc13'}, {'target': 'pc14', 'name': 'Apache 2 Server for pc14'}, {'target': 'pc15', 'name': 'Apache 2 Server for pc15'}, {'target': 'noc', 'name': 'Name Server Latency for noc'}, {'target': 'afnog.org', 'name': 'African Network Operators Group'}, {'target': 'nsrc.org', 'name': 'NSRC (Eugene, Oregon, USA)'}, {'target': 'ws.edu.isoc.org', 'name': 'ISOC Workshop Resource Centre (Eugene, Oregon, USA)'}, {'target': 'shell.uoregon.edu', 'name': 'Main User Box, University of Oregon (Eugene, Oregon, USA)'}, {'target': 'sageduck.org', 'name': 'sageduck.org'}], "Bogus smokeping example 1 test"
+    assert _without_groups(targets) == [{'address': 'localhost', 'name': 'The NOC@intERLab'}, {'address': 'pc1', 'name': 'pc1'}, {'address': 'pc2', 'name': 'pc2'}, {'address': 'pc3', 'name': 'pc3'}, {'address': 'pc4', 'name': 'pc4'}, {'address': 'pc5', 'name': 'pc5'}, {'address': 'pc6', 'name': 'pc6'}, {'address': 'pc7', 'name': 'pc7'}, {'address': 'pc8', 'name': 'pc8'}, {'address': 'pc9', 'name': 'pc9'}, {'address': 'pc10', 'name': 'pc10'}, {'address': 'pc11', 'name': 'pc11'}, {'address': 'pc12', 'name': 'pc12'}, {'address': 'pc13', 'name': 'pc13'}, {'address': 'pc14', 'name': 'pc14'}, {'address': 'pc15', 'name': 'pc15'}, {'address': 'localhost', 'name': 'Apache 2 Server for noc'}, {'address': 'pc1', 'name': 'Apache 2 Server for pc1'}, {'address': 'pc2', 'name': 'Apache 2 Server for pc2'}, {'address': 'pc3', 'name': 'Apache 2 Server for pc3'}, {'address': 'pc4', 'name': 'Apache 2 Server for pc4'}, {'address': 'pc5', 'name': 'Apache 2 Server for pc5'}, {'address': 'pc6', 'name': 'Apache 2 Server for pc6'}, {'address': 'pc7', 'name': 'Apache 2 Server for pc7'}, {'address': 'pc8', 'name': 'Apache 2 Server for pc8'}, {'address': 'pc9', 'name': 'Apache 2 Server for pc9'}, {'address': 'pc10', 'name': 'Apache 2 Server for pc10'}, {'address': 'pc11', 'name': 'Apache 2 Server for pc11'}, {'address': 'pc12', 'name': 'Apache 2 Server for pc12'}, {'address': 'pc13', 'name': 'Apache 2 Server for pc13'}, {'address': 'pc14', 'name': 'Apache 2 Server for pc14'}, {'address': 'pc15', 'name': 'Apache 2 Server for pc15'}, {'address': 'noc', 'name': 'Name Server Latency for noc'}, {'address': 'afnog.org', 'name': 'African Network Operators Group'}, {'address': 'nsrc.org', 'name': 'NSRC (Eugene, Oregon, USA)'}, {'address': 'ws.edu.isoc.org', 'name': 'ISOC Workshop Resource Centre (Eugene, Oregon, USA)'}, {'address': 'shell.uoregon.edu', 'name': 'Main User Box, University of Oregon (Eugene, Oregon, USA)'}, {'address': 'sageduck.org', 'name': 'sageduck.org'}], "Bogus smokeping example 1 test"
+    assert targets[0]['groups'] == ('Local', 'Local.Latency')
+    assert targets[-1]['groups'] == ('World', 'World.SouthAmerica')
+    assert targets[-3]['groups'] == ('World', 'World.NorthAmerica', 'World.NorthAmerica.USA')
 
     conf_file = "tests/smokeping_example_configs/smokeping_example2.conf"
     targets = config_management.read_smokeping_config(conf_file)
-    assert targets == [{'target': 'localhost', 'name': 'The NOC@intERLab'}, {'target': 'pc1', 'name': 'pc1'}, {'target': 'pc2', 'name': 'pc2'}, {'target': 'pc3', 'name': 'pc3'}, {'target': 'pc4', 'name': 'pc4'}, {'target': 'pc5', 'name': 'pc5'}, {'target': 'pc6', 'name': 'pc6'}, {'target': 'pc7', 'name': 'pc7'}, {'target': 'pc8', 'name': 'pc8'}, {'target': 'pc9', 'name': 'pc9'}, {'target': 'pc10', 'name': 'pc10'}, {'target': 'pc11', 'name': 'pc11'}, {'target': 'pc12', 'name': 'pc12'}, {'target': 'pc13', 'name': 'pc13'}, {'target': 'pc14', 'name': 'pc14'}, {'target': 'pc15', 'name': 'pc15'}, {'target': 'includedPC1', 'name': 'Apache 2 Server for includedPC1'}, {'target': 'includedPC2', 'name': 'Apache 2 Server for includedPC1'}, {'target': 'localhost', 'name': 'Apache 2 Server for noc'}, {'target': 'pc1', 'name': 'Apache 2 Server for pc1'}, {'target': 'pc2', 'name': 'Apache 2 Server for pc2'}, {'target': 'pc3', 'name': 'Apache 2 Server for pc3'}, {'target': 'pc4', 'name': 'Apache 2 Server for pc4'}, {'target': 'pc5', 'name': 'Apache 2 Server for pc5'}, {'target': 'pc6', 'name': 'Apache 2 Server for pc6'}, {'target': 'pc7', 'name': 'Apache 2 Server for pc7'}, {'target': 'pc8', 'name': 'Apache 2 Server for pc8'}, {'target': 'pc9', 'name': 'Apache 2 Server for pc9'}, {'target': 'pc10', 'name': 'Apache 2 Server for pc10'}, {'target': 'pc11', 'name': 'Apache 2 Server for pc11'}, {'target': 'pc12', 'name': 'Apache 2 Server for pc12'}, {'target': 'pc13', 'name': 'Apache 2 Server for pc13'}, {'target': 'pc14', 'name': 'Apache 2 Server for pc14'}, {'target': 'pc15', 'name': 'Apache 2 Server for pc15'}, {'target': 'noc', 'name': 'Name Server Latency for noc'}, {'target': 'afnog.org', 'name': 'African Network Operators Group'}, {'target': 'nsrc.org', 'name': 'NSRC (Eugene, Oregon, USA)'}, {'target': 'ws.edu.isoc.org', 'name': 'ISOC Workshop Resource Centre (Eugene, Oregon, USA)'}, {'target': 'shell.uoregon.edu', 'name': 'Main User Box, University of Oregon (Eugene, Oregon, USA)'}, {'target': 'sageduck.org', 'name': 'sageduck.org'}], "Bogus smokeping example 2 test with inclusions"
-    print(targets)
+    assert _without_groups(targets) == [{'address': 'localhost', 'name': 'The NOC@intERLab'}, {'address': 'pc1', 'name': 'pc1'}, {'address': 'pc2', 'name': 'pc2'}, {'address': 'pc3', 'name': 'pc3'}, {'address': 'pc4', 'name': 'pc4'}, {'address': 'pc5', 'name': 'pc5'}, {'address': 'pc6', 'name': 'pc6'}, {'address': 'pc7', 'name': 'pc7'}, {'address': 'pc8', 'name': 'pc8'}, {'address': 'pc9', 'name': 'pc9'}, {'address': 'pc10', 'name': 'pc10'}, {'address': 'pc11', 'name': 'pc11'}, {'address': 'pc12', 'name': 'pc12'}, {'address': 'pc13', 'name': 'pc13'}, {'address': 'pc14', 'name': 'pc14'}, {'address': 'pc15', 'name': 'pc15'}, {'address': 'includedPC1', 'name': 'Apache 2 Server for includedPC1'}, {'address': 'includedPC2', 'name': 'Apache 2 Server for includedPC1'}, {'address': 'localhost', 'name': 'Apache 2 Server for noc'}, {'address': 'pc1', 'name': 'Apache 2 Server for pc1'}, {'address': 'pc2', 'name': 'Apache 2 Server for pc2'}, {'address': 'pc3', 'name': 'Apache 2 Server for pc3'}, {'address': 'pc4', 'name': 'Apache 2 Server for pc4'}, {'address': 'pc5', 'name': 'Apache 2 Server for pc5'}, {'address': 'pc6', 'name': 'Apache 2 Server for pc6'}, {'address': 'pc7', 'name': 'Apache 2 Server for pc7'}, {'address': 'pc8', 'name': 'Apache 2 Server for pc8'}, {'address': 'pc9', 'name': 'Apache 2 Server for pc9'}, {'address': 'pc10', 'name': 'Apache 2 Server for pc10'}, {'address': 'pc11', 'name': 'Apache 2 Server for pc11'}, {'address': 'pc12', 'name': 'Apache 2 Server for pc12'}, {'address': 'pc13', 'name': 'Apache 2 Server for pc13'}, {'address': 'pc14', 'name': 'Apache 2 Server for pc14'}, {'address': 'pc15', 'name': 'Apache 2 Server for pc15'}, {'address': 'noc', 'name': 'Name Server Latency for noc'}, {'address': 'afnog.org', 'name': 'African Network Operators Group'}, {'address': 'nsrc.org', 'name': 'NSRC (Eugene, Oregon, USA)'}, {'address': 'ws.edu.isoc.org', 'name': 'ISOC Workshop Resource Centre (Eugene, Oregon, USA)'}, {'address': 'shell.uoregon.edu', 'name': 'Main User Box, University of Oregon (Eugene, Oregon, USA)'}, {'address': 'sageduck.org', 'name': 'sageduck.org'}], "Bogus smokeping example 2 test with inclusions"
+    assert targets[18]['groups'] == ('Local', 'Local.Apache')
 
     conf_file = "tests/smokeping_example_configs/smokeping_example3.conf"
     targets = config_management.read_smokeping_config(conf_file)
-    assert targets == [{'target': 'www.cdn77.com', 'name': 'ANYCAST CDN77 (AS60068 www.cdn77.com)'}, {'target': '1.1.1.1', 'name': 'ANYCAST Cloudflare (AS13335 1.1.1.1)'}, {'target': '192.175.48.1', 'name': 'ANYCAST DNS-OARC (AS112 192.175.48.1)'}, {'target': 'www.googleapis.com', 'name': 'ANYCAST Google API (AS15169 www.googleapis.com)'}, {'target': '8.8.8.8', 'name': 'ANYCAST Google DNS (AS15169 8.8.8.8)'}, {'target': 'drive.google.com', 'name': 'ANYCAST Google DRIVE (AS15169 drive.google.com)'}, {'target': '9.9.9.9', 'name': 'ANYCAST Quad9 (AS19281 9.9.9.9)'}, {'target': 'ns1.wordpress.com', 'name': 'ANYCAST WordPress (AS2635 ns1.wordpress.com)'}, {'target': 'ovh.es', 'name': '[FR] ISP OVH (AS16276 ovh.es)'}, {'target': 'nsa.online.net', 'name': '[FR] ISP Online.net (AS12876 nsa.online.net)'}, {'target': 'hetzner.com', 'name': '[DE] ISP Hetzner (AS24940 hetzner.com)'}], "Bogus smokeping example 3 test with inclusions"
-    print(targets)
+    assert _without_groups(targets) == [{'address': 'www.cdn77.com', 'name': 'ANYCAST CDN77 (AS60068 www.cdn77.com)'}, {'address': '1.1.1.1', 'name': 'ANYCAST Cloudflare (AS13335 1.1.1.1)'}, {'address': '192.175.48.1', 'name': 'ANYCAST DNS-OARC (AS112 192.175.48.1)'}, {'address': 'www.googleapis.com', 'name': 'ANYCAST Google API (AS15169 www.googleapis.com)'}, {'address': '8.8.8.8', 'name': 'ANYCAST Google DNS (AS15169 8.8.8.8)'}, {'address': 'drive.google.com', 'name': 'ANYCAST Google DRIVE (AS15169 drive.google.com)'}, {'address': '9.9.9.9', 'name': 'ANYCAST Quad9 (AS19281 9.9.9.9)'}, {'address': 'ns1.wordpress.com', 'name': 'ANYCAST WordPress (AS2635 ns1.wordpress.com)'}, {'address': 'ovh.es', 'name': '[FR] ISP OVH (AS16276 ovh.es)'}, {'address': 'nsa.online.net', 'name': '[FR] ISP Online.net (AS12876 nsa.online.net)'}, {'address': 'hetzner.com', 'name': '[DE] ISP Hetzner (AS24940 hetzner.com)'}], "Bogus smokeping example 3 test with inclusions"
+    assert targets[0]['groups'] == ('ANYCAST',)
+    assert targets[-1]['groups'] == ('ISPs',)
+
+
+def test_config_service_reload(tmp_path):
+    config_file = str(tmp_path / 'traceroute_history.conf')
+    with open(config_file, 'w') as fp:
+        fp.write('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 50\n\n'
+                 '[TARGET:one]\naddress = 127.0.0.1\ngroups = a, b\n')
+    service = config_management.ConfigService(config_file, check_interval=0)
+    snapshot = service.get()
+    assert snapshot.rtt_detection_threshold == 50
+    assert snapshot.targets == (config_management.TargetConfig(name='one', address='127.0.0.1', groups=('a', 'b')),)
+
+    reloads = []
+    service.add_listener(lambda old, new: reloads.append((old, new)))
+    assert service.reload() is None, "Unchanged config must not be reloaded"
+
+    with open(config_file, 'a') as fp:
+        fp.write('\n[TARGET:two]\naddress = 127.0.0.2\ninterval = 60\n')
+    # Make sure mtime changes even on coarse mtime resolution filesystems
+    os.utime(config_file, (0, 0))
+    assert service.get() is not snapshot
+    assert len(reloads) == 1
+    assert [target.name for target in reloads[0][1].targets] == ['one', 'two']
+    assert reloads[0][1].targets[1].interval == 60
+
+    # Unparseable config keeps previous snapshot
+    with open(config_file, 'w') as fp:
+        fp.write('not an ini file')
+    os.utime(config_file, (1, 1))
+    assert service.reload() is None
+    assert len(service.snapshot.targets) == 2
+
+
+def write_synthetic_smokeping_tree(path, regions=10, sites=50, hosts=20):
+    """
+    Writes a smokeping config with regions * sites * hosts targets, one include file per region
+    """
+    with open(os.path.join(path, 'smokeping.conf'), 'w') as fp:
+        fp.write('*** General ***\nowner = test\n\n*** Targets ***\n\nprobe = FPing\ntitle = Synthetic\n\n')
+        for region in range(regions):
+            include_file = os.path.join(path, 'region{0}.conf'.format(region))
+            fp.write('@include {0}\n'.format(include_file))
+            with open(include_file, 'w') as include_fp:
+                include_fp.write('+ Region{0}\nmenu = Region {0}\ntitle = Region {0}\n\n'.format(region))
+                for site in range(sites):
+                    include_fp.write('++ Site{0}\nmenu = Site {0}\ntitle = Site {0}\n\n'.format(site))
+                    for host in range(hosts):
+                        include_fp.write('+++ Host{0}\n# Comment line\nmenu = Host {0}\n'
+                                         'title = host-{1}-{2}-{0}\nhost = 10.{1}.{2}.{0}\n\n'.format(host, region,
+                                                                                                  site))
+    return os.path.join(path, 'smokeping.conf')
+
+
+def test_target_registry_synthetic_tree(tmp_path, monkeypatch):
+    smokeping_config = write_synthetic_smokeping_tree(str(tmp_path))
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'SMOKEPING_SOURCE': {'smokeping_config_path': smokeping_config},
+        'TARGET:host-0-0-0': {'address': '192.168.0.1', 'groups': 'mygroup'}
+    })
+
+    calls = {'parse': 0, 'lookup': 0}
+    tokenize_smokeping_file = config_management._tokenize_smokeping_file
+    get_target_config = config_management.get_target_config
+
+    def _tokenize(*args, **kwargs):
+        calls['parse'] += 1
+        return tokenize_smokeping_file(*args, **kwargs)
+
+    def _get_target_config(*args, **kwargs):
+        calls['lookup'] += 1
+        return get_target_config(*args, **kwargs)
+
+    monkeypatch.setattr(config_management, '_tokenize_smokeping_file', _tokenize)
+    monkeypatch.setattr(config_management, 'get_target_config', _get_target_config)
+    registry = config_management.build_target_registry(config)
+
+    assert len(registry.targets) == 10000
+    # Config file declarations take precedence over smokeping ones
+    assert registry.get_target('host-0-0-0').address == '192.168.0.1'
+    assert registry.get_groups('host-0-0-0') == ('mygroup',)
+    assert registry.groups['mygroup'] == ('host-0-0-0',)
+    assert registry.get_groups('host-9-49-19') == ('Region9', 'Region9.Site49')
+    assert len(registry.groups['Region3']) == 1000
+    assert len(registry.get_targets_by_group('Region3.Site7')) == 20
+    # Single pass: every file parsed once, one config lookup per declared target instead of per target rescans
+    assert calls['parse'] == 11
+    assert calls['lookup'] == 10001
+
+
+def test_smokeping_filters_and_include_cache(tmp_path):
+    smokeping_config = write_synthetic_smokeping_tree(str(tmp_path), regions=5, sites=50, hosts=20)
+    reader = config_management.SmokepingReader()
+
+    targets = reader.read(smokeping_config)
+    assert len(targets) == 5000
+    assert targets[0] == {'address': '10.0.0.0', 'name': 'host-0-0-0', 'groups': ('Region0', 'Region0.Site0')}
+    assert reader.parsed_files == 6
+
+    # Unchanged files are not parsed again
+    assert reader.read(smokeping_config) == targets
+    assert reader.parsed_files == 6
+
+    # Only the modified include gets parsed again
+    include_file = os.path.join(str(tmp_path), 'region2.conf')
+    with open(include_file, 'a') as fp:
+        fp.write('+++ Extra\ntitle = extra\nhost = 10.2.0.99\n')
+    assert len(reader.read(smokeping_config)) == 5001
+    assert reader.parsed_files == 7
+    assert include_file in reader.get_files(smokeping_config)
+
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'SMOKEPING_GROUP1': {'include_hostname_regex': "'10\\.[01]\\.'", 'exclude_hostname_regex': ''},
+        'SMOKEPING_GROUP2': {'smokeping_group': 'Region1.Site3', 'exclude_hostname_regex': '.*'}
+    })
+    filters = config_management.get_smokeping_filters(config)
+    assert len(filters) == 2
+    targets = reader.read(smokeping_config, filters=filters)
+    assert len(targets) == 2000 - 20
+    assert not [target for target in targets if 'Region1.Site3' in target['groups']]
+
 
 if __name__ == "__main__":
     print("Example code for %s, %s" % (__intname__, __build__))
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.database"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052401"
+
+import asyncio
+import threading
+import configparser
+import pytest
+import sqlalchemy.exc
+from sqlalchemy import create_engine, text
+from traceroute_history import database, models, crud, schemas
+
+
+@pytest.fixture
+def sqlite_config(tmp_path, monkeypatch):
+    db_file = tmp_path / 'test.db'
+    models.init_db(create_engine('sqlite:///{0}'.format(db_file)))
+    config = configparser.ConfigParser()
+    config['TRACEROUTE_HISTORY'] = {'database_driver': 'sqlite', 'database_host': str(db_file),
+                                    'sqlite_mmap_size': '1048576', 'sqlite_busy_timeout': '2000'}
+    for name in ('SessionLocal', 'AsyncSessionLocal', 'AsyncWriteSessionLocal', 'DB_WRITER'):
+        monkeypatch.setattr(database, name, None)
+    yield config
+    if database.DB_WRITER:
+        database.DB_WRITER.stop()
+
+
+def test_sqlite_settings(sqlite_config):
+    assert database.get_sqlite_settings(sqlite_config) == {'mmap_size': 1048576, 'busy_timeout': 2000}
+    sqlite_config['TRACEROUTE_HISTORY']['sqlite_production_mode'] = 'no'
+    assert database.get_sqlite_settings(sqlite_config) is None
+    assert database.get_sqlite_settings({'TRACEROUTE_HISTORY': {'database_driver': 'mysql'}}) is None
+
+
+def test_sqlite_production_mode(sqlite_config):
+    database.load_database(sqlite_config, writer=True)
+    db = database.SessionLocal()
+    assert db.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+    # NORMAL
+    assert db.execute(text('PRAGMA synchronous')).scalar() == 1
+    assert db.execute(text('PRAGMA busy_timeout')).scalar() == 2000
+    assert db.execute(text('PRAGMA mmap_size')).scalar() == 1048576
+    db.close()
+
+    target = database.run_write(crud.create_target,
+                                target=schemas.TargetCreate(name='target', address='10.0.0.9', groups=[]))
+
+    # Writes of many threads are serialized by the writer, without lock errors
+    def _write(thread_index):
+        for index in range(10):
+            database.run_write(crud.create_target_traceroute, target_id=target.id,
+                               traceroute=schemas.TracerouteCreate(
+                                   raw_traceroute='No route {0} {1}'.format(thread_index, index)))
+
+    threads = [threading.Thread(target=_write, args=(thread_index, )) for thread_index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert database.DB_WRITER.jobs == 81
+    with database.db_session() as db:
+        assert crud.get_traceroutes_by_target(db=db, target_id=target.id, count=True) == 80
+
+    # Failed units of work are rolled back and raised to the caller
+    def _fail(db):
+        db.add(models.Group(name='group'))
+        db.flush()
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        database.run_write(_fail)
+    with database.db_session() as db:
+        assert crud.get_group(db=db, name='group') is None
+
+
+def test_read_only_async_sessions(sqlite_config):
+    pytest.importorskip('aiosqlite')
+    database.load_database(sqlite_config)
+    database.load_async_database(sqlite_config, read_only=True)
+    assert database.DB_WRITER is None
+
+    async def _run():
+        async with database.AsyncWriteSessionLocal() as db:
+            await db.run_sync(crud.create_target,
+                              target=schemas.TargetCreate(name='target', address='10.0.0.9', groups=[]))
+        async with database.AsyncSessionLocal() as db:
+            target = await db.run_sync(crud.get_target, name='target')
+            assert target.address == '10.0.0.9'
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                await db.run_sync(crud.create_group, group=schemas.GroupCreate(name='group'))
+
+    asyncio.run(_run())
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.ingest_queue"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052501"
+
+import queue
+import threading
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from traceroute_history import models, database, schemas, probe_engine, traceroute_cache, crud, ingest_queue, \
+    probe_scheduler
+from traceroute_history import traceroute_history_runner as runner
+
+TRACEROUTE = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+
+@pytest.fixture
+def db_engine(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'), connect_args={'check_same_thread': False})
+    models.init_db(engine)
+    monkeypatch.setattr(database, 'SessionLocal', scoped_session(sessionmaker(bind=engine, autoflush=False)))
+    monkeypatch.setattr(database, 'DB_WRITER', None)
+    config_file = tmp_path / 'traceroute_history.conf'
+    config_file.write_text('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 0\n')
+    monkeypatch.setattr(runner, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(runner, 'LAST_TRACEROUTES', traceroute_cache.LastTracerouteCache())
+    return engine
+
+
+def _create_traceroute(db, target_id, raw_traceroute):
+    return crud.create_target_traceroute(db=db, target_id=target_id, commit=False,
+                                         traceroute=schemas.TracerouteCreate(raw_traceroute=raw_traceroute)).id
+
+
+def test_batched_commits(db_engine):
+    target_id = ingest_queue.run_now(crud.create_target, commit=False,
+                                     target=schemas.TargetCreate(name='target', address='10.0.0.9', groups=[])).id
+    commits = []
+    event.listen(db_engine, 'commit', lambda connection: commits.append(1))
+    notified = []
+    listener = lambda target_id, traceroute_id: notified.append(traceroute_id)
+    crud.add_traceroute_listener(listener)
+
+    ingest = ingest_queue.IngestQueue(batch_size=50, batch_interval=1)
+    ingest.start()
+    try:
+        futures = [ingest.put(_create_traceroute, {'target_id': target_id, 'raw_traceroute': 'No route {0}'.format(index)})
+                   for index in range(120)]
+        traceroute_ids = [future.result(timeout=10) for future in futures]
+    finally:
+        ingest.stop()
+        crud.remove_traceroute_listener(listener)
+
+    stats = ingest.get_stats()
+    assert stats['jobs'] == 120
+    # Two full batches, the rest being written after batch_interval at the latest
+    assert stats['batches'] == 3 == len(commits)
+    assert stats['average_flush_latency'] > 0
+    # Listeners are only notified once the batch is committed
+    assert sorted(notified) == sorted(traceroute_ids)
+    with database.db_session() as db:
+        assert crud.get_traceroutes_by_target(db=db, target_id=target_id, count=True) == 120
+
+
+def test_failed_batch_retries_jobs(db_engine):
+    rollbacks = []
+    ingest = ingest_queue.IngestQueue(batch_size=10, batch_interval=5, on_rollback=lambda: rollbacks.append(1))
+    ingest.start()
+    try:
+        target_future = ingest.put(crud.create_target, {'commit': False, 'target': schemas.TargetCreate(
+            name='target', address='10.0.0.9', groups=[])})
+        # Duplicate target name breaks the batch
+        duplicate_future = ingest.put(crud.create_target, {'commit': False, 'target': schemas.TargetCreate(
+            name='target', address='10.0.0.10', groups=[])})
+        group_futures = [ingest.put(crud.create_group, {'commit': False, 'group': schemas.GroupCreate(
+            name='group {0}'.format(index))}) for index in range(8)]
+        assert target_future.result(timeout=10).address == '10.0.0.9'
+        with pytest.raises(Exception):
+            duplicate_future.result(timeout=10)
+        assert len([future.result(timeout=10) for future in group_futures]) == 8
+    finally:
+        ingest.stop()
+    assert rollbacks == [1]
+    stats = ingest.get_stats()
+    assert stats['failed_batches'] == 1 and stats['failed_jobs'] == 1
+    with database.db_session() as db:
+        assert len(crud.get_groups(db=db)) == 8
+
+
+def test_backpressure(db_engine):
+    started = threading.Event()
+    release = threading.Event()
+
+    def _wait(db):
+        started.set()
+        return release.wait(10)
+
+    ingest = ingest_queue.IngestQueue(batch_size=1, batch_interval=0, max_queue_size=2)
+    ingest.start()
+    try:
+        # First job blocks the queue thread, the next two fill the queue
+        futures = [ingest.put(_wait)]
+        assert started.wait(10)
+        futures += [ingest.put(_wait) for _ in range(2)]
+        with pytest.raises(queue.Full):
+            ingest.put(lambda db: None, timeout=0.1)
+        assert ingest.get_stats()['blocked_puts'] == 1
+        assert ingest.get_stats()['max_depth'] == 2
+        release.set()
+        assert [future.result(timeout=10) for future in futures] == [True, True, True]
+    finally:
+        release.set()
+        ingest.stop()
+
+
+def test_probe_results_through_queue(db_engine, monkeypatch):
+    ingest = ingest_queue.IngestQueue(batch_size=100, batch_interval=0.05)
+    monkeypatch.setattr(runner, 'INGEST_QUEUE', ingest)
+    ingest.start()
+    try:
+        targets = [schemas.TargetCreate(name='target {0}'.format(index), address='10.0.0.9', groups=[])
+                   for index in range(20)]
+        futures = [runner.submit_traceroute_update(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE))
+                   for target in targets]
+        # First traceroute of a target has nothing to compare against
+        assert [future.result(timeout=10) for future in futures] == [False] * 20
+        assert runner.update_traceroute_database(targets[0], probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE)) \
+            is False
+    finally:
+        ingest.stop()
+    assert ingest.get_stats()['batches'] < 21
+    with database.db_session() as db:
+        assert len(crud.get_targets(db=db)) == 20
+        assert crud.get_traceroutes_by_target(db=db, target_name='target 0', count=True) == 1
+
+
+def test_probe_interval_in_probe_batch(db_engine, monkeypatch):
+    ingest = ingest_queue.IngestQueue(batch_size=100, batch_interval=0.05)
+    monkeypatch.setattr(runner, 'INGEST_QUEUE', ingest)
+    scheduler = probe_scheduler.ProbeScheduler()
+    scheduler.add('probe:target', print, 600)
+    controller = probe_scheduler.AdaptiveIntervalController(600, min_interval=60, max_interval=1800, backoff_after=5)
+
+    def on_changed(db, changed):
+        runner.adapt_probe_interval(db, 'target', changed, scheduler, controller)
+
+    target = schemas.TargetCreate(name='target', address='10.0.0.9', groups=[])
+    ingest.start()
+    try:
+        assert runner.submit_traceroute_update(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE),
+                                               on_changed=on_changed).result(timeout=10) is False
+        commits = []
+        event.listen(db_engine, 'commit', lambda connection: commits.append(1))
+        changed_traceroute = TRACEROUTE.replace('10.0.0.1', '10.0.0.2')
+        assert runner.submit_traceroute_update(target, probe_engine.ProbeResult('10.0.0.9', 0, changed_traceroute),
+                                               on_changed=on_changed).result(timeout=10) is True
+    finally:
+        ingest.stop()
+    # Path change tightened the interval, stored in the same commit as the traceroute
+    assert len(commits) == 1
+    assert scheduler.get('probe:target').interval == 60
+    with database.db_session() as db:
+        assert crud.get_target(db=db, name='target').probe_interval == 60
+        assert crud.get_traceroutes_by_target(db=db, target_name='target', count=True) == 2
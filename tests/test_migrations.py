@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.migrations"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052801"
+
+import configparser
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+from traceroute_history import models, migrations, crud, schemas, database
+
+TRACEROUTE = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+# Tables as created by the first versions
+LEGACY_SCHEMA = [
+    'CREATE TABLE target (id INTEGER PRIMARY KEY, creation_date DATETIME DEFAULT CURRENT_TIMESTAMP, '
+    'update_date DATETIME, name VARCHAR(255) NOT NULL UNIQUE, address VARCHAR(512))',
+    'CREATE TABLE traceroute (id INTEGER PRIMARY KEY, creation_date DATETIME DEFAULT CURRENT_TIMESTAMP, '
+    'raw_traceroute VARCHAR(2048) NOT NULL, target_id INTEGER REFERENCES target(id))',
+    'CREATE TABLE "group" (id INTEGER PRIMARY KEY, creation_date DATETIME DEFAULT CURRENT_TIMESTAMP, '
+    'update_date DATETIME, name VARCHAR(255) NOT NULL UNIQUE)',
+    'CREATE TABLE target_groups_association (target_id INTEGER REFERENCES target(id), '
+    'group_id INTEGER REFERENCES "group"(id))',
+    "INSERT INTO target (name, address) VALUES ('target', '10.0.0.9')",
+    "INSERT INTO traceroute (raw_traceroute, target_id) VALUES ('No route', 1)",
+]
+
+
+def test_upgrade_legacy_database(tmp_path):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'))
+    with engine.begin() as connection:
+        for statement in LEGACY_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text('INSERT INTO traceroute (raw_traceroute, target_id) VALUES (:raw, 1)'),
+                           {'raw': TRACEROUTE})
+    assert migrations.get_schema_version(engine) == 0
+
+    assert migrations.upgrade(engine) == [migration.version for migration in migrations.MIGRATIONS]
+    assert migrations.get_schema_version(engine) == migrations.LATEST_VERSION
+    inspector = inspect(engine)
+    assert {'hop', 'probe', 'rtt_series', 'rtt_rollup', 'rtt_rollup_dirty'} <= set(inspector.get_table_names())
+    assert 'path_hash' in [column['name'] for column in inspector.get_columns('traceroute')]
+    assert {'ix_traceroute_target_id_id', 'ix_traceroute_target_id_creation_date'} <= \
+        {index['name'] for index in inspector.get_indexes('traceroute')}
+    # Nothing left to apply
+    assert migrations.upgrade(engine) == []
+
+    db = sessionmaker(bind=engine)()
+    try:
+        unparseable, parseable = db.query(models.Traceroute).order_by(models.Traceroute.id).all()
+        assert unparseable.raw_traceroute == 'No route' and not unparseable.hops
+        # Existing traceroutes got their hops once, during the upgrade
+        assert [hop.ttl for hop in parseable.hops] == [1, 2]
+        assert parseable.path_hash is not None
+        crud.create_target_traceroute(db=db, target_id=1, traceroute=schemas.TracerouteCreate(raw_traceroute='x'))
+        assert crud.get_traceroutes_by_target(db=db, target_name='target', count=True) == 3
+    finally:
+        db.close()
+
+
+def test_latest_traceroute_uses_index(tmp_path):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'))
+    models.init_db(engine)
+    # Fresh databases get stamped at the latest version
+    assert migrations.get_schema_version(engine) == migrations.LATEST_VERSION
+    with engine.connect() as connection:
+        plan = ' '.join(str(row[-1]) for row in connection.execute(text(
+            'EXPLAIN QUERY PLAN SELECT id FROM traceroute WHERE target_id = 1 ORDER BY id DESC LIMIT 1')))
+        assert 'ix_traceroute_target_id_id' in plan and 'TEMP B-TREE' not in plan
+        plan = ' '.join(str(row[-1]) for row in connection.execute(text(
+            "EXPLAIN QUERY PLAN SELECT id FROM traceroute WHERE target_id = 1 AND creation_date < '2022-01-01'")))
+        assert 'SEARCH' in plan and 'ix_traceroute_target_id_' in plan
+
+
+def test_load_database_requires_upgrade(tmp_path, monkeypatch):
+    db_file = tmp_path / 'test.db'
+    engine = create_engine('sqlite:///{0}'.format(db_file))
+    with engine.begin() as connection:
+        for statement in LEGACY_SCHEMA:
+            connection.execute(text(statement))
+    config = configparser.ConfigParser()
+    config['TRACEROUTE_HISTORY'] = {'database_driver': 'sqlite', 'database_host': str(db_file),
+                                    'sqlite_production_mode': 'no'}
+    monkeypatch.setattr(database, 'SessionLocal', None)
+
+    # Opening a database which is behind never migrates it
+    with pytest.raises(SystemExit) as exc_info:
+        database.load_database(config)
+    assert exc_info.value.code == 3
+    assert migrations.get_schema_version(engine) == 0
+    assert 'hop' not in inspect(engine).get_table_names()
+
+    with pytest.raises(SystemExit) as exc_info:
+        database.load_database(config, upgrade=True)
+    assert exc_info.value.code == 0
+    assert migrations.get_schema_version(engine) == migrations.LATEST_VERSION
+    assert database.load_database(config) is not None
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+
+Loopback tests need root or CAP_NET_RAW, they're skipped otherwise
+Run them inside a network namespace with a few routed hops for multi-hop testing
+"""
+
+__intname__ = "tests.traceroute_history.native_traceroute"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022051101"
+
+import socket
+import struct
+import asyncio
+import pytest
+from traceroute_history import native_traceroute, trparse
+
+
+def can_use_raw_sockets():
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP).close()
+        return True
+    except (PermissionError, OSError):
+        return False
+
+
+def test_paris_icmp_checksum_is_constant():
+    checksums = set()
+    for sequence in range(0, 90):
+        packet = native_traceroute.build_icmp_echo(4242, sequence)
+        # Checksum of a valid packet including its own checksum is 0
+        assert native_traceroute.checksum(packet) == 0, "Bogus ICMP checksum"
+        checksums.add(struct.unpack('!H', packet[2:4])[0])
+    assert len(checksums) == 1, "ICMP flow identifiers should not change between probes"
+
+
+@pytest.mark.skipif(not can_use_raw_sockets(), reason='Raw sockets need root or CAP_NET_RAW')
+def test_native_traceroute_loopback():
+    async def trace_all():
+        tracer = native_traceroute.NativeTracer()
+        try:
+            return [await tracer.traceroute('127.0.0.1', protocol=protocol, timeout=2)
+                    for protocol in native_traceroute.PROTOCOLS]
+        finally:
+            tracer.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        traceroutes = loop.run_until_complete(trace_all())
+    finally:
+        loop.close()
+
+    for traceroute in traceroutes:
+        assert isinstance(traceroute, trparse.Traceroute)
+        assert len(traceroute.hops) == 1, "Loopback should be reached in one hop"
+        assert all(probe.ip == '127.0.0.1' and probe.rtt is not None for probe in traceroute.hops[0].probes)
+        # Rendered output must be readable by the usual parser
+        parsed = trparse.loads(trparse.dumps(traceroute))
+        assert parsed.hops[0].probes[0].ip == '127.0.0.1'
+
+
+if __name__ == "__main__":
+    print("Example code for %s, %s" % (__intname__, __build__))
+    test_paris_icmp_checksum_is_constant()
+    test_native_traceroute_loopback()
@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.paths"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022051701"
+
+from decimal import Decimal
+from traceroute_history import traceroute_cache, paths, trparse
+
+TRACEROUTE_A = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.1.1 (10.0.1.1)  5.000 ms  5.100 ms  5.200 ms
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+TRACEROUTE_B = TRACEROUTE_A.replace('10.0.1.1', '10.0.2.1')
+
+
+def build_traceroute(hops):
+    """
+    Builds a traceroute object the way the native backend does, with one IP per probe
+    """
+    traceroute = trparse.Traceroute('10.0.0.9', '10.0.0.9')
+    for idx, ips in enumerate(hops, 1):
+        hop = trparse.Hop(idx)
+        for ip in ips:
+            hop.add_probe(trparse.Probe(name=ip, ip=ip, rtt=Decimal('1') if ip else None))
+        traceroute.add_hop(hop)
+    return traceroute
+
+
+def test_path_hash():
+    traceroute_a = traceroute_cache.parse_traceroute(TRACEROUTE_A)
+    assert paths.get_path_vector(traceroute_a) == (('10.0.0.1',), ('10.0.1.1',), ('10.0.0.9',))
+    assert paths.get_path_hash(traceroute_a) != paths.get_path_hash(traceroute_cache.parse_traceroute(TRACEROUTE_B))
+    assert traceroute_cache.parse_traceroute('Cannot execute traceroute') is None
+
+    # ECMP hops are order independent
+    ecmp = build_traceroute([['10.0.0.1'] * 3, ['10.0.1.2', '10.0.1.1', '10.0.1.1'], ['10.0.0.9'] * 3])
+    reversed_ecmp = build_traceroute([['10.0.0.1'] * 3, ['10.0.1.1', '10.0.1.2', '10.0.1.2'], ['10.0.0.9'] * 3])
+    assert paths.get_path_vector(ecmp)[1] == ('10.0.1.1', '10.0.1.2')
+    assert paths.get_path_hash(ecmp) == paths.get_path_hash(reversed_ecmp)
+    assert paths.get_path_hash(ecmp) != paths.get_path_hash(traceroute_a)
+
+    timeout = traceroute_cache.parse_traceroute(TRACEROUTE_A.replace(
+        '10.0.1.1 (10.0.1.1)  5.000 ms  5.100 ms  5.200 ms', '* * *'))
+    assert paths.get_path_vector(timeout)[1] == (paths.TIMEOUT_MARKER,)
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.probe_engine"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022051001"
+
+import sys
+import pytest
+from time import monotonic
+from concurrent.futures import wait, CancelledError
+from traceroute_history import probe_engine
+
+FAKE_TRACEROUTE = "import sys, time; time.sleep(float(sys.argv[1])); print('traceroute to ' + sys.argv[1])"
+
+
+def fake_traceroute_command(address):
+    # address is used as the number of seconds the fake traceroute will last
+    return [sys.executable, '-c', FAKE_TRACEROUTE, address], 'utf-8'
+
+
+def test_probe_engine_concurrency(monkeypatch):
+    monkeypatch.setattr(probe_engine, 'get_traceroute_command', fake_traceroute_command)
+    engine = probe_engine.ProbeEngine(max_concurrent_probes=50, probe_timeout=10)
+    engine.start()
+    results = []
+    try:
+        start_time = monotonic()
+        futures = [engine.submit('0.5', callback=results.append) for _ in range(50)]
+        wait(futures)
+        duration = monotonic() - start_time
+    finally:
+        engine.stop()
+    assert len(results) == 50, "All callbacks should have been run"
+    assert all(result.exit_code == 0 and 'traceroute to 0.5' in result.output for result in results)
+    # 50 sequential probes would last 25 seconds
+    assert duration < 10, "Probes did not run concurrently"
+
+
+def test_probe_engine_timeout_and_cancel(monkeypatch):
+    monkeypatch.setattr(probe_engine, 'get_traceroute_command', fake_traceroute_command)
+    engine = probe_engine.ProbeEngine(max_concurrent_probes=2, probe_timeout=1)
+    engine.start()
+    try:
+        result = engine.submit('30').result(timeout=10)
+        assert result.exit_code == -1, "Probe should have timed out"
+
+        future = engine.submit('30')
+        start_time = monotonic()
+        while engine.in_flight == 0 and monotonic() - start_time < 5:
+            pass
+        future.cancel()
+        try:
+            future.result(timeout=5)
+        except CancelledError:
+            pass
+        assert future.cancelled()
+    finally:
+        engine.stop()
+    assert engine.in_flight == 0
+
+
+def test_probe_engine_rate_limit(monkeypatch):
+    monkeypatch.setattr(probe_engine, 'get_traceroute_command', fake_traceroute_command)
+    engine = probe_engine.ProbeEngine(max_concurrent_probes=50, probe_timeout=10, max_probes_per_second=10)
+    engine.start()
+    try:
+        start_time = monotonic()
+        wait([engine.submit('0') for _ in range(11)])
+        duration = monotonic() - start_time
+    finally:
+        engine.stop()
+    # 11 probes at 10 probes per second need at least one second to start
+    assert duration >= 1, "Probe rate limit not honored"
+
+
+if __name__ == "__main__":
+    print("Example code for %s, %s" % (__intname__, __build__))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        test_probe_engine_concurrency(monkeypatch)
+        test_probe_engine_timeout_and_cancel(monkeypatch)
+        test_probe_engine_rate_limit(monkeypatch)
@@ -0,0 +1,189 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.probe_scheduler"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022051301"
+
+from time import monotonic, sleep
+from traceroute_history import probe_scheduler, config_management
+from traceroute_history import traceroute_history_runner as runner
+
+
+def test_target_phase_spread():
+    interval = 1800
+    phases = [probe_scheduler.get_target_phase('target{0}'.format(i), interval) for i in range(10000)]
+    assert phases == [probe_scheduler.get_target_phase('target{0}'.format(i), interval) for i in range(10000)], \
+        "Phases must be deterministic"
+    assert all(0 <= phase < interval for phase in phases)
+
+    # Every minute of the interval should get roughly the same number of targets
+    buckets = [0] * 30
+    for phase in phases:
+        buckets[int(phase // 60)] += 1
+    assert min(buckets) > 0.8 * 10000 / 30 and max(buckets) < 1.2 * 10000 / 30, "Bogus phase distribution"
+
+
+def test_first_due_wall_clock_phase():
+    interval = 1800
+    phase = probe_scheduler.get_target_phase('target', interval)
+    # Whatever the start time, the first run lands on the same wall clock offset within the interval
+    for now in (1650000000, 1650000000.5, 1650001234, 1650009999.9):
+        first_due = probe_scheduler.get_first_due('target', interval, now=now)
+        assert 0 <= first_due < interval
+        assert abs((now + first_due) % interval - phase) < 1e-6
+
+
+class FakeClock(object):
+    """
+    Clock only moving forward when told to, so scheduler tests do not depend on wall clock timing
+    """
+    def __init__(self, now: float = 1000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+def _wait_until(predicate, timeout: float = 5):
+    # Only waits for the scheduler and worker threads to catch up with the fake clock
+    deadline = monotonic() + timeout
+    while not predicate():
+        assert monotonic() < deadline, "Scheduler did not catch up with the clock"
+        sleep(0.001)
+
+
+def test_probe_scheduler_runs():
+    runs = []
+
+    def record(name):
+        runs.append(name)
+
+    def ran(name, count):
+        return runs.count(name) == count and not scheduler.get(name).running
+
+    clock = FakeClock()
+    # Binary exact resolution and deadlines, so deadline slots match the clock exactly
+    scheduler = probe_scheduler.ProbeScheduler(max_workers=1, resolution=0.25, clock=clock)
+    # Same deadline, lower priority runs first
+    scheduler.add('low', record, 1, kwargs={'name': 'low'}, first_due=0.5, priority=10)
+    scheduler.add('high', record, 1, kwargs={'name': 'high'}, first_due=0.5, priority=0)
+    scheduler.add('removed', record, 1, kwargs={'name': 'removed'}, first_due=0.5)
+    scheduler.remove('removed')
+    scheduler.start()
+    try:
+        clock.advance(0.25)
+        assert runs == [], "Entries ran before their deadline"
+        clock.advance(0.25)
+        _wait_until(lambda: ran('high', 1) and ran('low', 1))
+        assert runs == ['high', 'low'], "Bogus run order"
+
+        # Per entry intervals
+        scheduler.reschedule('high', interval=0.5)
+        scheduler.reschedule('low', interval=10)
+        for count in range(2, 5):
+            clock.advance(0.5)
+            _wait_until(lambda: ran('high', count))
+        assert runs.count('low') == 1, "Rescheduled entry should not have run again"
+        assert 'removed' not in runs
+
+        stats = scheduler.get_stats()
+        assert stats['entries'] == 2
+        assert stats['dispatched'] == len(runs) == 5
+        assert stats['missed_deadlines'] == 0
+        assert stats['max_lag'] == 0
+    finally:
+        scheduler.stop()
+
+
+def test_probe_scheduler_scale():
+    scheduler = probe_scheduler.ProbeScheduler()
+    for i in range(10000):
+        scheduler.add('probe:target{0}'.format(i), print, 1800,
+                      first_due=probe_scheduler.get_target_phase('target{0}'.format(i), 1800))
+    # Replacing and rescheduling entries must not grow the heap unbounded
+    for i in range(10000):
+        scheduler.reschedule('probe:target{0}'.format(i), interval=900)
+    assert len(scheduler) == 10000
+    assert len(scheduler._heap) <= 2 * 10000 + 64
+
+
+def test_jitter_keeps_phase():
+    clock = FakeClock()
+    # Binary exact times, short since the scheduler thread still waits for the real time until a deadline
+    scheduler = probe_scheduler.ProbeScheduler(max_workers=1, resolution=1 / 64, clock=clock)
+    entry = scheduler.add('jittered', lambda: None, 1 / 8, first_due=1 / 16, jitter=3 / 32)
+    first_due = entry.next_due
+    scheduler.start()
+    try:
+        for runs in range(1, 16):
+            # Past the latest jittered slot of this cycle, before the deadline of the next one
+            clock.now = first_due + (runs - 1) * entry.interval + entry.jitter + scheduler.resolution
+            _wait_until(lambda: entry.runs == runs and not entry.running)
+    finally:
+        scheduler.stop()
+    # Jitter delays runs, but deadlines stay on the interval grid of the first one, cycle after cycle
+    assert (entry.next_due - first_due) / entry.interval == entry.runs == 15
+    assert scheduler.get_stats()['max_lag'] <= entry.jitter + scheduler.resolution
+
+
+def test_adaptive_interval():
+    controller = probe_scheduler.AdaptiveIntervalController(600, min_interval=60, max_interval=1800,
+                                                            backoff_factor=2, backoff_after=2)
+    assert controller.get_interval('target') == 600
+
+    # Path change tightens to min_interval right away
+    assert controller.update('target', True) == 60
+    assert controller.update('target', True) is None
+
+    # Backs off after backoff_after stable probes, up to max_interval
+    intervals = [controller.update('target', False) for _ in range(12)]
+    assert [interval for interval in intervals if interval] == [120, 240, 480, 960, 1800]
+    assert controller.get_interval('target') == 1800
+
+    controller.seed('other', 10)
+    assert controller.get_interval('other') == 60, "Seeded intervals must be bounded"
+
+
+def test_reconcile_reseeds_changed_interval():
+    scheduler = probe_scheduler.ProbeScheduler()
+    controller = probe_scheduler.AdaptiveIntervalController(600, min_interval=60, max_interval=3600)
+    settings = {'engine': None, 'interval': 600, 'scheduling_mode': 'burst', 'interval_controller': controller}
+    target = config_management.TargetConfig(name='target', address='127.0.0.1', interval=1800)
+    runner.reconcile_targets(scheduler, (), (target,), **settings)
+    assert scheduler.get('probe:target').interval == 1800
+
+    # Adapted interval survives unrelated changes, not a new configured interval
+    controller.update('target', True)
+    regrouped_target = target._replace(groups=('group',))
+    runner.reconcile_targets(scheduler, (target,), (regrouped_target,), **settings)
+    assert scheduler.get('probe:target').interval == 60
+    runner.reconcile_targets(scheduler, (regrouped_target,), (regrouped_target._replace(interval=900),), **settings)
+    assert scheduler.get('probe:target').interval == 900
+    assert controller.get_interval('target') == 900
+
+
+if __name__ == "__main__":
+    print("Example code for %s, %s" % (__intname__, __build__))
+    test_target_phase_spread()
+    test_first_due_wall_clock_phase()
+    test_probe_scheduler_runs()
+    test_probe_scheduler_scale()
+    test_jitter_keeps_phase()
+    test_adaptive_interval()
+    test_reconcile_reseeds_changed_interval()
+
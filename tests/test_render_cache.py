@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.render_cache"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052101"
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from traceroute_history import models, database, schemas, probe_engine, traceroute_cache, render_cache
+from traceroute_history import traceroute_history_runner as runner
+
+TRACEROUTE_A = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.1.1 (10.0.1.1)  5.000 ms  5.100 ms  5.200 ms
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+TRACEROUTE_B = TRACEROUTE_A.replace('10.0.1.1', '10.0.2.1')
+
+
+@pytest.fixture
+def db_engine(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'), connect_args={'check_same_thread': False})
+    models.init_db(engine)
+    monkeypatch.setattr(database, 'SessionLocal', scoped_session(sessionmaker(bind=engine, autoflush=False)))
+    config_file = tmp_path / 'traceroute_history.conf'
+    config_file.write_text('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 0\n')
+    monkeypatch.setattr(runner, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(runner, 'LAST_TRACEROUTES', traceroute_cache.LastTracerouteCache())
+    return engine
+
+
+def test_lru_eviction():
+    cache = render_cache.RenderCache(max_size=10)
+    cache.put((1, 1, 'web'), 'aaaa')
+    cache.put((2, 1, 'web'), 'bbbb')
+    assert cache.get((1, 1, 'web')) == 'aaaa'
+    # Least recently used entry goes first
+    cache.put((3, 1, 'web'), 'cccc')
+    assert cache.get((2, 1, 'web')) is None
+    assert cache.get((1, 1, 'web')) == 'aaaa'
+    assert cache.size == 8
+    # Values bigger than the whole cache are not kept
+    cache.put((4, 1, 'web'), 'd' * 11)
+    assert len(cache) == 2
+
+    renders = []
+    assert cache.get_or_render((3, 1, 'web'), lambda: renders.append(1)) == 'cccc'
+    assert not renders
+
+    cache.on_new_traceroute(1, 2)
+    assert cache.get((1, 1, 'web')) is None
+    assert cache.size == 4
+    assert cache.hits == 3 and cache.misses == 2
+
+
+def test_target_diff_cache(db_engine, monkeypatch):
+    monkeypatch.setattr(runner, 'RENDER_CACHE', render_cache.RenderCache())
+    target = schemas.TargetCreate(name='target', address='10.0.0.9')
+    runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_A))
+    runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_B))
+
+    diff = runner.get_target_diff(1, formatting='none')
+    assert '10.0.2.1' in diff
+    statements = []
+    event.listen(db_engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    assert runner.get_target_diff(1, formatting='none') == diff
+    # Only the version check
+    assert len(statements) == 1
+
+    # Stored by this process, listener drops outdated entries
+    runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_A))
+    assert len(runner.RENDER_CACHE) == 0
+    new_diff = runner.get_target_diff(1, formatting='none')
+    assert new_diff.index('10.0.1.1') < new_diff.index('10.0.2.1')
+
+    # Stored by another process, noticed through the version counter
+    with database.db_scoped_session() as db:
+        db.add(models.Traceroute(raw_traceroute=TRACEROUTE_B.replace('9.200 ms', '19.200 ms'), target_id=1))
+        db.commit()
+    assert '19.200 ms' in runner.get_target_diff(1, formatting='none')
+    assert runner.get_target_diff(2) is False
@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.resolver"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022051201"
+
+import asyncio
+from traceroute_history import resolver, trparse
+
+NUMERIC_TRACEROUTE = """traceroute to 127.0.0.1 (127.0.0.1), 30 hops max, 60 byte packets
+ 1  127.0.0.1  0.030 ms  0.010 ms  0.008 ms
+"""
+
+
+def test_resolver_cache():
+    hostname_resolver = resolver.HostnameResolver(cache_size=2, lookup_timeout=1)
+    loop = asyncio.new_event_loop()
+    try:
+        names = loop.run_until_complete(hostname_resolver.resolve_many(['127.0.0.1', '127.0.0.1', '192.0.2.1']))
+        assert set(names) == {'127.0.0.1', '192.0.2.1'}, "Duplicate addresses should be resolved once"
+        assert hostname_resolver.misses == 2
+
+        # TEST-NET address has no PTR record, failure must be negatively cached
+        assert names['192.0.2.1'] is None
+        assert hostname_resolver.get_cached('192.0.2.1') == (True, None)
+
+        traceroute = trparse.loads(NUMERIC_TRACEROUTE)
+        loop.run_until_complete(hostname_resolver.fill_names(traceroute))
+        assert traceroute.hops[0].probes[0].name == (names['127.0.0.1'] or '127.0.0.1')
+        assert hostname_resolver.hits == 1, "Traceroute hop should have been served from cache"
+
+        # LRU eviction
+        loop.run_until_complete(hostname_resolver.resolve('127.0.0.2'))
+        assert hostname_resolver.get_cached('192.0.2.1') == (False, None)
+    finally:
+        loop.close()
+
+
+if __name__ == "__main__":
+    print("Example code for %s, %s" % (__intname__, __build__))
+    test_resolver_cache()
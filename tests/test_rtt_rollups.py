@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.rtt_rollups"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052001"
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from traceroute_history import models, crud, schemas, rtt_series, rtt_rollups, trparse
+
+TRACEROUTE = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  {0:.3f} ms  {0:.3f} ms  {0:.3f} ms
+ 2  10.0.0.9 (10.0.0.9)  {1:.3f} ms  {1:.3f} ms  {1:.3f} ms
+"""
+
+LOST_TRACEROUTE = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  1.000 ms  1.000 ms  1.000 ms
+ 2  * * *
+"""
+
+# 2022-05-19 00:00:00 UTC
+DAY_START = 1652918400
+
+
+def test_percentile():
+    assert rtt_rollups.get_percentile([], 95) is None
+    assert rtt_rollups.get_percentile([5], 95) == 5
+    assert rtt_rollups.get_percentile(list(range(1, 101)), 95) == 95
+
+
+def test_rollups_and_retention():
+    engine = create_engine('sqlite://')
+    models.init_db(engine)
+    db = Session(engine)
+
+    # Two days of five minute probes, every 20th probe loses the target, destination rtt grows within each hour
+    writer = rtt_series.RttSeriesWriter()
+    for index, timestamp in enumerate(range(DAY_START, DAY_START + 2 * 86400, 300)):
+        if index % 20 == 19:
+            traceroute = trparse.loads(LOST_TRACEROUTE)
+        else:
+            traceroute = trparse.loads(TRACEROUTE.format(1, 10 + index % 12))
+        writer.record(1, traceroute, timestamp=timestamp)
+    writer.flush(db)
+
+    now = DAY_START + 86400 + 3600 + rtt_rollups.DEFAULT_GRACE
+    # 25 closed hours, 3 rows each (target, hop 1, hop 2), and the first closed day
+    assert rtt_rollups.roll_up(db, rtt_rollups.HOURLY, now=now) == 25 * 3
+    assert rtt_rollups.roll_up(db, rtt_rollups.DAILY, now=now) == 3
+    # Incremental, nothing left to do until the next bucket closes
+    assert rtt_rollups.roll_up(db, rtt_rollups.HOURLY, now=now) == 0
+    assert rtt_rollups.roll_up(db, rtt_rollups.HOURLY, now=now + 3600) == 3
+
+    hour = rtt_rollups.get_rollups(db, 1, DAY_START, DAY_START + 3600)
+    assert len(hour) == 1
+    assert hour[0].sample_count == 12
+    assert hour[0].rtt_min == 10
+    assert hour[0].rtt_max == 21
+    assert hour[0].rtt_p95 == 21
+    assert round(hour[0].loss, 2) == 0
+
+    day = rtt_rollups.get_rollups(db, 1, DAY_START, DAY_START + 60 * 86400)
+    assert [(rollup.resolution, rollup.sample_count) for rollup in day] == [(rtt_rollups.DAILY, 288)]
+    # 14 of 288 probes lost the target, hop 1 always answered
+    assert round(day[0].loss, 2) == round(100 * 14 / 288, 2)
+    hop = rtt_rollups.get_rollups(db, 1, DAY_START, DAY_START + 60 * 86400, ttl=1)
+    assert hop[0].loss == 0
+    assert hop[0].rtt_mean == 1
+
+    deleted = rtt_rollups.apply_retention(db, rtt_series_keep_days=2, hourly_keep_days=1, daily_keep_days=0,
+                                          now=DAY_START + 3 * 86400)
+    assert deleted == {'raw': 24, 'hourly': 26 * 3}
+    assert db.query(models.RttRollup).filter(models.RttRollup.resolution == rtt_rollups.DAILY).count() == 3
+
+
+def test_late_samples_roll_up_again():
+    engine = create_engine('sqlite://')
+    models.init_db(engine)
+    db = Session(engine)
+
+    now = DAY_START + 86400 + 3600 + rtt_rollups.DEFAULT_GRACE
+    writer = rtt_series.RttSeriesWriter(on_write=lambda **kwargs: rtt_rollups.mark_late_samples(now=now, **kwargs))
+    for timestamp in range(DAY_START, DAY_START + 86400 + 3600, 300):
+        writer.record(1, trparse.loads(TRACEROUTE.format(1, 10)), timestamp=timestamp)
+    writer.flush(db)
+    for resolution in rtt_rollups.RESOLUTIONS:
+        rtt_rollups.roll_up(db, resolution, now=now)
+    assert db.query(models.RttRollupDirty).count() == 0
+    # Samples of the current hour are not late
+    writer.record(1, trparse.loads(TRACEROUTE.format(1, 10)), timestamp=now - 60)
+    writer.flush(db)
+    assert db.query(models.RttRollupDirty).count() == 0
+
+    # Samples recorded during an outage and replayed afterwards land in already rolled up buckets
+    writer.record(1, trparse.loads(TRACEROUTE.format(1, 50)), timestamp=DAY_START + 10 * 3600 + 150)
+    writer.flush(db)
+    assert db.query(models.RttRollupDirty).count() == 2
+    assert rtt_rollups.roll_up(db, rtt_rollups.HOURLY, now=now) == 15 * 3
+    assert rtt_rollups.roll_up(db, rtt_rollups.DAILY, now=now) == 3
+    assert db.query(models.RttRollupDirty).count() == 0
+
+    hour = rtt_rollups.get_rollups(db, 1, DAY_START + 10 * 3600, DAY_START + 11 * 3600)
+    assert [(rollup.sample_count, rollup.rtt_max) for rollup in hour] == [(13, 50)]
+    assert rtt_rollups.get_rollups(db, 1, DAY_START, DAY_START + 3600)[0].sample_count == 12
+    day = rtt_rollups.get_rollups(db, 1, DAY_START, DAY_START + 60 * 86400)
+    assert [rollup.sample_count for rollup in day] == [289]
+    # Nothing left to do
+    assert rtt_rollups.roll_up(db, rtt_rollups.HOURLY, now=now) == 0
+
+
+def test_delete_target_deletes_rtt_data():
+    engine = create_engine('sqlite://')
+    models.init_db(engine)
+    db = Session(engine)
+    target = crud.create_target(db, schemas.TargetCreate(name='target', address='10.0.0.9', groups=[]))
+    other = crud.create_target(db, schemas.TargetCreate(name='other', address='10.0.0.8', groups=[]))
+
+    writer = rtt_series.RttSeriesWriter()
+    for target_id in (target.id, other.id):
+        writer.record(target_id, trparse.loads(TRACEROUTE.format(1, 10)), timestamp=DAY_START)
+    writer.flush(db)
+    rtt_rollups.roll_up(db, rtt_rollups.HOURLY, now=DAY_START + 86400)
+    crud.mark_rtt_rollups_dirty(db, target.id, rtt_rollups.HOURLY, DAY_START)
+    db.commit()
+
+    crud.delete_target(db, name='target')
+    for model in (models.RttSeries, models.RttRollup, models.RttRollupDirty):
+        assert db.query(model).filter(model.target_id == target.id).count() == 0
+    # Other targets keep their data
+    assert db.query(models.RttSeries).filter(models.RttSeries.target_id == other.id).count() == 1
+    assert db.query(models.RttRollup).filter(models.RttRollup.target_id == other.id).count() == 3
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.rtt_series"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022051901"
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from traceroute_history import models, rtt_series, trparse
+
+TRACEROUTE = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.600 ms
+ 2  * * *
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms *  9.200 ms
+"""
+
+# 2022-05-19 10:00:00 UTC
+BUCKET_START = 1652954400
+
+
+def test_pack_samples():
+    traceroute = trparse.loads(TRACEROUTE)
+    data = rtt_series.pack_samples(BUCKET_START, BUCKET_START + 125, traceroute)
+    assert len(data) == 3 * rtt_series.SAMPLE_STRUCT.size
+    samples = rtt_series.unpack_samples(BUCKET_START, data)
+    assert samples[0] == rtt_series.RttSample(BUCKET_START + 125, 1, 0.4, 0.5, 0.6, 0)
+    assert samples[1] == rtt_series.RttSample(BUCKET_START + 125, 2, None, None, None, 100)
+    # trparse drops unanswered probes of answering hops, so only fully silent hops show loss
+    assert samples[2] == rtt_series.RttSample(BUCKET_START + 125, 3, 9.0, 9.1, 9.2, 0)
+
+
+def test_writer_batches_per_target_and_hour():
+    engine = create_engine('sqlite://')
+    models.init_db(engine)
+    db = Session(engine)
+    traceroute = trparse.loads(TRACEROUTE)
+
+    writer = rtt_series.RttSeriesWriter(max_buffered_samples=30)
+    # Five minute samples over two hours, for two targets
+    full = False
+    for timestamp in range(BUCKET_START, BUCKET_START + 7200, 300):
+        for target_id in (1, 2):
+            full = writer.record(target_id, traceroute, timestamp=timestamp) or full
+        if full:
+            writer.flush(db)
+            full = False
+    writer.flush(db)
+    assert writer.buffered_samples == 0
+    assert writer.flushed_samples == 2 * 24 * 3
+
+    # One row per target and hour
+    assert db.query(models.RttSeries).count() == 4
+    assert {series.sample_count for series in db.query(models.RttSeries)} == {36}
+
+    samples = rtt_series.get_samples(db, target_id=1)
+    assert len(samples) == 24 * 3
+    assert [sample.timestamp for sample in samples] == sorted(sample.timestamp for sample in samples)
+    samples = rtt_series.get_samples(db, target_id=2, start=BUCKET_START + 3000, end=BUCKET_START + 4200, ttl=3)
+    assert [sample.timestamp - BUCKET_START for sample in samples] == [3000, 3300, 3600, 3900]
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.soak"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052701"
+
+import gc
+import os
+import random
+import configparser
+import tracemalloc
+import weakref
+from concurrent.futures import wait as wait_futures
+from sqlalchemy import create_engine, event
+from traceroute_history import models, database, schemas, probe_engine, traceroute_cache, rtt_series, \
+    render_cache, ingest_queue
+from traceroute_history import traceroute_history_runner as runner
+
+# Probe cycles of the soak test, raise it for longer runs
+SOAK_CYCLES = int(os.environ.get('TRACEROUTE_HISTORY_SOAK_CYCLES', 5000))
+SOAK_TARGETS = 50
+
+TRACEROUTE = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  {0} ({0})  5.000 ms  5.100 ms  5.200 ms
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+
+class FakeProbeEngine(probe_engine.ProbeEngine):
+    """
+    Probe engine answering instantly, one probe out of ten sees its path change
+    """
+    async def _os_probe(self, address):
+        return 0, TRACEROUTE.format('10.0.{0}.1'.format(random.randint(1, 2) if random.random() < 0.1 else 1))
+
+
+def _track_orm_objects(tracked):
+    """
+    Adds every Target / Traceroute / Hop loaded or created from now on to tracked
+
+    :return: (list) (model, event name, listener) to remove once done
+    """
+    listeners = []
+    for model in (models.Target, models.Traceroute, models.Hop):
+        for event_name in ('load', 'init'):
+            listener = (lambda instance, *args: tracked.add(instance))
+            event.listen(model, event_name, listener)
+            listeners.append((model, event_name, listener))
+    return listeners
+
+
+def test_daemon_soak(tmp_path, monkeypatch):
+    # Sqlite connections left over by previous tests fail to close when garbage collected from another thread, the
+    # logged traceback would keep the frames of the soak thread that triggered the collection, and their objects, alive
+    gc.collect()
+    db_file = tmp_path / 'test.db'
+    init_engine = create_engine('sqlite:///{0}'.format(db_file))
+    models.init_db(init_engine)
+    init_engine.dispose()
+    config = configparser.ConfigParser()
+    config['TRACEROUTE_HISTORY'] = {'database_driver': 'sqlite', 'database_host': str(db_file)}
+    config_file = tmp_path / 'traceroute_history.conf'
+    config_file.write_text('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 0\n')
+    for name in ('SessionLocal', 'DB_WRITER'):
+        monkeypatch.setattr(database, name, None)
+    monkeypatch.setattr(runner, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(runner, 'LAST_TRACEROUTES', traceroute_cache.LastTracerouteCache())
+    monkeypatch.setattr(runner, 'RTT_SERIES', rtt_series.RttSeriesWriter())
+    monkeypatch.setattr(runner, 'RENDER_CACHE', render_cache.RenderCache())
+    monkeypatch.setattr(runner, 'SPOOL', None)
+    ingest = ingest_queue.IngestQueue(batch_interval=0.05)
+    monkeypatch.setattr(runner, 'INGEST_QUEUE', ingest)
+
+    database.load_database(config, writer=True)
+    connections = {'open': 0, 'checked_out': 0}
+    for engine in (database.SessionLocal.session_factory.kw['bind'], database.DB_WRITER._session_factory.kw['bind']):
+        event.listen(engine, 'connect', lambda *args: connections.update(open=connections['open'] + 1))
+        event.listen(engine.pool, 'close', lambda *args: connections.update(open=connections['open'] - 1))
+        event.listen(engine, 'checkout', lambda *args: connections.update(checked_out=connections['checked_out'] + 1))
+        event.listen(engine, 'checkin', lambda *args: connections.update(checked_out=connections['checked_out'] - 1))
+
+    # Weak references only, tracking must not keep objects alive
+    orm_objects = weakref.WeakSet()
+    listeners = _track_orm_objects(orm_objects)
+    engine = FakeProbeEngine(max_concurrent_probes=16)
+    targets = [schemas.TargetCreate(name='target {0}'.format(index), address='10.0.0.9', groups=[
+        schemas.GroupCreate(name='group {0}'.format(index % 5))]) for index in range(SOAK_TARGETS)]
+    rounds = max(SOAK_CYCLES // SOAK_TARGETS, 10)
+    warmup_rounds = rounds // 5
+    ingest.start()
+    engine.start()
+    tracemalloc.start()
+    try:
+        for round_index in range(rounds):
+            wait_futures([runner.probe_target(engine, target) for target in targets])
+            if round_index % 10 == 0:
+                runner.flush_rtt_series()
+                runner.list_targets(include_tr=True)
+                runner.get_last_traceroutes_formatted('target 0', limit=2)
+            if round_index == warmup_rounds:
+                # Let pending batches land before taking the reference
+                ingest.stop()
+                ingest.start()
+                gc.collect()
+                reference_memory = tracemalloc.get_traced_memory()[0]
+                reference_connections = dict(connections)
+        ingest.stop()
+        runner.flush_rtt_series()
+        gc.collect()
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+        engine.stop()
+        ingest.stop()
+        database.DB_WRITER.stop()
+        for listener in listeners:
+            event.remove(*listener)
+
+    assert ingest.get_stats()['jobs'] >= rounds * SOAK_TARGETS
+    # Closed sessions do not keep any ORM object loaded during the soak alive
+    assert len(orm_objects) == 0, '{0} ORM objects left alive'.format(len(orm_objects))
+    # No connection left checked out, no connection opened for good after warmup
+    assert connections['checked_out'] == 0
+    assert connections['open'] <= reference_connections['open']
+    # Flat memory, whatever the number of cycles
+    assert memory - reference_memory < 1024 * 1024, 'Memory grew by {0} bytes'.format(memory - reference_memory)
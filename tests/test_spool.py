@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.spool"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052601"
+
+import os
+import datetime
+import pytest
+import sqlalchemy.exc
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+from traceroute_history import models, database, schemas, probe_engine, traceroute_cache, crud, spool
+from traceroute_history import traceroute_history_runner as runner
+
+TRACEROUTE_A = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.1.1 (10.0.1.1)  5.000 ms  5.100 ms  5.200 ms
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+TRACEROUTE_B = TRACEROUTE_A.replace('10.0.1.1', '10.0.2.1')
+
+
+def test_spool_records(tmp_path):
+    spool_file = str(tmp_path / 'test.spool')
+    spool_a = spool.Spool(spool_file, sync_records=2)
+    spool_a.open()
+    for index in (3, 1, 2):
+        assert spool_a.append({'index': index}, timestamp=1000 + index)
+    records, end = spool_a.read_pending()
+    # Timestamp order
+    assert [record.record['index'] for record in records] == [1, 2, 3]
+    assert end == spool_a.size
+
+    # Records 3 and 1 are stored, 2 is not, offset stops right before 2
+    offset = spool.get_replayed_offset(records[1:2], end)
+    assert offset == records[1].start
+    spool_a.commit(offset)
+    assert len(spool_a) == 1
+    spool_a.close()
+
+    # Torn record at the end, eg crash during write
+    with open(spool_file, 'ab') as file_handle:
+        file_handle.write(spool.pack_record(1004, b'{"index": 4}')[:-3])
+    spool_b = spool.Spool(spool_file)
+    spool_b.open()
+    records, end = spool_b.read_pending()
+    assert [record.record['index'] for record in records] == [2]
+    assert os.path.getsize(spool_file) == end
+    spool_b.commit(end)
+    # Fully replayed spools are emptied
+    assert len(spool_b) == 0 and os.path.getsize(spool_file) == 0
+    spool_b.close()
+
+
+def test_spool_delivered_records(tmp_path):
+    spool_file = str(tmp_path / 'test.spool')
+    spool_a = spool.Spool(spool_file)
+    spool_a.open()
+    for index in (3, 1, 2):
+        spool_a.append({'index': index}, timestamp=1000 + index)
+    records, end = spool_a.read_pending()
+    # Records 1 and 2 stored, offset stays before 3 which is first in spool order
+    spool_a.commit(spool.get_replayed_offset(records[2:], end), delivered=[record.start for record in records[:2]])
+    assert len(spool_a) == 1
+    assert [record.record['index'] for record in spool_a.read_pending()[0]] == [3]
+    spool_a.close()
+
+    # Delivered records are remembered across restarts
+    spool_b = spool.Spool(spool_file)
+    spool_b.open()
+    assert len(spool_b) == 1
+    records, end = spool_b.read_pending()
+    assert [record.record['index'] for record in records] == [3]
+    spool_b.commit(spool.get_replayed_offset([], end), delivered=[records[0].start])
+    assert len(spool_b) == 0 and os.path.getsize(spool_file) == 0
+    assert spool_b.get_stats()['replayed'] == 1
+    spool_b.close()
+
+
+def test_spool_max_size(tmp_path):
+    spool_a = spool.Spool(str(tmp_path / 'test.spool'), max_size=100)
+    spool_a.open()
+    assert spool_a.append({'output': 'x' * 40}, timestamp=1)
+    assert not spool_a.append({'output': 'x' * 40}, timestamp=2)
+    assert spool_a.get_stats()['dropped'] == 1
+    assert spool_a.size <= 100
+    spool_a.close()
+
+
+@pytest.fixture
+def db_engine(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'), connect_args={'check_same_thread': False})
+    models.init_db(engine)
+    monkeypatch.setattr(database, 'SessionLocal', scoped_session(sessionmaker(bind=engine, autoflush=False)))
+    monkeypatch.setattr(database, 'DB_WRITER', None)
+    config_file = tmp_path / 'traceroute_history.conf'
+    config_file.write_text('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 0\n')
+    monkeypatch.setattr(runner, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(runner, 'LAST_TRACEROUTES', traceroute_cache.LastTracerouteCache())
+    return engine
+
+
+def test_database_outage(db_engine, tmp_path, monkeypatch):
+    spool_a = spool.Spool(str(tmp_path / 'test.spool'))
+    spool_a.open()
+    monkeypatch.setattr(runner, 'SPOOL', spool_a)
+    target = schemas.TargetCreate(name='target', address='10.0.0.9', groups=[schemas.GroupCreate(name='group')])
+    assert runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_A)) is False
+
+    def _unavailable(function, **kwargs):
+        raise sqlalchemy.exc.OperationalError('INSERT', {}, Exception('database is down'))
+
+    with monkeypatch.context() as outage:
+        outage.setattr(database, 'run_write', _unavailable)
+        for raw_traceroute in (TRACEROUTE_B, TRACEROUTE_A, TRACEROUTE_B):
+            assert runner.update_traceroute_database(
+                target, probe_engine.ProbeResult('10.0.0.9', 0, raw_traceroute)) is None
+    assert len(spool_a) == 3
+    # Results are spooled until the spool got replayed, even once the database is back
+    runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_A))
+    assert len(spool_a) == 4
+
+    assert runner.replay_spool(batch_size=3) == 4
+    assert len(spool_a) == 0
+    with database.db_session() as db:
+        traceroutes = crud.get_traceroutes_by_target(db=db, target_name='target')
+        # Stored in probe order, every one being a path change
+        assert [traceroute.raw_traceroute for traceroute in traceroutes] == \
+            [TRACEROUTE_A, TRACEROUTE_B, TRACEROUTE_A, TRACEROUTE_B, TRACEROUTE_A]
+        assert isinstance(traceroutes[0].creation_date, datetime.datetime)
+        assert traceroutes[0].creation_date > traceroutes[1].creation_date
+    assert runner.replay_spool() == 0
+    spool_a.close()
+
+
+def test_replay_failing_halfway(db_engine, tmp_path, monkeypatch):
+    spool_a = spool.Spool(str(tmp_path / 'test.spool'))
+    spool_a.open()
+    monkeypatch.setattr(runner, 'SPOOL', spool_a)
+    target = schemas.TargetCreate(name='target', address='10.0.0.9', groups=[])
+    # Probe results finish, thus get spooled, out of timestamp order
+    for timestamp, raw_traceroute in ((1650000003, TRACEROUTE_B), (1650000001, TRACEROUTE_A),
+                                      (1650000002, TRACEROUTE_B), (1650000004, TRACEROUTE_A)):
+        assert runner._spool_probe_result(target, probe_engine.ProbeResult('10.0.0.9', 0, raw_traceroute), timestamp)
+
+    run_write = runner.run_write
+    calls = []
+
+    def _fail_second_batch(function, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise sqlalchemy.exc.OperationalError('INSERT', {}, Exception('database is down'))
+        return run_write(function, **kwargs)
+
+    with monkeypatch.context() as outage:
+        outage.setattr(runner, 'run_write', _fail_second_batch)
+        assert runner.replay_spool(batch_size=2) == 2
+    assert len(spool_a) == 2
+    assert runner.replay_spool(batch_size=2) == 2
+    assert len(spool_a) == 0
+
+    with database.db_session() as db:
+        traceroutes = crud.get_traceroutes_by_target(db=db, target_name='target')
+        creation_dates = [traceroute.creation_date for traceroute in traceroutes]
+        # Unchanged path at 1650000003 is not stored, nothing is stored twice
+        assert len(creation_dates) == len(set(creation_dates)) == 3
+        assert [traceroute.raw_traceroute for traceroute in traceroutes] == [TRACEROUTE_A, TRACEROUTE_B, TRACEROUTE_A]
+    spool_a.close()
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.target_list"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052002"
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from traceroute_history import models, database, schemas, probe_engine, traceroute_cache
+from traceroute_history import traceroute_history_runner as runner
+
+TRACEROUTE_A = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.1.1 (10.0.1.1)  5.000 ms  5.100 ms  5.200 ms
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+TRACEROUTE_B = TRACEROUTE_A.replace('10.0.1.1', '10.0.2.1')
+
+
+@pytest.fixture
+def db_engine(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'), connect_args={'check_same_thread': False})
+    models.init_db(engine)
+    monkeypatch.setattr(database, 'SessionLocal', scoped_session(sessionmaker(bind=engine, autoflush=False)))
+    config_file = tmp_path / 'traceroute_history.conf'
+    config_file.write_text('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 0\n')
+    monkeypatch.setattr(runner, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(runner, 'LAST_TRACEROUTES', traceroute_cache.LastTracerouteCache())
+    return engine
+
+
+def test_list_targets_query_count(db_engine):
+    """
+    Dashboard query count must not grow with the number of targets
+    """
+    statements = []
+    event.listen(db_engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    def _add_targets(start, count):
+        for index in range(start, start + count):
+            target = schemas.TargetCreate(name='target{0}'.format(index), address='10.0.0.9',
+                                          groups=[schemas.GroupCreate(name='group{0}'.format(index % 2))])
+            runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_A))
+            runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_B))
+
+    query_counts = []
+    for start, count in ((0, 3), (3, 20)):
+        _add_targets(start, count)
+        for include_tr in (False, True):
+            statements.clear()
+            targets = runner.list_targets(include_tr=include_tr, formatting='none')
+            query_counts.append(len(statements))
+        assert len(targets) == start + count
+    assert query_counts[0] == query_counts[2] == 4
+    assert query_counts[1] == query_counts[3] == 6
+
+    target = targets[5]
+    assert target['groups'] == ['group1']
+    assert target['current_rtt'] == 9.2
+    assert target['previous_rtt'] == 9.2
+    assert '10.0.2.1' in target['current_tr']
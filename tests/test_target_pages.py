@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.target_pages"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052003"
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+from traceroute_history import models, database, schemas, probe_engine, traceroute_cache
+from traceroute_history import traceroute_history_runner as runner
+
+TRACEROUTE_A = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.1.1 (10.0.1.1)  5.000 ms  5.100 ms  5.200 ms
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+TRACEROUTE_B = TRACEROUTE_A.replace('10.0.1.1', '10.0.2.1')
+
+
+@pytest.fixture
+def db_engine(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'), connect_args={'check_same_thread': False})
+    models.init_db(engine)
+    monkeypatch.setattr(database, 'SessionLocal', scoped_session(sessionmaker(bind=engine, autoflush=False)))
+    config_file = tmp_path / 'traceroute_history.conf'
+    config_file.write_text('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 0\n')
+    monkeypatch.setattr(runner, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(runner, 'LAST_TRACEROUTES', traceroute_cache.LastTracerouteCache())
+    return engine
+
+
+def test_list_targets_page(db_engine):
+    slow = TRACEROUTE_B.replace('9.000 ms  9.100 ms  9.200 ms', '59.000 ms  59.100 ms  59.200 ms')
+    for index in range(7):
+        target = schemas.TargetCreate(name='target{0}'.format(index), address='10.0.0.{0}'.format(index),
+                                      groups=[schemas.GroupCreate(name='group{0}'.format(index % 2))])
+        runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_A))
+        if index % 3 == 0:
+            runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, slow))
+        elif index == 5:
+            runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 1, 'No route'))
+
+    names = []
+    cursor = None
+    while True:
+        page = runner.list_targets_page(limit=3, cursor=cursor, sort='name', descending=True)
+        names += [target['name'] for target in page['targets']]
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert names == ['target{0}'.format(index) for index in range(6, -1, -1)]
+    with pytest.raises(ValueError):
+        runner.list_targets_page(limit=3, cursor=runner.encode_page_cursor('name', True, 'target3', 4), sort='address')
+
+    page = runner.list_targets_page(sort='rtt_delta', descending=True, min_rtt_delta=10)
+    # Same delta, ties are sorted by id
+    assert [target['name'] for target in page['targets']] == ['target6', 'target3', 'target0']
+    assert round(page['targets'][0]['rtt_delta'], 3) == 50
+    page = runner.list_targets_page(status='down')
+    assert [target['name'] for target in page['targets']] == ['target5']
+    page = runner.list_targets_page(group='group1', status='up', search='10.0.0.')
+    assert [target['name'] for target in page['targets']] == ['target1', 'target3']
+
+    diff = runner.get_target_diff(page['targets'][1]['id'], formatting='web')
+    assert 'traceroute-green' in diff and '59.000 ms' in diff
+    assert runner.get_target_diff(999) is False
@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.traceroute_cache"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022051601"
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from traceroute_history import models, database, schemas, probe_engine, traceroute_cache, crud, paths, migrations
+from traceroute_history import traceroute_history_runner as runner
+
+TRACEROUTE_A = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.1.1 (10.0.1.1)  5.000 ms  5.100 ms  5.200 ms
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+TRACEROUTE_B = TRACEROUTE_A.replace('10.0.1.1', '10.0.2.1')
+
+
+@pytest.fixture
+def db_engine(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'), connect_args={'check_same_thread': False})
+    models.init_db(engine)
+    monkeypatch.setattr(database, 'SessionLocal', scoped_session(sessionmaker(bind=engine, autoflush=False)))
+    config_file = tmp_path / 'traceroute_history.conf'
+    config_file.write_text('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 0\n')
+    monkeypatch.setattr(runner, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(runner, 'LAST_TRACEROUTES', traceroute_cache.LastTracerouteCache())
+    return engine
+
+
+def test_steady_state_probes_do_not_read(db_engine):
+    target = schemas.TargetCreate(name='target', address='10.0.0.9')
+    assert runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_A)) is False
+
+    # Cache gets warmed with bulk queries for traceroutes, hops and probes
+    runner.LAST_TRACEROUTES.clear()
+    statements = []
+    event.listen(db_engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    runner.warm_last_traceroutes()
+    assert len(statements) == 3
+    assert runner.LAST_TRACEROUTES.get('target').traceroute_id == 1
+
+    statements.clear()
+    assert runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_A)) is False
+    assert runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_B)) is True
+    # Only reads left are the refresh of newly inserted traceroutes
+    assert not [statement for statement in statements if statement.lstrip().upper().startswith('SELECT')
+                and 'traceroute.id = ?' not in statement], "Steady state probes must not read the database"
+    assert runner.LAST_TRACEROUTES.get('target').traceroute_id == 2
+
+    # Failed probes are stored, next probe is stored as well since previous one is not parseable
+    assert runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 1, 'No route')) is None
+    assert runner.update_traceroute_database(target, probe_engine.ProbeResult('10.0.0.9', 0, TRACEROUTE_B)) is True
+    with database.db_scoped_session() as db:
+        assert db.query(models.Traceroute).count() == 4
+
+
+def test_normalized_hops(db_engine):
+    with database.db_scoped_session() as db:
+        target = crud.create_target(db=db, target=schemas.TargetCreate(name='target', address='10.0.0.9', groups=[]))
+        first = crud.create_target_traceroute(db=db, traceroute=schemas.TracerouteCreate(raw_traceroute=TRACEROUTE_A),
+                                              target_id=target.id)
+        crud.create_target_traceroute(db=db, traceroute=schemas.TracerouteCreate(raw_traceroute='No route'),
+                                      target_id=target.id)
+        second = crud.create_target_traceroute(db=db, traceroute=schemas.TracerouteCreate(
+            raw_traceroute=TRACEROUTE_B), target_id=target.id)
+
+        assert [hop.ttl for hop in first.hops] == [1, 2, 3]
+        assert [probe.rtt for probe in first.hops[1].probes] == [5.0, 5.1, 5.2]
+        assert crud.get_traceroute_rtt(db=db, traceroute_id=second.id) == 9.2
+        assert [traceroute.id for traceroute in crud.get_traceroutes_by_hop_ip(db=db, ip='10.0.0.1')] == \
+            [second.id, first.id]
+        assert [traceroute.id for traceroute in crud.get_traceroutes_by_hop_ip(db=db, ip='10.0.2.1')] == [second.id]
+        assert len(crud.get_hop_rtts(db=db, target_id=target.id, ttl=2)) == 6
+        assert paths.get_path_vector(first.to_trparse()) == (('10.0.0.1',), ('10.0.1.1',), ('10.0.0.9',))
+
+        assert first.path_hash == paths.get_path_hash(traceroute_cache.parse_traceroute(TRACEROUTE_A))
+        assert crud.count_distinct_paths(db=db, target_id=target.id) == 2
+        assert crud.get_path_last_seen(db=db, target_id=target.id, path_hash=first.path_hash) == first.creation_date
+        assert [path[0] for path in crud.get_distinct_paths(db=db, target_id=target.id)] == \
+            [second.path_hash, first.path_hash]
+
+        # Traceroutes stored without hops get them from the upgrade migration
+        crud.delete_traceroutes(db=db, traceroute_ids=[])
+        db.query(models.Probe).delete()
+        db.query(models.Hop).delete()
+        db.query(models.Traceroute).update({'path_hash': None})
+        db.commit()
+        with db_engine.begin() as connection:
+            migrations._backfill_traceroute_hops(connection, batch_size=1)
+        assert db.query(models.Hop).count() == 6
+        assert crud.count_distinct_paths(db=db, target_id=target.id) == 2
+        # Traceroutes having hops but no path hash only get the latter
+        db.query(models.Traceroute).update({'path_hash': None})
+        db.commit()
+        with db_engine.begin() as connection:
+            migrations._backfill_traceroute_hops(connection)
+        assert db.query(models.Hop).count() == 6
+        assert crud.count_distinct_paths(db=db, target_id=target.id) == 2
+
+        assert crud.delete_traceroutes(db=db, traceroute_ids=[first.id]) == 1
+        db.commit()
+        assert db.query(models.Hop).count() == 3
+        assert db.query(models.Probe).count() == 9
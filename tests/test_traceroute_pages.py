@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+#  -*- coding: utf-8 -*-
+#
+# This file is part of traceroute_history module
+
+"""
+Versioning semantics:
+    Major version: backward compatibility breaking changes
+    Minor version: New functionality
+    Patch version: Backwards compatible bug fixes
+"""
+
+__intname__ = "tests.traceroute_history.traceroute_pages"
+__author__ = "Orsiris de Jong"
+__copyright__ = "Copyright (C) 2022 Orsiris de Jong"
+__licence__ = "BSD 3 Clause"
+__build__ = "2022052201"
+
+import io
+import csv
+import json
+import datetime
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker, scoped_session
+from traceroute_history import models, database, schemas, traceroute_cache, crud
+from traceroute_history import traceroute_history_runner as runner
+
+TRACEROUTE_A = """traceroute to 10.0.0.9 (10.0.0.9), 30 hops max, 60 byte packets
+ 1  10.0.0.1 (10.0.0.1)  0.500 ms  0.400 ms  0.450 ms
+ 2  10.0.1.1 (10.0.1.1)  5.000 ms  5.100 ms  5.200 ms
+ 3  10.0.0.9 (10.0.0.9)  9.000 ms  9.100 ms  9.200 ms
+"""
+
+
+@pytest.fixture
+def db_engine(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///{0}'.format(tmp_path / 'test.db'), connect_args={'check_same_thread': False})
+    models.init_db(engine)
+    monkeypatch.setattr(database, 'SessionLocal', scoped_session(sessionmaker(bind=engine, autoflush=False)))
+    config_file = tmp_path / 'traceroute_history.conf'
+    config_file.write_text('[TRACEROUTE_HISTORY]\nrtt_detection_threshold = 0\n')
+    monkeypatch.setattr(runner, 'CONFIG_FILE', str(config_file))
+    monkeypatch.setattr(runner, 'LAST_TRACEROUTES', traceroute_cache.LastTracerouteCache())
+    return engine
+
+
+def test_traceroute_pages_and_stream(db_engine):
+    with database.db_scoped_session() as db:
+        target = crud.create_target(db=db, target=schemas.TargetCreate(name='target', address='10.0.0.9', groups=[]))
+        other = crud.create_target(db=db, target=schemas.TargetCreate(name='other', address='10.0.0.8', groups=[]))
+        for index in range(7):
+            crud.create_target_traceroute(db=db, traceroute=schemas.TracerouteCreate(
+                raw_traceroute=TRACEROUTE_A if index % 2 else 'No route "{0}"'.format(index)),
+                target_id=target.id if index != 3 else other.id)
+        # Dates set by python have microseconds, server side ones do not
+        db.add(models.Traceroute(raw_traceroute='Older', target_id=target.id,
+                                 creation_date=datetime.datetime(2020, 1, 1, 0, 0, 0, 500)))
+        db.commit()
+
+        ids = []
+        cursor = None
+        while True:
+            traceroutes, cursor = runner.get_traceroutes_page(db=db, target_id=target.id, limit=2, cursor=cursor)
+            ids += [traceroute.id for traceroute in traceroutes]
+            if not cursor:
+                break
+        assert ids == [7, 6, 5, 3, 2, 1, 8]
+        traceroutes, cursor = runner.get_traceroutes_page(db=db, limit=3, descending=False)
+        assert [traceroute.id for traceroute in traceroutes] == [8, 1, 2]
+        traceroutes, cursor = runner.get_traceroutes_page(db=db, limit=3, cursor=cursor, descending=False)
+        assert [traceroute.id for traceroute in traceroutes] == [3, 4, 5]
+
+    lines = ''.join(runner.stream_traceroutes('ndjson', target_id=1, batch_size=3)).splitlines()
+    rows = [json.loads(line) for line in lines]
+    assert [row['id'] for row in rows] == [7, 6, 5, 3, 2, 1, 8]
+    assert rows[1]['raw_traceroute'] == TRACEROUTE_A
+    rows = list(csv.reader(io.StringIO(''.join(runner.stream_traceroutes('csv', cursor=cursor, descending=False)))))
+    assert rows[0] == ['id', 'target_id', 'creation_date', 'raw_traceroute']
+    assert [row[0] for row in rows[1:]] == ['6', '7']
+    assert rows[2][3] == 'No route "6"'
+
+
+def test_traceroute_pages_same_second(db_engine):
+    with database.db_scoped_session() as db:
+        target = crud.create_target(db=db, target=schemas.TargetCreate(name='target', address='10.0.0.9', groups=[]))
+        creation_date = datetime.datetime(2022, 5, 1, 12, 0, 0)
+        for microsecond in (0, 0, 250000, 0, 999999):
+            db.add(models.Traceroute(raw_traceroute='No route', target_id=target.id,
+                                     creation_date=creation_date.replace(microsecond=microsecond)))
+        db.add(models.Traceroute(raw_traceroute='No route', target_id=target.id))
+        db.flush()
+        # Stored like server side CURRENT_TIMESTAMP dates
+        db.execute(text("UPDATE traceroute SET creation_date = '2022-05-01 12:00:00' WHERE id = 6"))
+        db.commit()
+
+        for descending, expected_ids in ((True, [5, 3, 6, 4, 2, 1]), (False, [1, 2, 4, 6, 3, 5])):
+            ids = []
+            cursor = None
+            while True:
+                traceroutes, cursor = runner.get_traceroutes_page(db=db, target_id=target.id, limit=1, cursor=cursor,
+                                                                  descending=descending)
+                ids += [traceroute.id for traceroute in traceroutes]
+                if not cursor:
+                    break
+            assert ids == expected_ids
+
+    with pytest.raises(ValueError):
+        runner.decode_traceroute_cursor(runner.encode_page_cursor('creation_date', True, 'yesterday', 1), True)
@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+compression encodes raw traceroute outputs for storage
+Every encoded payload starts with a codec byte, so codecs can be added later without migrating existing rows
+
+"""
+
+__intname__ = 'traceroute_history.compression'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022051801'
+
+import zlib
+
+CODEC_PLAIN = 0
+CODEC_ZLIB = 1
+DEFAULT_CODEC = CODEC_ZLIB
+
+# Preset dictionary holding the text that repeats across traceroute outputs (unix traceroute and windows tracert)
+# zlib favours the end of the dictionary, so most frequent strings come last
+# Never change it, payloads compressed with it could not be decoded anymore, add a new codec instead
+PRESET_DICTIONARY = (
+    b'Tracing route to  over a maximum of 30 hops\r\n\r\n  Trace complete.\r\n Request timed out.\r\n'
+    b'Unable to resolve target system name Destination host unreachable. Transmit error '
+    b'traceroute: unknown host Name or service not known Cannot handle "host" cmdline arg '
+    b'.net .com .org .fr .de .amazonaws.com .googleusercontent.com 1e100.net '
+    b'<1 ms  <1 ms  <1 ms    1 ms    2 ms  '
+    b'172.16. 192.168.0. 192.168.1. 10.0.0. 100.64. '
+    b'traceroute to  (), 30 hops max, 60 byte packets\n'
+    b' !H !N !P !X  * * *\n  *  *  *\n'
+    b' 1   2   3   4   5   6   7   8   9  10  11  12  13  14  15  16  17  18  19  20 '
+    b'.000 ms  .100 ms  .200 ms  .300 ms  .400 ms  .500 ms  .600 ms  .700 ms  .800 ms  .900 ms  '
+)
+
+
+def encode(text: str, codec: int = DEFAULT_CODEC):
+    """
+    :param text: (str) raw traceroute output
+    :param codec: (int) CODEC_PLAIN or CODEC_ZLIB
+    :return: (bytes) codec byte followed by the encoded text
+    """
+    data = text.encode('utf-8')
+    if codec == CODEC_ZLIB:
+        compressor = zlib.compressobj(level=9, zdict=PRESET_DICTIONARY)
+        data = compressor.compress(data) + compressor.flush()
+    elif codec != CODEC_PLAIN:
+        raise ValueError('Unknown codec {0}'.format(codec))
+    return bytes((codec,)) + data
+
+
+def decode(payload: bytes):
+    """
+    :param payload: (bytes) as returned by encode()
+    :return: (str) raw traceroute output
+    """
+    codec = payload[0]
+    data = payload[1:]
+    if codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj(zdict=PRESET_DICTIONARY)
+        data = decompressor.decompress(data) + decompressor.flush()
+    elif codec != CODEC_PLAIN:
+        raise ValueError('Unknown codec {0}'.format(codec))
+    return data.decode('utf-8')
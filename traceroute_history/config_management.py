@@ -6,6 +6,7 @@ traceroute_history is a quick tool to make traceroute / tracert calls, and store
 differs from last call.
 
 config_management handles all necessary connections to config files
+ConfigService keeps an immutable snapshot of the configuration in memory, and swaps in a new one when config files change
 
 """
 
@@ -17,6 +18,10 @@ __version__ = '0.5.0-dev'
 __build__ = '2022050601'
 
 import os
+import threading
+from time import monotonic
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional, Pattern, Tuple
 from logging import getLogger
 import re
 import configparser
@@ -24,10 +29,49 @@ from traceroute_history import exceptions
 
 logger = getLogger(__name__)
 
-# Don't add $ since we could have some comments afterwards
-COMMENT_REGEX = re.compile(r"\s*#")
-SMOKEPING_TARGET_REGEX = re.compile(r'.*host\s*=\s*(\S*)', re.IGNORECASE)
-SMOKEPING_TITLE_REGEX = re.compile(r'.*title\s*=\s*(.*)$', re.IGNORECASE)
+# Seconds between two config file modification checks
+DEFAULT_CONFIG_CHECK_INTERVAL = 10
+
+
+class TargetConfig(NamedTuple):
+    """
+    Target as declared in config, interval is None when the global interval applies
+    """
+    name: str
+    address: str
+    groups: Tuple[str, ...] = ()
+    interval: Optional[int] = None
+    priority: int = 0
+
+
+class TargetRegistry(NamedTuple):
+    """
+    Read only indexes of all targets, built in a single pass over config and smokeping sources
+    targets maps target names to TargetConfig in declaration order, groups maps group names to target names
+    """
+    targets: Mapping[str, TargetConfig]
+    groups: Mapping[str, Tuple[str, ...]]
+
+    def get_target(self, name):
+        return self.targets.get(name)
+
+    def get_groups(self, name):
+        target = self.targets.get(name)
+        return target.groups if target else None
+
+    def get_targets_by_group(self, group):
+        return tuple(self.targets[name] for name in self.groups.get(group, ()))
+
+
+class ConfigSnapshot(NamedTuple):
+    """
+    Immutable parsed configuration, mtimes are the (path, mtime) of every file it was read from
+    """
+    config_file: str
+    mtimes: Tuple[Tuple[str, Optional[float]], ...]
+    targets: Tuple[TargetConfig, ...]
+    registry: TargetRegistry
+    rtt_detection_threshold: int = 0
 
 
 def load_config(config_file):
@@ -66,107 +110,216 @@ def save_config(config_file, config):
         logger.critical('Cannot save configuration file. {}'.format(exc))
         return False
 
-def read_include_file(include_file):
+class SmokepingFilter(NamedTuple):
     """
-    Read smokeping include files
+    Hostname filter from a SMOKEPING_GROUP section, applying to hosts nested in group, or to all hosts if group is None
     """
+    group: Optional[str]
+    include_regex: Optional[Pattern]
+    exclude_regex: Optional[Pattern]
 
-    targets = []
-    target_names = []
+    def accepts(self, address, groups):
+        if self.group and self.group not in groups:
+            return True
+        if self.include_regex and not self.include_regex.match(address):
+            return False
+        if self.exclude_regex and self.exclude_regex.match(address):
+            return False
+        return True
 
-    with open(include_file, 'r', encoding="utf-8") as smokeping_include_config:
-        for line in smokeping_include_config:
-            target = re.match(SMOKEPING_TARGET_REGEX, line)
-            target_name = re.match(SMOKEPING_TITLE_REGEX, line)
-            if target:
-                targets.append(target)
-            if target_name:
-                target_names.append(target_name)
-    return targets, target_names
 
-def read_smokeping_config(config_file):
-    """
-    Read smokeping config file
+def _get_regex(section, key):
+    try:
+        # Values may be quoted in config file
+        regex = section[key].strip().strip('\'"')
+    except KeyError:
+        return None
+    return re.compile(regex) if regex else None
 
-    :param config_file: (str) path to config file
-    :return: (list)(dict) [{'target': x, 'title': y}]
-    """
 
-    if config_file == '':
-        return None
-    if not os.path.isfile(config_file):
-        logger.error('smokeping config "{0}" does not seem to be a file.'.format(config_file))
-        return None
+def get_smokeping_filters(config):
+    """
+    Reads include_hostname_regex / exclude_hostname_regex filters of SMOKEPING_GROUP* sections
 
-    targets = {}
-    target_names = {}
+    :return: (list)(SmokepingFilter)
+    """
+    filters = []
+    for section in config.sections():
+        if not section.startswith('SMOKEPING_GROUP'):
+            continue
+        try:
+            smokeping_filter = SmokepingFilter(group=config[section].get('smokeping_group', '').strip() or None,
+                                               include_regex=_get_regex(config[section], 'include_hostname_regex'),
+                                               exclude_regex=_get_regex(config[section], 'exclude_hostname_regex'))
+        except re.error as exc:
+            logger.error('Bogus hostname regex in section "{0}": {1}. Ignoring section.'.format(section, exc))
+            continue
+        if smokeping_filter.include_regex or smokeping_filter.exclude_regex:
+            filters.append(smokeping_filter)
+    return filters
 
-    targets_section = False
-    host_counter = 0
 
-    with open(config_file, 'r') as smokeping_config:
+def _tokenize_smokeping_file(path, targets_section_only):
+    """
+    Streams a smokeping config file into tokens: ('section', level, id), ('host', address), ('title', name) and
+    ('include', path)
+    Tokens do not depend on the including file, so they can be cached per file
+    """
+    tokens = []
+    targets_section = not targets_section_only
+    with open(path, 'r', encoding='utf-8', errors='replace') as smokeping_config:
         for line in smokeping_config:
             # Remove EOL
             line = line.rstrip()
 
-            # Walk file until we hit targets section
-            if line == "*** Targets ***":
-                targets_section = True
+            if targets_section_only:
+                # Walk file until we hit targets section
+                if line == "*** Targets ***":
+                    targets_section = True
+                    continue
+                if not targets_section:
+                    continue
+                # Stop reading file after another section is reached
+                if line.startswith("*** "):
+                    targets_section = False
+                    continue
+
+            if not line:
                 continue
-            if not targets_section:
+            if line.startswith('+'):
+                level = len(line) - len(line.lstrip('+'))
+                tokens.append(('section', level, line[level:].strip()))
                 continue
-            # Stop reading file after another section is reached
-            if line.startswith("*** "):
-                targets_section = False
+            if line.startswith('@include'):
+                tokens.append(('include', line[len('@include'):].strip()))
                 continue
+            key, separator, value = line.partition('=')
+            if not separator:
+                continue
+            key = key.strip().lower()
+            if key == 'host':
+                value = value.split()
+                tokens.append(('host', value[0] if value else ''))
+            elif key == 'title':
+                tokens.append(('title', value.strip()))
+    return tuple(tokens)
 
-            if line.startswith("@include"):
-                _, include_path = line.split("@include ")
-
-                # Try to resolve abs filename, if not, try local
-                if not os.path.isfile(include_path):
-                    include_path = os.path.join(os.path.dirname(config_file), os.path.basename(include_path))
 
-                with open(include_path, 'r') as include_file:
-                    iterator = include_file.readlines()
+class SmokepingReader(object):
+    """
+    Reads smokeping target hierarchies
+    Tokens of every file (main config and includes) are cached by (path, mtime, size), so rereading a tree only
+    reparses the files that changed
+    """
+    # Maximum @include nesting, protects against include loops
+    MAX_INCLUDE_DEPTH = 8
+
+    def __init__(self):
+        self._cache = {}
+        self._files = {}
+        self._lock = threading.Lock()
+        self.parsed_files = 0
+
+    def _get_tokens(self, path, targets_section_only):
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            cached = self._cache.get((path, targets_section_only))
+        if cached and cached[0] == key:
+            return cached[1], key[0]
+        tokens = _tokenize_smokeping_file(path, targets_section_only)
+        with self._lock:
+            self._cache[(path, targets_section_only)] = (key, tokens)
+            self.parsed_files += 1
+        return tokens, key[0]
+
+    def _walk(self, config_file, path, files, depth=0):
+        tokens, mtime = self._get_tokens(path, targets_section_only=depth == 0)
+        files[path] = mtime
+        for token in tokens:
+            if token[0] != 'include':
+                yield token
+                continue
+            include_path = token[1]
+            # Try to resolve abs filename, if not, try local
+            if not os.path.isfile(include_path):
+                include_path = os.path.join(os.path.dirname(config_file), os.path.basename(include_path))
+            if depth >= self.MAX_INCLUDE_DEPTH:
+                logger.error('Too many nested smokeping includes, ignoring "{0}".'.format(include_path))
+                continue
+            try:
+                yield from self._walk(config_file, include_path, files, depth + 1)
+            except OSError as exc:
+                logger.error('Cannot read smokeping include file "{0}": {1}.'.format(include_path, exc))
+
+    def get_files(self, config_file):
+        """
+        :return: (dict) path: mtime of all files the last read of config_file used
+        """
+        with self._lock:
+            return dict(self._files.get(config_file, {}))
+
+    def read(self, config_file, filters=None):
+        """
+        :param config_file: (str) path to smokeping config file
+        :param filters: (list)(SmokepingFilter) optional hostname filters
+        :return: (list)(dict) [{'address': x, 'name': y, 'groups': (z, ...)}]
+        """
+        files = {}
+        target_list = []
+        # Section path of current host, eg ['Local', 'Latency', 'PC1']
+        section_path = []
+        target = None
+
+        def _add_target(tgt):
+            if tgt is None or not tgt.get('address'):
+                return
+            if filters and not all(smokeping_filter.accepts(tgt['address'], tgt['groups'])
+                                   for smokeping_filter in filters):
+                return
+            target_list.append(tgt)
+
+        for token in self._walk(config_file, config_file, files):
+            if token[0] == 'section':
+                _add_target(target)
+                level = token[1]
+                section_path = section_path[:level - 1] + [token[2]]
+                target = {'groups': tuple('.'.join(section_path[:depth]) for depth in range(1, len(section_path)))}
+            elif target is None:
+                # Properties of the top level section
+                continue
+            elif token[0] == 'host':
+                target['address'] = token[1]
             else:
-                iterator = [line]
+                target['name'] = token[1]
+        _add_target(target)
 
-            for ln in iterator:
-                # Remove EOL (again, but may be from include file this time)
-                ln = ln.rstrip()
+        with self._lock:
+            self._files[config_file] = files
+        # Keep historical key order
+        return [dict(((key, tgt[key]) for key in ('address', 'name', 'groups') if key in tgt)) for tgt in target_list]
 
-                # Let's begin searching for hosts, we'll get
-                if ln.startswith("+"):
-                    host_counter += 1
 
-                if re.match(COMMENT_REGEX, ln):
-                    continue
-                target = re.match(SMOKEPING_TARGET_REGEX, ln)
-                target_name = re.match(SMOKEPING_TITLE_REGEX, ln)
+SMOKEPING_READER = SmokepingReader()
 
-                if target:
-                    targets[host_counter] = target.group(1)
-                if target_name:
-                    target_names[host_counter] = target_name.group(1)
 
+def read_smokeping_config(config_file, filters=None):
+    """
+    Read smokeping config file, with its @include files
 
-    # TODO Add regex for group inclusion / exclusion
+    :param config_file: (str) path to config file
+    :param filters: (list)(SmokepingFilter) optional hostname filters, see get_smokeping_filters
+    :return: (list)(dict) [{'address': x, 'name': y, 'groups': (z, ...)}], groups being the dotted paths of the
+             sections ('+', '++', ...) the host is nested in
+    """
 
-    # Merge targets and names into list when target host exists
-    target_list = []
-    for count in range(1, host_counter + 1):
-        try:
-            tgt = {'address': targets[count]}
-        except KeyError:
-            continue
-        try:
-            tgt['name'] = target_names[count]
-        except KeyError:
-            pass
-        target_list.append(tgt)
+    if not config_file:
+        return None
+    if not os.path.isfile(config_file):
+        logger.error('smokeping config "{0}" does not seem to be a file.'.format(config_file))
+        return None
 
-    return target_list
+    return SMOKEPING_READER.read(config_file, filters=filters)
 
 
 def get_targets_from_config(config):
@@ -174,7 +327,7 @@ def get_targets_from_config(config):
     for section in config.sections():
         if section.startswith("TARGET:"):
             target = {}
-            target['name'] = section.lstrip("TARGET:")
+            target['name'] = section[len("TARGET:"):]
             target['address'] = config[section]['address']
             targets.append(target)
     #targets = [section.lstrip('TARGET:') for section in config.sections() if section.startswith('TARGET:')]
@@ -182,21 +335,52 @@ def get_targets_from_config(config):
         smokeping_config = config['SMOKEPING_SOURCE']['smokeping_config_path']
     except KeyError:
         smokeping_config = None
-    smokeping_targets = read_smokeping_config(smokeping_config)
+    smokeping_targets = read_smokeping_config(smokeping_config, filters=get_smokeping_filters(config))
     if smokeping_targets:
         targets = targets + smokeping_targets
     return targets
 
 
 def get_groups_from_config(config, target_name):
-    targets = get_targets_from_config(config)
-    for target in targets:
+    """
+    Groups declared in the TARGET section of target_name
+    Use build_target_registry when groups of many targets are needed, it also knows about smokeping groups
+    """
+    try:
+        return [group.strip() for group in config['TARGET:' + target_name]['groups'].split(',')]
+    except KeyError:
+        return None
+
+
+def build_target_registry(config):
+    """
+    Reads config file targets and smokeping targets once, and indexes them by name and by group
+    Smokeping targets get the groups of their section hierarchy
+    When a name is declared more than once, the first declaration wins, so TARGET sections override smokeping hosts
+
+    :return: (TargetRegistry)
+    """
+    targets = {}
+    groups = {}
+    for target in get_targets_from_config(config):
+        # Smokeping hosts without title are named after their address
+        target.setdefault('name', target['address'])
         try:
-            if target['name'] == target_name:
-                return [group.strip() for group in config['TARGET:' + target['name']]['groups'].split(',')]
-        except KeyError:
-            pass
-    return None
+            target_config = get_target_config(config, target)
+        except KeyError as exc:
+            logger.error('Failed to read configuration for target "{0}": {1}.'.format(target.get('name'), exc))
+            continue
+        if target_config.name in targets:
+            logger.debug('Target "{0}" declared more than once, using first declaration.'.format(target_config.name))
+            continue
+        smokeping_groups = tuple(group for group in target.get('groups', ()) if group not in target_config.groups)
+        if smokeping_groups:
+            target_config = target_config._replace(groups=target_config.groups + smokeping_groups)
+        targets[target_config.name] = target_config
+        for group in target_config.groups:
+            groups.setdefault(group, []).append(target_config.name)
+    return TargetRegistry(targets=MappingProxyType(targets),
+                          groups=MappingProxyType({group: tuple(names) for group, names in groups.items()}))
 
 
 def get_groups_for_target(target_name, regex):
@@ -209,3 +393,147 @@ def remove_target_from_config(config, name):
         config.remove_section('TARGET:' + name)
     except KeyError:
         pass
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, TypeError):
+        return None
+
+
+def get_config_mtimes(config_file, config):
+    """
+    :return: (tuple) (path, mtime) of config file and smokeping config file if any
+    """
+    paths = [config_file]
+    try:
+        smokeping_config = config['SMOKEPING_SOURCE']['smokeping_config_path']
+        if smokeping_config:
+            paths.append(smokeping_config)
+    except KeyError:
+        pass
+    return tuple((path, _get_mtime(path)) for path in paths)
+
+
+def get_target_config(config, target):
+    """
+    Builds a TargetConfig from a target dict (as returned by get_targets_from_config) and its optional TARGET: section
+    """
+    name = str(target['name'])
+    try:
+        section = config['TARGET:' + name]
+    except KeyError:
+        section = {}
+    try:
+        groups = tuple(group.strip() for group in section['groups'].split(',') if group.strip())
+    except KeyError:
+        groups = ()
+    try:
+        interval = int(section['interval'])
+    except KeyError:
+        interval = None
+    except (TypeError, ValueError):
+        logger.error('Bogus interval value for target "{0}". Using global interval.'.format(name))
+        interval = None
+    try:
+        priority = int(section['priority'])
+    except KeyError:
+        priority = 0
+    except (TypeError, ValueError):
+        logger.error('Bogus priority value for target "{0}". Using default.'.format(name))
+        priority = 0
+    return TargetConfig(name=name, address=target['address'], groups=groups, interval=interval, priority=priority)
+
+
+def build_config_snapshot(config_file):
+    """
+    Parses config file and smokeping sources into a ConfigSnapshot
+
+    :return: (ConfigSnapshot)
+    """
+    config = load_config(config_file)
+    # Read mtimes before files, so changes happening while parsing are caught on next check
+    mtimes = get_config_mtimes(config_file, config)
+
+    registry = build_target_registry(config)
+    # Smokeping include files are only known once parsed, they keep the mtimes read before parsing them
+    try:
+        smokeping_config = config['SMOKEPING_SOURCE']['smokeping_config_path']
+    except KeyError:
+        smokeping_config = None
+    if smokeping_config:
+        known_paths = [path for path, _ in mtimes]
+        mtimes += tuple((path, mtime) for path, mtime in SMOKEPING_READER.get_files(smokeping_config).items()
+                        if path not in known_paths)
+
+    try:
+        rtt_detection_threshold = int(config['TRACEROUTE_HISTORY']['rtt_detection_threshold'])
+    except KeyError:
+        rtt_detection_threshold = 0
+    except (TypeError, ValueError):
+        logger.warning('Bogus rtt_detection_threshold value.')
+        rtt_detection_threshold = 0
+
+    return ConfigSnapshot(config_file=config_file, mtimes=mtimes, targets=tuple(registry.targets.values()),
+                          registry=registry, rtt_detection_threshold=rtt_detection_threshold)
+
+
+class ConfigService(object):
+    """
+    Holds the current ConfigSnapshot
+    Config files are parsed once, then only their mtimes are checked, at most every check_interval seconds
+    When a file changed, a new snapshot is built and swapped in atomically, listeners get called with (old, new)
+    A config that cannot be parsed anymore is logged and the previous snapshot is kept
+    """
+    def __init__(self, config_file, check_interval: float = DEFAULT_CONFIG_CHECK_INTERVAL):
+        self.config_file = config_file
+        self.check_interval = check_interval
+        self._snapshot = build_config_snapshot(config_file)
+        self._last_check = monotonic()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def get(self):
+        """
+        Returns current snapshot, reloading it first if the check interval elapsed and files changed
+        """
+        if monotonic() - self._last_check >= self.check_interval:
+            self.reload()
+        return self._snapshot
+
+    def add_listener(self, listener):
+        """
+        :param listener: (callable) called with (old ConfigSnapshot, new ConfigSnapshot) after each reload
+        """
+        self._listeners.append(listener)
+
+    def is_stale(self):
+        return any(_get_mtime(path) != mtime for path, mtime in self._snapshot.mtimes)
+
+    def reload(self, force: bool = False):
+        """
+        :return: (ConfigSnapshot) new snapshot, or None if nothing changed
+        """
+        with self._lock:
+            self._last_check = monotonic()
+            if not force and not self.is_stale():
+                return None
+            try:
+                snapshot = build_config_snapshot(self.config_file)
+            except (exceptions.ConfigFileNotFound, exceptions.ConfigFileNotParseable, configparser.Error, OSError) as exc:
+                logger.error('Cannot reload configuration, keeping previous one: {0}'.format(exc))
+                return None
+            previous_snapshot = self._snapshot
+            self._snapshot = snapshot
+        logger.info('Configuration reloaded, {0} targets.'.format(len(snapshot.targets)))
+        for listener in self._listeners:
+            try:
+                listener(previous_snapshot, snapshot)
+            except Exception:
+                logger.error('Configuration reload listener failed.', exc_info=True)
+        return snapshot
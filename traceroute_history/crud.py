@@ -17,8 +17,55 @@ __version__ = '0.4.1'
 __build__ = '2020092202'
 
 
-from sqlalchemy.orm import Session
-from traceroute_history import schemas, models
+from datetime import datetime
+from sqlalchemy import func, case, and_, or_
+from sqlalchemy.orm import Session, Query, selectinload
+from traceroute_history import schemas, models, trparse, paths, compression
+
+# Callables notified with (target_id, traceroute_id) of every stored traceroute, see add_traceroute_listener
+_traceroute_listeners = []
+
+
+def add_traceroute_listener(listener):
+    """
+    Registers a callable run after every create_target_traceroute commit, in the writing thread
+    """
+    if listener not in _traceroute_listeners:
+        _traceroute_listeners.append(listener)
+
+
+def remove_traceroute_listener(listener):
+    if listener in _traceroute_listeners:
+        _traceroute_listeners.remove(listener)
+
+
+def _notify_traceroute_listeners(target_id: int, traceroute_id: int):
+    for listener in _traceroute_listeners:
+        listener(target_id, traceroute_id)
+
+
+def _commit(db: Session, commit: bool):
+    """
+    Commits, or only flushes so ids are known, when the caller commits a whole batch later, see commit()
+    """
+    if commit:
+        db.commit()
+    else:
+        db.flush()
+
+
+def commit(db: Session):
+    """
+    Commits a batch of operations made with commit=False, then notifies listeners of the traceroutes it stored
+    """
+    db.commit()
+    for target_id, traceroute_id in db.info.pop('pending_traceroutes', []):
+        _notify_traceroute_listeners(target_id, traceroute_id)
+
+
+def rollback(db: Session):
+    db.rollback()
+    db.info.pop('pending_traceroutes', None)
 
 
 def get_target(db: Session, id: int = None, name: str = None):
@@ -32,20 +79,35 @@ def get_targets(db: Session, skip: int = 0, limit: int = None):
     return db.query(models.Target).offset(skip).limit(limit).all()
 
 
-def create_target(db: Session, target: schemas.TargetCreate):
+def get_targets_with_groups(db: Session):
+    """
+    :return: (list)(Target) all targets, groups loaded with a single extra query
+    """
+    return db.query(models.Target).options(selectinload(models.Target.groups)).order_by(models.Target.id).all()
+
+
+def create_target(db: Session, target: schemas.TargetCreate, commit: bool = True):
     # Make IPv4 or IPv6 a string so SQLAlchemy is happy only being able to store a string
     target.address = str(target.address)
 
     db_target = models.Target(name=target.name, address=target.address, groups=target.groups)
     db.add(db_target)
-    db.commit()
+    _commit(db, commit)
     db.refresh(db_target)
     return db_target
 
 
+def update_target_probe_interval(db: Session, name: str, probe_interval: int, commit: bool = True):
+    db.query(models.Target).filter(models.Target.name == name).update({'probe_interval': probe_interval})
+    _commit(db, commit)
+
+
 def delete_target(db: Session, id: int = None, name: str = None):
     target = get_target(db, id, name)
     if target:
+        # Rtt series and rollups have no relationship on Target, so they are not loaded just to be deleted
+        for model in (models.RttSeries, models.RttRollup, models.RttRollupDirty):
+            db.query(model).filter(model.target_id == target.id).delete(synchronize_session=False)
         db.delete(target)
         return db.commit()
     return False
@@ -66,10 +128,10 @@ def get_groups_by_target(db: Session, target_id: int = None, target_name: str =
     return db.query(models.Group).filter(models.Group.targets.any(id=target_id)).all()
 
 
-def create_group(db: Session, group: schemas.GroupCreate):
+def create_group(db: Session, group: schemas.GroupCreate, commit: bool = True):
     db_group = models.Group(name=group.name)
     db.add(db_group)
-    db.commit()
+    _commit(db, commit)
     db.refresh(db_group)
     return db_group
 
@@ -94,15 +156,471 @@ def get_traceroutes_by_target(db: Session, target_id: int = None, target_name: s
         return None
 
 
+def get_last_traceroute_per_target(db: Session):
+    """
+    :return: (list)(Target, Traceroute) every target with its last traceroute (None if it has none), hops included
+    """
+    last_ids = db.query(models.Traceroute.target_id, func.max(models.Traceroute.id).label('last_id')).group_by(
+        models.Traceroute.target_id).subquery()
+    return db.query(models.Target, models.Traceroute).outerjoin(
+        last_ids, last_ids.c.target_id == models.Target.id).outerjoin(
+        models.Traceroute, models.Traceroute.id == last_ids.c.last_id).options(
+        selectinload(models.Traceroute.hops).selectinload(models.Hop.probes)).all()
+
+
+def _get_ranked_traceroutes(db: Session):
+    """
+    :return: (Subquery) traceroute_id, target_id, rank where rank 1 is the last traceroute of a target
+    """
+    return db.query(models.Traceroute.id.label('traceroute_id'), models.Traceroute.target_id.label('target_id'),
+                    func.row_number().over(partition_by=models.Traceroute.target_id,
+                                           order_by=models.Traceroute.id.desc()).label('rank')).subquery()
+
+
+def get_last_traceroutes_per_target(db: Session, limit: int = 2, with_hops: bool = False):
+    """
+    Fetches the last traceroutes of all targets in a single query
+
+    :param limit: (int) number of traceroutes per target
+    :param with_hops: (bool) also load hops and probes, with two extra queries
+    :return: (list)(Traceroute) traceroutes ordered by target, newest first
+    """
+    ranked = _get_ranked_traceroutes(db)
+    query = db.query(models.Traceroute).join(ranked, ranked.c.traceroute_id == models.Traceroute.id).filter(
+        ranked.c.rank <= limit)
+    if with_hops:
+        query = query.options(selectinload(models.Traceroute.hops).selectinload(models.Hop.probes))
+    return query.order_by(models.Traceroute.target_id, models.Traceroute.id.desc()).all()
+
+
+def _get_last_probes(db: Session, ranked, limit: int):
+    """
+    :return: (Subquery) traceroute_id, rtt, rank where rank 1 is the last probe of the last hop of a traceroute
+    """
+    return db.query(models.Hop.traceroute_id.label('traceroute_id'), models.Probe.rtt.label('rtt'),
+                    func.row_number().over(partition_by=models.Hop.traceroute_id,
+                                           order_by=(models.Hop.ttl.desc(), models.Probe.id.desc())).label(
+                        'rank')).join(models.Probe, models.Probe.hop_id == models.Hop.id).join(
+        ranked, ranked.c.traceroute_id == models.Hop.traceroute_id).filter(ranked.c.rank <= limit).subquery()
+
+
+def get_last_traceroute_rtts(db: Session, limit: int = 2):
+    """
+    Bulk version of get_traceroute_rtt for the last traceroutes of all targets, in a single query
+
+    :return: (dict) traceroute_id: rtt of the last probe of the last hop
+    """
+    last_probes = _get_last_probes(db, _get_ranked_traceroutes(db), limit)
+    return dict(db.query(last_probes.c.traceroute_id, last_probes.c.rtt).filter(last_probes.c.rank == 1).all())
+
+
+# Sortable columns of get_target_page, null values are sorted as the given sentinel so they can be used as keyset
+TARGET_PAGE_SORTS = ('name', 'address', 'last_probe', 'current_rtt', 'rtt_delta')
+NULL_SORT_VALUES = {'address': '', 'last_probe': 0, 'current_rtt': -1.0, 'rtt_delta': -1e9}
+TARGET_STATUSES = ('up', 'down')
+
+
+def get_target_page(db: Session, limit: int = 50, after=None, sort: str = 'name', descending: bool = False,
+                    group: str = None, status: str = None, search: str = None, min_rtt_delta: float = None):
+    """
+    Keyset paginated dashboard rows, in a single query (plus one for groups)
+    Targets are up when the last probe of their last traceroute answered
+
+    :param after: (tuple) (sort value, target id) of the last row of previous page
+    :param sort: (str) one of TARGET_PAGE_SORTS, last_probe sorts by last traceroute id
+    :param search: (str) optional part of name or address
+    :param min_rtt_delta: (float) optional minimal rtt increase between previous and last traceroute
+    :return: (list)(Row) Target, last_traceroute_id, last_probe, current_rtt, previous_rtt, rtt_delta, sort_value
+    """
+    if sort not in TARGET_PAGE_SORTS:
+        raise ValueError('Unknown sort column "{0}".'.format(sort))
+    ranked = _get_ranked_traceroutes(db)
+    last_probes = _get_last_probes(db, ranked, 2)
+    per_target = db.query(
+        ranked.c.target_id.label('target_id'),
+        func.max(case((ranked.c.rank == 1, ranked.c.traceroute_id))).label('last_traceroute_id'),
+        func.max(case((ranked.c.rank == 1, last_probes.c.rtt))).label('current_rtt'),
+        func.max(case((ranked.c.rank == 2, last_probes.c.rtt))).label('previous_rtt')).outerjoin(
+        last_probes, and_(last_probes.c.traceroute_id == ranked.c.traceroute_id, last_probes.c.rank == 1)).filter(
+        ranked.c.rank <= 2).group_by(ranked.c.target_id).subquery()
+
+    rtt_delta = per_target.c.current_rtt - per_target.c.previous_rtt
+    sort_columns = {
+        'name': models.Target.name,
+        'address': models.Target.address,
+        'last_probe': per_target.c.last_traceroute_id,
+        'current_rtt': per_target.c.current_rtt,
+        'rtt_delta': rtt_delta
+    }
+    sort_column = sort_columns[sort]
+    if sort in NULL_SORT_VALUES:
+        sort_column = func.coalesce(sort_column, NULL_SORT_VALUES[sort])
+
+    query = db.query(models.Target, per_target.c.last_traceroute_id, models.Traceroute.creation_date.label('last_probe'),
+                     per_target.c.current_rtt, per_target.c.previous_rtt, rtt_delta.label('rtt_delta'),
+                     sort_column.label('sort_value')).outerjoin(
+        per_target, per_target.c.target_id == models.Target.id).outerjoin(
+        models.Traceroute, models.Traceroute.id == per_target.c.last_traceroute_id).options(
+        selectinload(models.Target.groups))
+
+    if group:
+        query = query.filter(models.Target.groups.any(name=group))
+    if status == 'up':
+        query = query.filter(per_target.c.current_rtt.isnot(None))
+    elif status == 'down':
+        query = query.filter(per_target.c.current_rtt.is_(None))
+    if search:
+        pattern = '%{0}%'.format(search)
+        query = query.filter(or_(models.Target.name.like(pattern), models.Target.address.like(pattern)))
+    if min_rtt_delta is not None:
+        query = query.filter(rtt_delta >= min_rtt_delta)
+    if after:
+        value, target_id = after
+        if descending:
+            query = query.filter(or_(sort_column < value, and_(sort_column == value, models.Target.id < target_id)))
+        else:
+            query = query.filter(or_(sort_column > value, and_(sort_column == value, models.Target.id > target_id)))
+    if descending:
+        query = query.order_by(sort_column.desc(), models.Target.id.desc())
+    else:
+        query = query.order_by(sort_column, models.Target.id)
+    return query.limit(limit).all()
+
+
+def get_traceroute_version(db: Session):
+    """
+    :return: (int) highest traceroute id, changes whenever any process stores a traceroute
+    """
+    return db.query(func.max(models.Traceroute.id)).scalar()
+
+
+def get_latest_traceroute_id(db: Session, target_id: int):
+    return db.query(func.max(models.Traceroute.id)).filter(models.Traceroute.target_id == target_id).scalar()
+
+
+def get_traceroute_rtt(db: Session, traceroute_id: int):
+    """
+    :return: (float) rtt of the last probe of the last hop, None if it did not answer or traceroute has no hops
+    """
+    return db.query(models.Probe.rtt).join(models.Hop, models.Probe.hop_id == models.Hop.id).filter(
+        models.Hop.traceroute_id == traceroute_id).order_by(models.Hop.ttl.desc(), models.Probe.id.desc()).limit(
+        1).scalar()
+
+
+def get_hop_rtts(db: Session, target_id: int, ttl: int = None, skip: int = 0, limit: int = None):
+    """
+    :return: (list)(creation_date, ttl, ip, rtt) probe rtts of a target, newest traceroutes first
+    """
+    query = db.query(models.Traceroute.creation_date, models.Hop.ttl, models.Probe.ip, models.Probe.rtt).join(
+        models.Hop, models.Hop.traceroute_id == models.Traceroute.id).join(
+        models.Probe, models.Probe.hop_id == models.Hop.id).filter(models.Traceroute.target_id == target_id)
+    if ttl is not None:
+        query = query.filter(models.Hop.ttl == ttl)
+    return query.order_by(models.Traceroute.id.desc(), models.Hop.ttl, models.Probe.id).offset(skip).limit(
+        limit).all()
+
+
+def get_traceroutes_by_hop_ip(db: Session, ip: str, target_id: int = None, skip: int = 0, limit: int = None):
+    """
+    :return: (list)(Traceroute) traceroutes that went through ip, newest first
+    """
+    query = db.query(models.Traceroute).join(models.Hop, models.Hop.traceroute_id == models.Traceroute.id).join(
+        models.Probe, models.Probe.hop_id == models.Hop.id).filter(models.Probe.ip == ip)
+    if target_id is not None:
+        query = query.filter(models.Traceroute.target_id == target_id)
+    return query.distinct().order_by(models.Traceroute.id.desc()).offset(skip).limit(limit).all()
+
+
+def compress_raw_traceroutes(db: Session, batch_size: int = 500):
+    """
+    Moves plain text raw traceroutes of previous versions to compressed storage
+
+    :return: (int) number of compressed traceroutes
+    """
+    count = 0
+    last_id = 0
+    while True:
+        traceroutes = db.query(models.Traceroute).filter(
+            models.Traceroute.raw_data.is_(None), models.Traceroute.id > last_id).order_by(
+            models.Traceroute.id).limit(batch_size).all()
+        if not traceroutes:
+            return count
+        for traceroute in traceroutes:
+            traceroute.raw_traceroute = traceroute.legacy_raw_traceroute
+            count += 1
+        last_id = traceroutes[-1].id
+        db.commit()
+
+
+def get_path_last_seen(db: Session, target_id: int, path_hash: str):
+    """
+    :return: (datetime) creation date of the last traceroute of target that took the path, None if never seen
+    """
+    return db.query(func.max(models.Traceroute.creation_date)).filter(
+        models.Traceroute.target_id == target_id, models.Traceroute.path_hash == path_hash).scalar()
+
+
+def count_distinct_paths(db: Session, target_id: int):
+    return db.query(func.count(models.Traceroute.path_hash.distinct())).filter(
+        models.Traceroute.target_id == target_id).scalar()
+
+
+def get_distinct_paths(db: Session, target_id: int):
+    """
+    :return: (list)(path_hash, first_seen, last_seen, count) paths a target used, most recently seen first
+    """
+    return db.query(models.Traceroute.path_hash, func.min(models.Traceroute.creation_date),
+                    func.max(models.Traceroute.creation_date), func.count(models.Traceroute.id)).filter(
+        models.Traceroute.target_id == target_id, models.Traceroute.path_hash.isnot(None)).group_by(
+        models.Traceroute.path_hash).order_by(func.max(models.Traceroute.id).desc()).all()
+
+
+def append_rtt_series(db: Session, target_id: int, bucket_start: int, data: bytes, sample_count: int):
+    """
+    Appends packed rtt samples to the series of a target, does not commit
+    """
+    series = db.query(models.RttSeries).filter(models.RttSeries.target_id == target_id,
+                                               models.RttSeries.bucket_start == bucket_start).first()
+    if series:
+        series.data = series.data + data
+        series.sample_count += sample_count
+    else:
+        db.add(models.RttSeries(target_id=target_id, bucket_start=bucket_start, data=data, sample_count=sample_count))
+    # Next appends to the same bucket within this transaction need to find this one
+    db.flush()
+
+
+def get_rtt_series(db: Session, target_id: int, start: int = None, end: int = None):
+    """
+    :return: (list)(RttSeries) hourly series of a target, ordered by time
+    """
+    query = db.query(models.RttSeries).filter(models.RttSeries.target_id == target_id)
+    if start is not None:
+        query = query.filter(models.RttSeries.bucket_start >= start)
+    if end is not None:
+        query = query.filter(models.RttSeries.bucket_start < end)
+    return query.order_by(models.RttSeries.bucket_start).all()
+
+
+def get_rtt_series_target_ids(db: Session):
+    """
+    :return: (dict) target_id: first bucket_start of every target having rtt series
+    """
+    return dict(db.query(models.RttSeries.target_id, func.min(models.RttSeries.bucket_start)).group_by(
+        models.RttSeries.target_id).all())
+
+
+def delete_rtt_series(db: Session, before: int):
+    """
+    Deletes rtt series of buckets starting before given timestamp, does not commit
+    """
+    return db.query(models.RttSeries).filter(models.RttSeries.bucket_start < before).delete(synchronize_session=False)
+
+
+def get_last_rtt_rollups(db: Session, resolution: int):
+    """
+    :return: (dict) target_id: last rolled up bucket_start of given resolution
+    """
+    return dict(db.query(models.RttRollup.target_id, func.max(models.RttRollup.bucket_start)).filter(
+        models.RttRollup.resolution == resolution).group_by(models.RttRollup.target_id).all())
+
+
+def replace_rtt_rollups(db: Session, target_id: int, resolution: int, start: int, end: int, rollups):
+    """
+    Replaces rollups of a target between start and end, so rolling up a period twice is harmless, does not commit
+    """
+    db.query(models.RttRollup).filter(models.RttRollup.target_id == target_id,
+                                      models.RttRollup.resolution == resolution,
+                                      models.RttRollup.bucket_start >= start,
+                                      models.RttRollup.bucket_start < end).delete(synchronize_session=False)
+    db.add_all(rollups)
+
+
+def mark_rtt_rollups_dirty(db: Session, target_id: int, resolution: int, earliest: int):
+    """
+    Records that rollups of a target from earliest on must be computed again, does not commit
+    """
+    dirty = db.query(models.RttRollupDirty).filter(models.RttRollupDirty.target_id == target_id,
+                                                   models.RttRollupDirty.resolution == resolution).first()
+    if dirty:
+        dirty.earliest = min(dirty.earliest, earliest)
+    else:
+        db.add(models.RttRollupDirty(target_id=target_id, resolution=resolution, earliest=earliest))
+    db.flush()
+
+
+def get_dirty_rtt_rollups(db: Session, resolution: int):
+    """
+    :return: (dict) target_id: earliest timestamp to roll up again at given resolution
+    """
+    return dict(db.query(models.RttRollupDirty.target_id, models.RttRollupDirty.earliest).filter(
+        models.RttRollupDirty.resolution == resolution).all())
+
+
+def clear_dirty_rtt_rollups(db: Session, resolution: int, dirty_rollups: dict):
+    """
+    Forgets dirty rollups once computed again, unless marked dirty from an earlier timestamp since, does not commit
+    """
+    for target_id, earliest in dirty_rollups.items():
+        db.query(models.RttRollupDirty).filter(models.RttRollupDirty.target_id == target_id,
+                                               models.RttRollupDirty.resolution == resolution,
+                                               models.RttRollupDirty.earliest >= earliest).delete(
+            synchronize_session=False)
+
+
+def get_rtt_rollups(db: Session, target_id: int, resolution: int, start: int = None, end: int = None,
+                    ttl: int = None):
+    """
+    :return: (list)(RttRollup) rollups of a target, ordered by time then ttl
+    """
+    query = db.query(models.RttRollup).filter(models.RttRollup.target_id == target_id,
+                                              models.RttRollup.resolution == resolution)
+    if start is not None:
+        query = query.filter(models.RttRollup.bucket_start >= start)
+    if end is not None:
+        query = query.filter(models.RttRollup.bucket_start < end)
+    if ttl is not None:
+        query = query.filter(models.RttRollup.ttl == ttl)
+    return query.order_by(models.RttRollup.bucket_start, models.RttRollup.ttl).all()
+
+
+def delete_rtt_rollups(db: Session, resolution: int, before: int):
+    """
+    Deletes rollups of given resolution starting before given timestamp, does not commit
+    """
+    return db.query(models.RttRollup).filter(models.RttRollup.resolution == resolution,
+                                             models.RttRollup.bucket_start < before).delete(synchronize_session=False)
+
+
+def delete_traceroutes(db: Session, traceroute_ids):
+    """
+    Bulk deletes traceroutes with their hops and probes
+    """
+    traceroute_ids = list(traceroute_ids)
+    if not traceroute_ids:
+        return 0
+    hop_ids = db.query(models.Hop.id).filter(models.Hop.traceroute_id.in_(traceroute_ids))
+    db.query(models.Probe).filter(models.Probe.hop_id.in_(hop_ids.scalar_subquery())).delete(synchronize_session=False)
+    db.query(models.Hop).filter(models.Hop.traceroute_id.in_(traceroute_ids)).delete(synchronize_session=False)
+    return db.query(models.Traceroute).filter(models.Traceroute.id.in_(traceroute_ids)).delete(
+        synchronize_session='fetch')
+
+
 def get_traceroutes(db: Session, skip: int = 0, limit: int = None):
     return db.query(models.Traceroute).offset(skip).limit(limit).all()
 
 
-def create_target_traceroute(db: Session, traceroute: schemas.TracerouteCreate, target_id: int):
+def _filter_traceroute_keyset(query, target_id: int = None, after=None, descending: bool = True):
+    """
+    :param after: (tuple) (creation_date as datetime, id) of the last traceroute already read
+    """
+    if target_id is not None:
+        query = query.filter(models.Traceroute.target_id == target_id)
+    if after:
+        creation_date, traceroute_id = after
+        if descending:
+            query = query.filter(or_(models.Traceroute.creation_date < creation_date,
+                                     and_(models.Traceroute.creation_date == creation_date,
+                                          models.Traceroute.id < traceroute_id)))
+        else:
+            query = query.filter(or_(models.Traceroute.creation_date > creation_date,
+                                     and_(models.Traceroute.creation_date == creation_date,
+                                          models.Traceroute.id > traceroute_id)))
+    if descending:
+        return query.order_by(models.Traceroute.creation_date.desc(), models.Traceroute.id.desc())
+    return query.order_by(models.Traceroute.creation_date, models.Traceroute.id)
+
+
+def get_traceroute_page(db: Session, target_id: int = None, limit: int = 100, after=None, descending: bool = True):
+    """
+    Keyset paginated traceroutes on (creation_date, id), cost does not depend on the page number
+
+    :return: (list)(Traceroute)
+    """
+    return _filter_traceroute_keyset(db.query(models.Traceroute), target_id=target_id, after=after,
+                                     descending=descending).limit(limit).all()
+
+
+def get_traceroute_rows_statement(target_id: int = None, after=None, descending: bool = True):
+    """
+    Statement selecting traceroutes as plain rows, for sync and async sessions, see decode_traceroute_row
+    """
+    query = Query([models.Traceroute.id, models.Traceroute.target_id, models.Traceroute.creation_date,
+                   models.Traceroute.raw_data, models.Traceroute.legacy_raw_traceroute])
+    return _filter_traceroute_keyset(query, target_id=target_id, after=after, descending=descending).statement
+
+
+def decode_traceroute_row(row):
+    """
+    :return: (tuple) id, target_id, creation_date, raw_traceroute of a get_traceroute_rows_statement row
+    """
+    traceroute_id, target_id, creation_date, raw_data, legacy_raw_traceroute = row
+    return traceroute_id, target_id, creation_date, \
+        compression.decode(raw_data) if raw_data is not None else legacy_raw_traceroute
+
+
+def iter_traceroute_rows(db: Session, target_id: int = None, after=None, descending: bool = True,
+                         batch_size: int = 500):
+    """
+    Streams traceroutes as plain rows, without ORM objects, fetching batch_size rows at a time from the cursor
+
+    :return: (generator)(tuple) id, target_id, creation_date, raw_traceroute
+    """
+    result = db.execute(get_traceroute_rows_statement(target_id=target_id, after=after, descending=descending),
+                        execution_options={'stream_results': True})
+    for rows in result.partitions(batch_size):
+        for row in rows:
+            yield decode_traceroute_row(row)
+
+
+def _parse(raw_traceroute: str):
+    """
+    :return: (trparse.Traceroute) parsed traceroute, None if it is not parseable
+    """
+    try:
+        return trparse.loads(raw_traceroute)
+    except (trparse.ParseError, IndexError, TypeError, AttributeError):
+        return None
+
+
+def _build_hops(traceroute: trparse.Traceroute):
+    hops = []
+    for hop in traceroute.hops:
+        db_hop = models.Hop(ttl=hop.idx)
+        for probe in hop.probes:
+            db_hop.probes.append(models.Probe(ip=probe.ip, name=probe.name, asn=probe.asn,
+                                              rtt=float(probe.rtt) if probe.rtt is not None else None,
+                                              annotation=probe.annotation))
+        hops.append(db_hop)
+    return hops
+
+
+def create_target_traceroute(db: Session, traceroute: schemas.TracerouteCreate, target_id: int,
+                             parsed_traceroute: trparse.Traceroute = None, creation_date: datetime = None,
+                             commit: bool = True):
+    """
+    Stores a traceroute with its hop and probe rows
+
+    :param parsed_traceroute: (trparse.Traceroute) already parsed traceroute, raw_traceroute gets parsed if not given
+    :param creation_date: (datetime) optional UTC creation date, defaults to now
+    :param commit: (bool) if False, the traceroute is only flushed, listeners are notified by commit()
+    """
     db_traceroute = models.Traceroute(**traceroute.dict(), target_id=target_id)
+    if creation_date is not None:
+        db_traceroute.creation_date = creation_date
+    if parsed_traceroute is None:
+        parsed_traceroute = _parse(db_traceroute.raw_traceroute)
+    if parsed_traceroute is not None:
+        db_traceroute.hops = _build_hops(parsed_traceroute)
+        db_traceroute.path_hash = paths.get_path_hash(parsed_traceroute)
     db.add(db_traceroute)
+    if not commit:
+        db.flush()
+        db.info.setdefault('pending_traceroutes', []).append((target_id, db_traceroute.id))
+        return db_traceroute
     db.commit()
     db.refresh(db_traceroute)
+    _notify_traceroute_listeners(target_id, db_traceroute.id)
     return db_traceroute
 
 
@@ -18,18 +18,39 @@ __build__ = '2020050601'
 
 import os
 import sys
+import queue
+import pathlib
+import threading
+from concurrent.futures import Future
 from logging import getLogger
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import StaticPool
 import sqlalchemy.exc
 from contextlib import contextmanager
 import urllib.parse
-from traceroute_history import models
+from traceroute_history import models, migrations
 
 logger = getLogger(__name__)
 
+# Async dialects used by the web UI, for database_driver values of the config file
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+# SQLite production mode defaults, bytes of the database file read through memory mapping, and milliseconds a
+# connection waits for a lock before failing
+SQLITE_DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_DEFAULT_BUSY_TIMEOUT = 5000
 
 SessionLocal = None
+AsyncSessionLocal = None
+# Same as AsyncSessionLocal, unless the latter is read only
+AsyncWriteSessionLocal = None
+# Dedicated writer of SQLite production mode, see run_write()
+DB_WRITER = None
 
 # Dependency for FastAPI
 def get_db():
@@ -41,30 +62,274 @@ def get_db():
     finally:
         db.close()
 
+# Async dependency for FastAPI
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        raise TypeError('AsyncSessionLocal DB not initialized')
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Async dependency for FastAPI routes that write
+async def get_async_write_db():
+    if AsyncWriteSessionLocal is None:
+        raise TypeError('AsyncWriteSessionLocal DB not initialized')
+    async with AsyncWriteSessionLocal() as db:
+        yield db
+
+def new_session():
+    """
+    :return: (Session) session of its own for a single unit of work, that is not bound to current thread
+             Objects stay readable after commit, so they can be used once the session is closed
+    """
+    if SessionLocal is None:
+        raise TypeError('SessionLocal DB not initialized')
+    return SessionLocal.session_factory(expire_on_commit=False)
+
+
 # For internal DB requests
 @contextmanager
 def db_scoped_session():
-    """Provide a transactional scope around a series of operations."""
-    session = SessionLocal()
+    """
+    Provide a transactional scope around a series of operations, as a session of its own
+    The session is closed afterwards, so its identity map does not outlive the unit of work and its connection goes
+    back to the pool. Returned objects are detached, only their already loaded attributes can be read
+    """
+    session = new_session()
     try:
         yield session
         session.commit()
-        session.flush()
     except:
         session.rollback()
         raise
     finally:
-        pass #TODO
-        #session.close()
+        session.close()
+
+@contextmanager
+def db_session():
+    """
+    Provide a session that is not bound to current thread, eg for generators consumed from several threads
+    """
+    session = SessionLocal.session_factory()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+class DatabaseWriter(object):
+    """
+    Runs write units of work one after another, in a dedicated thread owning a single database connection
+    SQLite only allows one writer at a time, serializing writes here avoids lock errors between threads of the runner
+    """
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._queue = queue.Queue()
+        self._thread = None
+        self.jobs = 0
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='database_writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def run(self, function, **kwargs):
+        """
+        Runs function(db=session, **kwargs) in the writer thread, commits, and waits for its result
+        Exceptions of function are raised here, after rollback
+        """
+        if threading.current_thread() is self._thread:
+            # Nested write, already in the writer thread
+            return self._execute(function, kwargs)
+        if self._thread is None:
+            raise RuntimeError('Database writer is not running')
+        future = Future()
+        self._queue.put((function, kwargs, future))
+        return future.result()
+
+    def _execute(self, function, kwargs):
+        session = self._session_factory()
+        try:
+            result = function(db=session, **kwargs)
+            session.commit()
+            return result
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            function, kwargs, future = job
+            try:
+                future.set_result(self._execute(function, kwargs))
+            except BaseException as exc:
+                future.set_exception(exc)
+            self.jobs += 1
+
+
+def run_write(function, **kwargs):
+    """
+    Runs function(db=session, **kwargs) as a unit of work that writes, then commits
+    Goes through the dedicated writer in SQLite production mode, uses a session of its own otherwise
+    Either way, the session is closed afterwards and returned objects are detached, but keep their loaded attributes
+    """
+    if DB_WRITER is not None:
+        return DB_WRITER.run(function, **kwargs)
+    session = new_session()
+    try:
+        result = function(db=session, **kwargs)
+        session.commit()
+        return result
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
-def load_database(config, initialize=False):
+
+def get_sqlite_settings(config):
+    """
+    :return: (dict) mmap_size and busy_timeout of SQLite production mode, None if disabled or not using sqlite
+    """
+    if not config['TRACEROUTE_HISTORY']['database_driver'].startswith('sqlite'):
+        return None
+    production_mode = str(config['TRACEROUTE_HISTORY'].get('sqlite_production_mode', 'yes')).strip().lower()
+    if production_mode in ('no', 'false', 'off', '0'):
+        return None
+    if production_mode not in ('yes', 'true', 'on', '1'):
+        logger.error('Bogus sqlite_production_mode value. Using default.')
+    settings = {}
+    for key, default in (('mmap_size', SQLITE_DEFAULT_MMAP_SIZE), ('busy_timeout', SQLITE_DEFAULT_BUSY_TIMEOUT)):
+        try:
+            settings[key] = int(config['TRACEROUTE_HISTORY']['sqlite_' + key])
+        except KeyError:
+            settings[key] = default
+        except (TypeError, ValueError):
+            logger.error('Bogus sqlite_{0} value. Using default.'.format(key))
+            settings[key] = default
+    return settings
+
+
+def set_sqlite_pragmas(engine, mmap_size: int, busy_timeout: int, read_only: bool = False):
+    """
+    Sets SQLite production pragmas on every new connection of engine
+    WAL lets readers work while a write is in progress, synchronous=NORMAL only syncs on checkpoints in WAL mode,
+    which is still safe against corruption
+    Journal mode is stored in the database file, read only connections just inherit it
+    """
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA busy_timeout={0:d}'.format(busy_timeout))
+        if not read_only:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA mmap_size={0:d}'.format(mmap_size))
+        cursor.close()
+
+
+def get_read_only_connection_string(db_driver: str, db_host: str):
+    """
+    :return: (str) SQLAlchemy connection string opening an sqlite database file read only
+    """
+    return '{0}:///{1}?mode=ro&uri=true'.format(db_driver, pathlib.Path(db_host).absolute().as_uri())
+
+
+def get_connection_string(config, db_driver: str = None):
+    """
+    :param db_driver: (str) optional driver overriding the one of config, eg an async one
+    :return: (str) SQLAlchemy connection string
+    """
+    if db_driver is None:
+        db_driver = config['TRACEROUTE_HISTORY']['database_driver']
+    db_host = config['TRACEROUTE_HISTORY']['database_host']
+
+    try:
+        db_user = urllib.parse.quote_plus(config['TRACEROUTE_HISTORY']['database_user'])
+        db_password = urllib.parse.quote_plus(config['TRACEROUTE_HISTORY']['database_password'])
+    except KeyError:
+        db_user = None
+        db_password = None
+    try:
+        db_name = config['TRACEROUTE_HISTORY']['database_name']
+    except KeyError:
+        db_name = None
+
+    if db_driver.startswith('sqlite'):
+        db_name = ''
+    elif db_name:
+        db_name = '/' + db_name
+
+    if db_user and db_password and not db_driver.startswith('sqlite'):
+        return '{0}:///{1}:{2}@{3}{4}'.format(db_driver, db_user, db_password, db_host, db_name)
+    return '{0}:///{1}{2}'.format(db_driver, db_host, db_name)
+
+
+def load_async_database(config, read_only: bool = False):
+    """
+    Initiates the async session factory used by the web UI, sync sessions stay in use for everything else
+    Needs the async driver of the configured database (aiosqlite, aiomysql or asyncpg)
+
+    :param read_only: (bool) in SQLite production mode, AsyncSessionLocal connections are read only, writes need
+                      AsyncWriteSessionLocal
+    :return: (async_sessionmaker) session factory, None if database cannot be used asynchronously
+    """
+    global AsyncSessionLocal
+    global AsyncWriteSessionLocal
+
+    # Those imports need greenlet, which is optional for sync usage
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+    db_driver = config['TRACEROUTE_HISTORY']['database_driver']
+    try:
+        async_driver = ASYNC_DRIVERS[db_driver.split('+')[0]]
+    except KeyError:
+        logger.critical('No async driver known for database driver "{0}".'.format(db_driver))
+        return None
+    sqlite_settings = get_sqlite_settings(config)
+    try:
+        engine = create_async_engine(get_connection_string(config, db_driver=async_driver))
+        if sqlite_settings and read_only:
+            read_only_engine = create_async_engine(get_read_only_connection_string(
+                async_driver, config['TRACEROUTE_HISTORY']['database_host']))
+        else:
+            read_only_engine = engine
+    except ImportError as exc:
+        logger.critical('Cannot load async database driver "{0}": {1}.'.format(async_driver, exc))
+        return None
+    if sqlite_settings:
+        set_sqlite_pragmas(engine.sync_engine, **sqlite_settings)
+        if read_only_engine is not engine:
+            set_sqlite_pragmas(read_only_engine.sync_engine, read_only=True, **sqlite_settings)
+    # Objects stay readable after commit, lazy loads are not possible outside of run_sync
+    AsyncWriteSessionLocal = sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    AsyncSessionLocal = sessionmaker(read_only_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    return AsyncSessionLocal
+
+
+def load_database(config, initialize=False, writer=False, upgrade=False):
     """
     Initiates database session as scoped session so we can reutilise the factory in a threaded model
 
+    :param upgrade: (bool) applies pending schema migrations, then exits
+                    Otherwise, exits when the database schema is not up to date
+    :param writer: (bool) in SQLite production mode, starts DB_WRITER which run_write() hands writes to
     :return:
     """
 
     global SessionLocal
+    global DB_WRITER
 
     db_driver = config['TRACEROUTE_HISTORY']['database_driver']
     db_host = config['TRACEROUTE_HISTORY']['database_host']
@@ -89,10 +354,7 @@ def load_database(config, initialize=False):
     elif db_name:
         db_name = '/' + db_name
 
-    if db_user and db_password and db_driver != 'sqlite':
-        connection_string = '{0}:///{1}:{2}@{3}{4}'.format(db_driver, db_user, db_password, db_host, db_name)
-    else:
-        connection_string = '{0}:///{1}{2}'.format(db_driver, db_host, db_name)
+    connection_string = get_connection_string(config)
 
     logger.debug('SQL Connection string "{0}".'.format(connection_string))
     if initialize:
@@ -100,6 +362,12 @@ def load_database(config, initialize=False):
         models.init_db(db_engine)
         logger.info('DB engine initialization finished.')
         sys.exit(0)
+    elif upgrade:
+        db_engine = create_engine(connection_string)
+        applied = migrations.upgrade(db_engine)
+        logger.info('Applied {0} database migrations, schema is at version {1}.'.format(
+            len(applied), migrations.get_schema_version(db_engine)))
+        sys.exit(0)
     else:
         try:
             logger.debug('Trying to open {0} database "{1}{2}" as user "{2}".'.format(db_driver, db_host, db_name, db_user, db_password))
@@ -108,8 +376,25 @@ def load_database(config, initialize=False):
             # We need to disable thread check
             # Warning: Check that we always use different threads when using scheduler
             engine = create_engine(connection_string, connect_args={'check_same_thread': False})
+            sqlite_settings = get_sqlite_settings(config)
+            if sqlite_settings:
+                set_sqlite_pragmas(engine, **sqlite_settings)
+            # Migrations only run with --init-db / --upgrade-db, never behind a running process
+            schema_version = migrations.get_schema_version(engine)
+            if schema_version < migrations.LATEST_VERSION:
+                logger.critical('Database schema is at version {0}, this version requires {1}. Please run '
+                                'traceroute_history_runner.py with --upgrade-db.'.format(schema_version,
+                                                                                        migrations.LATEST_VERSION))
+                sys.exit(3)
             session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
             SessionLocal =  scoped_session(session_factory)
+            if sqlite_settings and writer and DB_WRITER is None:
+                # A single connection, only ever used by the writer thread
+                writer_engine = create_engine(connection_string, connect_args={'check_same_thread': False},
+                                              poolclass=StaticPool)
+                set_sqlite_pragmas(writer_engine, **sqlite_settings)
+                DB_WRITER = DatabaseWriter(sessionmaker(autoflush=False, expire_on_commit=False, bind=writer_engine))
+                DB_WRITER.start()
             return SessionLocal
         except sqlalchemy.exc.OperationalError:
             logger.critical('Cannot connect to database "{0}".'.format(db_host), exc_info=True)
@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+ingest_queue is a write-behind queue for probe results
+Units of work are queued by probe callbacks, and a single thread runs them in batches, every batch being committed in
+one transaction, so thousands of probes per interval do not mean thousands of commits (and fsyncs)
+
+"""
+
+__intname__ = 'traceroute_history.ingest_queue'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022052501'
+
+import queue
+import threading
+from time import monotonic
+from logging import getLogger
+from concurrent.futures import Future
+from sqlalchemy.orm import Session
+from traceroute_history import crud, database
+
+logger = getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+# Seconds to wait for more jobs once a batch got its first one
+DEFAULT_BATCH_INTERVAL = 0.2
+DEFAULT_MAX_QUEUE_SIZE = 10000
+
+
+def run_jobs(db: Session, jobs):
+    """
+    Runs jobs in a single transaction, then commits
+    Jobs must use crud functions with commit=False, so nothing gets committed before the whole batch is done
+
+    :param jobs: (list)(tuple) function, kwargs, every function being called with db and its kwargs
+    :return: (list) results of every job
+    """
+    try:
+        results = [function(db=db, **kwargs) for function, kwargs in jobs]
+        crud.commit(db)
+    except BaseException:
+        crud.rollback(db)
+        raise
+    return results
+
+
+def run_now(function, **kwargs):
+    """
+    Runs a single queue job right away, in its own transaction
+    """
+    return database.run_write(run_jobs, jobs=[(function, kwargs)])[0]
+
+
+class IngestQueue(object):
+    """
+    Bounded queue of database units of work, drained by a single thread in batches of batch_size jobs, or whatever
+    arrived within batch_interval seconds after the first job of a batch
+    Producers block while the queue is full, which slows probe callbacks down instead of growing memory use
+
+    When a batch fails, it is rolled back, on_rollback is called, and its jobs are retried one by one so a single bad
+    job does not lose the others
+    """
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, batch_interval: float = DEFAULT_BATCH_INTERVAL,
+                 max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE, on_rollback=None):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_queue_size = max_queue_size
+        self.on_rollback = on_rollback
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.max_depth = 0
+        self.blocked_puts = 0
+        self.batches = 0
+        self.jobs = 0
+        self.failed_batches = 0
+        self.failed_jobs = 0
+        self.total_flush_latency = 0
+        self.max_flush_latency = 0
+        self.last_flush_latency = 0
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='ingest_queue', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Waits for all queued jobs to be written, then stops the queue thread
+        """
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def put(self, function, kwargs: dict = None, timeout: float = None):
+        """
+        Queues a unit of work, blocks while the queue is full
+
+        :param function: (callable) called with db and kwargs from the queue thread
+        :param timeout: (float) optional seconds to wait for room in the queue, raises queue.Full once elapsed
+        :return: (concurrent.futures.Future) future resolving to the function result once its batch is committed
+        """
+        if self._thread is None:
+            raise RuntimeError('Ingest queue is not running')
+        future = Future()
+        job = (function, kwargs or {}, future)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.blocked_puts += 1
+            self._queue.put(job, timeout=timeout)
+        depth = self._queue.qsize()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+        return future
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'depth': self._queue.qsize(),
+                'max_depth': self.max_depth,
+                'blocked_puts': self.blocked_puts,
+                'batches': self.batches,
+                'jobs': self.jobs,
+                'failed_batches': self.failed_batches,
+                'failed_jobs': self.failed_jobs,
+                'average_batch_size': self.jobs / self.batches if self.batches else 0,
+                'average_flush_latency': self.total_flush_latency / self.batches if self.batches else 0,
+                'max_flush_latency': self.max_flush_latency,
+                'last_flush_latency': self.last_flush_latency
+            }
+
+    def _get_batch(self):
+        """
+        :return: (list, bool) jobs of next batch, True if the queue got stopped
+        """
+        job = self._queue.get()
+        if job is None:
+            return [], True
+        jobs = [job]
+        deadline = monotonic() + self.batch_interval
+        while len(jobs) < self.batch_size:
+            remaining = deadline - monotonic()
+            try:
+                if remaining > 0:
+                    job = self._queue.get(timeout=remaining)
+                else:
+                    job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                return jobs, True
+            jobs.append(job)
+        return jobs, False
+
+    def _run(self):
+        while True:
+            jobs, stopped = self._get_batch()
+            if jobs:
+                self._write(jobs)
+            if stopped:
+                return
+
+    def _write(self, jobs):
+        start = monotonic()
+        try:
+            results = database.run_write(run_jobs, jobs=[(function, kwargs) for function, kwargs, _ in jobs])
+        except Exception as exc:
+            logger.error('Ingest batch of {0} jobs failed, retrying jobs one by one: {1}.'.format(len(jobs), exc))
+            with self._lock:
+                self.failed_batches += 1
+            if self.on_rollback:
+                self.on_rollback()
+            self._write_one_by_one(jobs)
+        else:
+            for (_, _, future), result in zip(jobs, results):
+                future.set_result(result)
+        latency = monotonic() - start
+        with self._lock:
+            self.batches += 1
+            self.jobs += len(jobs)
+            self.last_flush_latency = latency
+            self.total_flush_latency += latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    def _write_one_by_one(self, jobs):
+        for function, kwargs, future in jobs:
+            try:
+                result = run_now(function, **kwargs)
+            except Exception as exc:
+                with self._lock:
+                    self.failed_jobs += 1
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+migrations brings databases created by previous versions up to date
+Every schema change gets a new migration at the end of MIGRATIONS, applied migrations are recorded in the
+schema_version table so only newer ones run on upgrade
+Migrations run with --init-db or --upgrade-db only, the runner and the web UI refuse to open a database whose schema
+is behind, so DDL never runs against a database in use
+Migration steps check the current schema before changing it, so databases upgraded by the column / index detection of
+previous versions, or created from scratch by models.init_db, can be stamped without failing
+
+"""
+
+__intname__ = 'traceroute_history.migrations'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022052801'
+
+from typing import Callable, NamedTuple
+from logging import getLogger
+import sqlalchemy.exc
+from sqlalchemy import Column, Float, Integer, LargeBinary, MetaData, String, Table, func, inspect, insert, select, \
+    text, update
+from traceroute_history import models, compression, paths, traceroute_cache
+
+logger = getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    # Called with a connection, within the transaction recording the migration
+    upgrade: Callable
+
+
+def _create_tables(*table_names):
+    def _upgrade(connection):
+        for table_name in table_names:
+            models.Base.metadata.tables[table_name].create(bind=connection, checkfirst=True)
+    return _upgrade
+
+
+def _add_columns(table_name, *column_names):
+    def _upgrade(connection):
+        inspector = inspect(connection)
+        # Missing tables get created with all their columns
+        if table_name not in inspector.get_table_names():
+            return
+        existing_columns = [column['name'] for column in inspector.get_columns(table_name)]
+        for column_name in column_names:
+            if column_name in existing_columns:
+                continue
+            column = models.Base.metadata.tables[table_name].c[column_name]
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(table_name, column_name, column_type)))
+    return _upgrade
+
+
+def _create_indexes(table_name, *index_names):
+    def _upgrade(connection):
+        inspector = inspect(connection)
+        if table_name not in inspector.get_table_names():
+            return
+        existing_indexes = [index['name'] for index in inspector.get_indexes(table_name)]
+        for index in models.Base.metadata.tables[table_name].indexes:
+            if index.name in index_names and index.name not in existing_indexes:
+                index.create(bind=connection)
+    return _upgrade
+
+
+# Tables as they are at version 5, later migrations may add columns to the models which do not exist yet at this point
+_V5_METADATA = MetaData()
+_V5_TRACEROUTE = Table('traceroute', _V5_METADATA, Column('id', Integer, primary_key=True),
+                       Column('raw_traceroute', String), Column('raw_traceroute_data', LargeBinary),
+                       Column('path_hash', String))
+_V5_HOP = Table('hop', _V5_METADATA, Column('id', Integer, primary_key=True), Column('traceroute_id', Integer),
+                Column('ttl', Integer))
+_V5_PROBE = Table('probe', _V5_METADATA, Column('id', Integer, primary_key=True), Column('hop_id', Integer),
+                  Column('ip', String), Column('name', String), Column('asn', Integer), Column('rtt', Float),
+                  Column('annotation', String))
+
+
+def _backfill_traceroute_hops(connection, batch_size: int = 500):
+    # Traceroutes whose output is not parseable keep no hops, they are not read again once this migration is recorded
+    hop_count = 0
+    hash_count = 0
+    last_id = 0
+    while True:
+        traceroutes = connection.execute(
+            select(_V5_TRACEROUTE.c.id, _V5_TRACEROUTE.c.raw_traceroute, _V5_TRACEROUTE.c.raw_traceroute_data).where(
+                _V5_TRACEROUTE.c.path_hash.is_(None), _V5_TRACEROUTE.c.id > last_id).order_by(
+                _V5_TRACEROUTE.c.id).limit(batch_size)).all()
+        if not traceroutes:
+            break
+        last_id = traceroutes[-1].id
+        # Traceroutes stored once hops were normalized, but before path hashes, only lack the latter
+        with_hops = set(connection.execute(select(_V5_HOP.c.traceroute_id).where(
+            _V5_HOP.c.traceroute_id.in_([traceroute.id for traceroute in traceroutes]))).scalars())
+        for traceroute in traceroutes:
+            if traceroute.raw_traceroute_data is not None:
+                raw_traceroute = compression.decode(traceroute.raw_traceroute_data)
+            else:
+                raw_traceroute = traceroute.raw_traceroute
+            parsed_traceroute = traceroute_cache.parse_traceroute(raw_traceroute)
+            if parsed_traceroute is None or not parsed_traceroute.hops:
+                continue
+            if traceroute.id not in with_hops:
+                for hop in parsed_traceroute.hops:
+                    hop_id = connection.execute(insert(_V5_HOP).values(
+                        traceroute_id=traceroute.id, ttl=hop.idx)).inserted_primary_key[0]
+                    if hop.probes:
+                        connection.execute(insert(_V5_PROBE), [
+                            {'hop_id': hop_id, 'ip': probe.ip, 'name': probe.name, 'asn': probe.asn,
+                             'rtt': float(probe.rtt) if probe.rtt is not None else None,
+                             'annotation': probe.annotation} for probe in hop.probes])
+                hop_count += 1
+            connection.execute(update(_V5_TRACEROUTE).where(_V5_TRACEROUTE.c.id == traceroute.id).values(
+                path_hash=paths.get_path_hash(parsed_traceroute)))
+            hash_count += 1
+    if hop_count:
+        logger.info('Created hops of {0} existing traceroutes.'.format(hop_count))
+    if hash_count:
+        logger.info('Computed path hash of {0} existing traceroutes.'.format(hash_count))
+
+
+def _run_steps(*steps):
+    def _upgrade(connection):
+        for step in steps:
+            step(connection)
+    return _upgrade
+
+
+MIGRATIONS = [
+    Migration(1, 'Create hop, probe, rtt series and rtt rollup tables',
+              _create_tables('hop', 'probe', 'rtt_series', 'rtt_rollup')),
+    Migration(2, 'Add target probe interval, traceroute path hash and compressed raw traceroute columns',
+              _run_steps(_add_columns('target', 'probe_interval'),
+                         _add_columns('traceroute', 'path_hash', 'raw_traceroute_data'))),
+    Migration(3, 'Add traceroute path hash and creation date indexes',
+              _create_indexes('traceroute', 'ix_traceroute_target_id_path_hash',
+                              'ix_traceroute_target_id_creation_date')),
+    Migration(4, 'Add traceroute latest traceroutes index',
+              _create_indexes('traceroute', 'ix_traceroute_target_id_id')),
+    Migration(5, 'Create hops and path hashes of traceroutes stored before hops were normalized',
+              _backfill_traceroute_hops),
+    Migration(6, 'Create rtt rollup dirty table', _create_tables('rtt_rollup_dirty')),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def get_schema_version(db_engine):
+    """
+    :return: (int) version of the last applied migration, 0 if none was recorded
+    """
+    if not inspect(db_engine).has_table(models.SchemaVersion.__tablename__):
+        return 0
+    with db_engine.connect() as connection:
+        return connection.execute(select(func.max(models.SchemaVersion.version))).scalar() or 0
+
+
+def upgrade(db_engine):
+    """
+    Applies migrations newer than the database schema version, each one in its own transaction
+
+    :return: (list)(int) versions of applied migrations
+    """
+    models.SchemaVersion.__table__.create(bind=db_engine, checkfirst=True)
+    current_version = get_schema_version(db_engine)
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= current_version:
+            continue
+        logger.info('Applying database migration {0}: {1}.'.format(migration.version, migration.description))
+        try:
+            with db_engine.begin() as connection:
+                migration.upgrade(connection)
+                connection.execute(insert(models.SchemaVersion).values(version=migration.version,
+                                                                      description=migration.description))
+        except sqlalchemy.exc.IntegrityError:
+            # Another --upgrade-db run against the same database applied it first
+            logger.info('Database migration {0} was already applied.'.format(migration.version))
+            continue
+        applied.append(migration.version)
+    return applied
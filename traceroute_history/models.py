@@ -17,26 +17,202 @@ __version__ = '0.4.0'
 __build__ = '2020050601'
 
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Index, LargeBinary, Table
 from sqlalchemy.orm import relationship
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.sql import func
 #from traceroute_history.database import Base
+from decimal import Decimal
+from traceroute_history import trparse, compression
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+
+class SqliteDateTime(sqlite.DATETIME):
+    """
+    SQLite stores dates as text, server side CURRENT_TIMESTAMP dates having no microseconds
+    Microseconds are only stored when not zero, so dates sort and compare the same whether they were set by the server
+    or by python, eg in keyset pagination
+    """
+    def bind_processor(self, dialect):
+        def process(value):
+            if value is None:
+                return None
+            return value.strftime('%Y-%m-%d %H:%M:%S.%f' if value.microsecond else '%Y-%m-%d %H:%M:%S')
+        return process
+
+
+class Probe(Base):
+    __tablename__ = 'probe'
+
+    id = Column(Integer, primary_key=True)
+    hop_id = Column(Integer, ForeignKey('hop.id'), index=True, nullable=False)
+    ip = Column(String(45), index=True, nullable=True)  # None for unanswered probes
+    name = Column(String(255), nullable=True)
+    asn = Column(Integer, nullable=True)
+    rtt = Column(Float, nullable=True)  # ms, None for unanswered probes
+    annotation = Column(String(32), nullable=True)
+
+    def __repr__(self):
+        return 'Probe {0} ({1}): rtt={2}'.format(self.name, self.ip, self.rtt)
+
+
+class Hop(Base):
+    __tablename__ = 'hop'
+
+    id = Column(Integer, primary_key=True)
+    traceroute_id = Column(Integer, ForeignKey('traceroute.id'), index=True, nullable=False)
+    ttl = Column(Integer, nullable=False)
+    probes = relationship(Probe, order_by=Probe.id, cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return 'Hop {0}: {1}'.format(self.ttl, self.probes)
+
+
 class Traceroute(Base):
     __tablename__ = 'traceroute'
 
     id = Column(Integer, primary_key=True)
-    creation_date = Column(DateTime(timezone=True), server_default=func.now())  # using func.now() guarantees UTC data
-    raw_traceroute = Column(String(2048), nullable=False)
+    # using func.now() guarantees UTC data
+    creation_date = Column(DateTime(timezone=True).with_variant(SqliteDateTime(timezone=True), 'sqlite'),
+                           server_default=func.now())
+    # Plain text column of previous versions, left empty since raw output is stored compressed in raw_data
+    legacy_raw_traceroute = Column('raw_traceroute', String(2048), nullable=False, default='')
+    raw_data = Column('raw_traceroute_data', LargeBinary, nullable=True)  # See compression.encode
     target_id = Column(Integer, ForeignKey('target.id'))
+    path_hash = Column(String(40), nullable=True)  # See paths.get_path_hash, None when not parseable
     target = relationship('Target')
+    # Parsed hops, empty when raw_traceroute is not parseable (failed probe)
+    hops = relationship(Hop, order_by=Hop.ttl, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        Index('ix_traceroute_target_id_path_hash', 'target_id', 'path_hash'),
+        # Keyset pagination, see crud.get_traceroute_page
+        Index('ix_traceroute_target_id_creation_date', 'target_id', 'creation_date'),
+    )
 
     def __repr__(self):
         return 'Traceroute recorded at {0}:\n {1}'.format(self.creation_date, self.raw_traceroute)
 
+    @property
+    def raw_traceroute(self):
+        """
+        Raw traceroute output, decoded on first access
+        """
+        try:
+            return self._decoded_raw_traceroute
+        except AttributeError:
+            pass
+        if self.raw_data is not None:
+            raw_traceroute = compression.decode(self.raw_data)
+        else:
+            raw_traceroute = self.legacy_raw_traceroute
+        self._decoded_raw_traceroute = raw_traceroute
+        return raw_traceroute
+
+    @raw_traceroute.setter
+    def raw_traceroute(self, raw_traceroute):
+        self.raw_data = compression.encode(raw_traceroute)
+        self.legacy_raw_traceroute = ''
+        self._decoded_raw_traceroute = raw_traceroute
+
+    @property
+    def is_compressed(self):
+        return self.raw_data is not None
+
+    def to_trparse(self):
+        """
+        Builds a trparse.Traceroute object from stored hops, without parsing raw_traceroute
+
+        :return: (trparse.Traceroute) traceroute object, None if there are no stored hops
+        """
+        if not self.hops:
+            return None
+        traceroute = trparse.Traceroute(None, None)
+        for db_hop in self.hops:
+            hop = trparse.Hop(db_hop.ttl)
+            for db_probe in db_hop.probes:
+                rtt = Decimal(str(db_probe.rtt)) if db_probe.rtt is not None else None
+                hop.add_probe(trparse.Probe(name=db_probe.name, ip=db_probe.ip, asn=db_probe.asn, rtt=rtt,
+                                            annotation=db_probe.annotation))
+                traceroute.update_global_rtt(rtt)
+            traceroute.add_hop(hop)
+        return traceroute
+
+
+# Latest traceroutes of a target, ie filter on target_id, order by id desc
+Index('ix_traceroute_target_id_id', Traceroute.target_id, Traceroute.id.desc())
+
+
+class RttSeries(Base):
+    """
+    Rtt samples of a target for one hour, see rtt_series module
+    """
+    __tablename__ = 'rtt_series'
+
+    id = Column(Integer, primary_key=True)
+    target_id = Column(Integer, ForeignKey('target.id'), nullable=False)
+    bucket_start = Column(Integer, nullable=False)  # Unix timestamp of the hour
+    sample_count = Column(Integer, nullable=False, default=0)
+    data = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        Index('ix_rtt_series_target_id_bucket_start', 'target_id', 'bucket_start', unique=True),
+    )
+
+    def __repr__(self):
+        return 'RttSeries of target {0} at {1}: {2} samples'.format(self.target_id, self.bucket_start,
+                                                                   self.sample_count)
+
+
+class RttRollup(Base):
+    """
+    Rtt statistics of a target hop over an hour or a day, see rtt_rollups module
+    ttl 0 holds statistics of the target itself, ie of the last answering hop of every probe
+    """
+    __tablename__ = 'rtt_rollup'
+
+    id = Column(Integer, primary_key=True)
+    target_id = Column(Integer, ForeignKey('target.id'), nullable=False)
+    resolution = Column(Integer, nullable=False)  # Bucket duration in seconds
+    bucket_start = Column(Integer, nullable=False)  # Unix timestamp
+    ttl = Column(Integer, nullable=False)
+    sample_count = Column(Integer, nullable=False)
+    rtt_min = Column(Float, nullable=True)  # ms, None when no probe answered
+    rtt_max = Column(Float, nullable=True)
+    rtt_mean = Column(Float, nullable=True)
+    rtt_p95 = Column(Float, nullable=True)
+    loss = Column(Float, nullable=False)  # Mean loss percentage
+
+    __table_args__ = (
+        Index('ix_rtt_rollup_target_id_resolution_bucket_start_ttl', 'target_id', 'resolution', 'bucket_start', 'ttl',
+              unique=True),
+    )
+
+    def __repr__(self):
+        return 'RttRollup of target {0} at {1} ({2}s), ttl {3}: {4} samples'.format(
+            self.target_id, self.bucket_start, self.resolution, self.ttl, self.sample_count)
+
+
+class RttRollupDirty(Base):
+    """
+    Earliest sample written to an already closed bucket of a target, so the rollups from there get computed again
+    """
+    __tablename__ = 'rtt_rollup_dirty'
+
+    id = Column(Integer, primary_key=True)
+    target_id = Column(Integer, ForeignKey('target.id'), nullable=False)
+    resolution = Column(Integer, nullable=False)  # Bucket duration in seconds
+    earliest = Column(Integer, nullable=False)  # Unix timestamp
+
+    __table_args__ = (
+        Index('ix_rtt_rollup_dirty_target_id_resolution', 'target_id', 'resolution', unique=True),
+    )
+
+    def __repr__(self):
+        return 'RttRollupDirty of target {0} ({1}s) since {2}'.format(self.target_id, self.resolution, self.earliest)
+
 
 # Many to Many relationship
 target_groups_association = Table('target_groups_association', Base.metadata,
@@ -65,6 +241,7 @@ class Target(Base):
     update_date = Column(DateTime(timezone=True), onupdate=func.now())
     name = Column(String(255), unique=True, nullable=False)
     address = Column(String(512), nullable=True)
+    probe_interval = Column(Integer, nullable=True)  # Effective probe interval when using adaptive intervals
     traceroutes = relationship(Traceroute, backref='traceroutes')
     groups = relationship('Group', secondary=target_groups_association, back_populates='targets')
 
@@ -72,5 +249,26 @@ class Target(Base):
         return 'Target {0}: address={1}, created on {2}'.format(self.name, self.address, self.creation_date)
 
 
+class SchemaVersion(Base):
+    """
+    Migrations applied to the database, see migrations module
+    """
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(255), nullable=False)
+    applied_date = Column(DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return 'Schema version {0} applied on {1}: {2}'.format(self.version, self.applied_date, self.description)
+
+
 def init_db(db_engine):
+    """
+    Creates missing tables with their latest schema, then brings existing tables up to date
+    """
+    # migrations module depends on models
+    from traceroute_history import migrations
+
     Base.metadata.create_all(db_engine)
+    migrations.upgrade(db_engine)
@@ -0,0 +1,385 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+native_traceroute is an in-process IPv4 traceroute implementation (ICMP, UDP and TCP SYN probes)
+All TTLs of a target are probed at once, paris-traceroute style: every probe of a trace keeps the same flow
+identifiers so per-flow load balancers route them alike, and replies are matched back to probes by id
+Results are returned as trparse.Traceroute objects, so no text is generated nor parsed
+
+Raw sockets are needed, hence root or CAP_NET_RAW
+
+"""
+
+__intname__ = 'traceroute_history.native_traceroute'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022051101'
+
+import asyncio
+import socket
+import struct
+import random
+from time import monotonic
+from decimal import Decimal
+from logging import getLogger
+from traceroute_history import trparse
+
+logger = getLogger(__name__)
+
+PROTOCOLS = ('icmp', 'udp', 'tcp')
+DEFAULT_PROTOCOL = 'icmp'
+DEFAULT_MAX_HOPS = 30
+DEFAULT_PROBES_PER_HOP = 3
+DEFAULT_HOP_TIMEOUT = 3
+DEFAULT_PORTS = {'udp': 33434, 'tcp': 80}
+
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACHABLE = 3
+ICMP_ECHO_REQUEST = 8
+ICMP_TIME_EXCEEDED = 11
+
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+# Destination unreachable codes as shown by unix traceroute
+UNREACHABLE_ANNOTATIONS = {0: '!N', 1: '!H', 2: '!P', 4: '!F', 9: '!X', 10: '!X', 13: '!X'}
+
+
+def checksum(data: bytes):
+    """
+    RFC 1071 internet checksum
+    """
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!{0}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def build_icmp_echo(identifier: int, sequence: int):
+    """
+    Builds an ICMP echo request whose checksum only depends on identifier
+    The payload compensates the sequence number, so the first four bytes (hashed by load balancers) stay constant
+    """
+    payload = struct.pack('!H', 0xffff - sequence)
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    icmp_checksum = checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, icmp_checksum, identifier, sequence) + payload
+
+
+def build_tcp_syn(source_ip: str, destination_ip: str, source_port: int, destination_port: int, sequence: int):
+    """
+    Builds a TCP SYN segment, the IP header is left to the kernel
+    """
+    offset_flags = (5 << 12) | TCP_SYN
+    header = struct.pack('!HHIIHHHH', source_port, destination_port, sequence, 0, offset_flags, 64240, 0, 0)
+    pseudo_header = socket.inet_aton(source_ip) + socket.inet_aton(destination_ip) + \
+        struct.pack('!BBH', 0, socket.IPPROTO_TCP, len(header))
+    tcp_checksum = checksum(pseudo_header + header)
+    return header[:16] + struct.pack('!H', tcp_checksum) + header[18:]
+
+
+def get_source_address(destination_ip: str):
+    """
+    Finds the local address the kernel would use to reach destination_ip, without sending anything
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((destination_ip, 9))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+def _answered(future):
+    return future.done() and not future.cancelled()
+
+
+class _Reply(object):
+    def __init__(self, ip, receive_time, icmp_type=None, icmp_code=None, reached=False):
+        self.ip = ip
+        self.receive_time = receive_time
+        self.icmp_type = icmp_type
+        self.icmp_code = icmp_code
+        self.reached = reached
+
+
+class NativeTracer(object):
+    """
+    Shares one raw receive socket per protocol between all running traces, and dispatches replies to the
+    waiting probes by probe key:
+    - ICMP probes are keyed by (identifier, sequence)
+    - UDP probes keep a constant 5-tuple per trace and are keyed by their IP total length (payload size)
+    - TCP probes keep a constant 5-tuple per trace and are keyed by their sequence number
+
+    Must be used from a single event loop
+    """
+    def __init__(self, loop=None):
+        self._loop = loop
+        self._icmp_socket = None
+        self._tcp_socket = None
+        self._pending = {}
+        self._flow_ids = set()
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def _open_raw_socket(self, protocol, reader):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, protocol)
+        sock.setblocking(False)
+        self._get_loop().add_reader(sock.fileno(), reader, sock)
+        return sock
+
+    def _ensure_sockets(self, protocol):
+        if self._icmp_socket is None:
+            self._icmp_socket = self._open_raw_socket(socket.IPPROTO_ICMP, self._read_icmp)
+        if protocol == 'tcp' and self._tcp_socket is None:
+            self._tcp_socket = self._open_raw_socket(socket.IPPROTO_TCP, self._read_tcp)
+
+    def close(self):
+        for sock in (self._icmp_socket, self._tcp_socket):
+            if sock is not None:
+                self._get_loop().remove_reader(sock.fileno())
+                sock.close()
+        self._icmp_socket = None
+        self._tcp_socket = None
+
+    def _allocate_flow_id(self, low, high):
+        while True:
+            flow_id = random.randint(low, high)
+            if flow_id not in self._flow_ids:
+                self._flow_ids.add(flow_id)
+                return flow_id
+
+    def _dispatch(self, key, reply):
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    def _read_icmp(self, sock):
+        while True:
+            try:
+                packet, (responder, _) = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                logger.debug('Cannot read from raw ICMP socket.', exc_info=True)
+                return
+            try:
+                key, reply = self._parse_icmp(packet, responder)
+            except (IndexError, struct.error):
+                continue
+            if key:
+                self._dispatch(key, reply)
+
+    @staticmethod
+    def _parse_icmp(packet, responder):
+        receive_time = monotonic()
+        ihl = (packet[0] & 0x0f) * 4
+        icmp_type, icmp_code = packet[ihl], packet[ihl + 1]
+        if icmp_type == ICMP_ECHO_REPLY:
+            identifier, sequence = struct.unpack('!HH', packet[ihl + 4:ihl + 8])
+            return ('icmp', identifier, sequence), _Reply(responder, receive_time, icmp_type, icmp_code, True)
+        if icmp_type not in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACHABLE):
+            return None, None
+
+        # Time exceeded and unreachable messages quote the original IP header and 8 bytes of its payload
+        inner = packet[ihl + 8:]
+        inner_ihl = (inner[0] & 0x0f) * 4
+        inner_protocol = inner[9]
+        total_length = struct.unpack('!H', inner[2:4])[0]
+        destination_ip = socket.inet_ntoa(inner[16:20])
+        l4_header = inner[inner_ihl:inner_ihl + 8]
+        reached = icmp_type == ICMP_DEST_UNREACHABLE and responder == destination_ip
+        reply = _Reply(responder, receive_time, icmp_type, icmp_code, reached)
+        if inner_protocol == socket.IPPROTO_ICMP:
+            identifier, sequence = struct.unpack('!HH', l4_header[4:8])
+            return ('icmp', identifier, sequence), reply
+        if inner_protocol == socket.IPPROTO_UDP:
+            source_port = struct.unpack('!H', l4_header[0:2])[0]
+            return ('udp', destination_ip, source_port, total_length), reply
+        if inner_protocol == socket.IPPROTO_TCP:
+            source_port, _, sequence = struct.unpack('!HHI', l4_header[0:8])
+            return ('tcp', destination_ip, source_port, sequence), reply
+        return None, None
+
+    def _read_tcp(self, sock):
+        while True:
+            try:
+                packet, (responder, _) = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                logger.debug('Cannot read from raw TCP socket.', exc_info=True)
+                return
+            try:
+                ihl = (packet[0] & 0x0f) * 4
+                _, destination_port, _, acknowledgment, offset_flags = struct.unpack('!HHIIH',
+                                                                                     packet[ihl:ihl + 14])
+            except (IndexError, struct.error):
+                continue
+            # SYN-ACK or RST from the destination, acknowledging our SYN sequence
+            if offset_flags & (TCP_ACK | TCP_RST):
+                self._dispatch(('tcp', responder, destination_port, (acknowledgment - 1) & 0xffffffff),
+                               _Reply(responder, monotonic(), reached=True))
+
+    def _send_probes(self, protocol, destination_ip, port, max_hops, probes_per_hop):
+        """
+        Sends every probe of a trace at once
+
+        :return: (list, callable) list of (ttl, key, future, send_time), cleanup function
+        """
+        loop = self._get_loop()
+        probes = []
+
+        if protocol == 'icmp':
+            flow_id = self._allocate_flow_id(1, 0xffff)
+            sock = self._icmp_socket
+
+            def cleanup():
+                self._flow_ids.discard(flow_id)
+        elif protocol == 'udp':
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind(('', 0))
+            flow_id = sock.getsockname()[1]
+
+            def cleanup():
+                sock.close()
+        else:
+            source_ip = get_source_address(destination_ip)
+            flow_id = self._allocate_flow_id(33000, 60999)
+            sock = self._tcp_socket
+
+            def cleanup():
+                self._flow_ids.discard(flow_id)
+
+        try:
+            for ttl in range(1, max_hops + 1):
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+                for index in range(probes_per_hop):
+                    probe_id = (ttl - 1) * probes_per_hop + index
+                    if protocol == 'icmp':
+                        key = ('icmp', flow_id, probe_id)
+                        packet = build_icmp_echo(flow_id, probe_id)
+                        destination = (destination_ip, 0)
+                    elif protocol == 'udp':
+                        # Probes differ only by payload length, which is quoted back in ICMP errors
+                        payload = b'\x00' * (probe_id + 2)
+                        key = ('udp', destination_ip, flow_id, 20 + 8 + len(payload))
+                        packet = payload
+                        destination = (destination_ip, port)
+                    else:
+                        key = ('tcp', destination_ip, flow_id, probe_id)
+                        packet = build_tcp_syn(source_ip, destination_ip, flow_id, port, probe_id)
+                        destination = (destination_ip, 0)
+
+                    future = loop.create_future()
+                    self._pending[key] = future
+                    send_time = monotonic()
+                    try:
+                        sock.sendto(packet, destination)
+                    except OSError as exc:
+                        logger.debug('Cannot send probe with ttl {0} to {1}: {2}'.format(ttl, destination_ip, exc))
+                    probes.append((ttl, key, future, send_time))
+        except BaseException:
+            self._forget(probes)
+            cleanup()
+            raise
+        return probes, cleanup
+
+    def _forget(self, probes):
+        for _, key, future, _ in probes:
+            self._pending.pop(key, None)
+            future.cancel()
+
+    @staticmethod
+    def _get_reached_ttl(probes):
+        reached = [ttl for ttl, _, future, _ in probes if _answered(future) and future.result().reached]
+        return min(reached) if reached else None
+
+    @staticmethod
+    def _is_complete(probes):
+        """
+        A trace is complete once the destination answered and every probe up to that hop got a reply
+        """
+        reached_ttl = NativeTracer._get_reached_ttl(probes)
+        if reached_ttl is None:
+            return False
+        return all(future.done() for ttl, _, future, _ in probes if ttl <= reached_ttl)
+
+    async def traceroute(self, address: str, protocol: str = DEFAULT_PROTOCOL, max_hops: int = DEFAULT_MAX_HOPS,
+                         probes_per_hop: int = DEFAULT_PROBES_PER_HOP, timeout: float = DEFAULT_HOP_TIMEOUT,
+                         port: int = None):
+        """
+        Traces the route to address, probing all TTLs at once
+
+        :param address: (str) fqdn or IPv4 address
+        :param protocol: (str) icmp, udp or tcp
+        :param max_hops: (int) maximum TTL to probe
+        :param probes_per_hop: (int) number of probes sent per TTL
+        :param timeout: (float) seconds to wait for replies, for the whole trace
+        :param port: (int) destination port for udp / tcp probes
+        :return: (trparse.Traceroute) parsed traceroute object
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError('Unknown native traceroute protocol "{0}".'.format(protocol))
+        if port is None:
+            port = DEFAULT_PORTS.get(protocol)
+
+        loop = self._get_loop()
+        address_info = await loop.getaddrinfo(address, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        destination_ip = address_info[0][4][0]
+
+        self._ensure_sockets(protocol)
+        probes, cleanup = self._send_probes(protocol, destination_ip, port, max_hops, probes_per_hop)
+        try:
+            deadline = monotonic() + timeout
+            pending = [future for _, _, future, _ in probes]
+            while pending and not self._is_complete(probes):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                _, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self._forget(probes)
+            cleanup()
+
+        return self._build_traceroute(address, destination_ip, probes)
+
+    @staticmethod
+    def _build_traceroute(address, destination_ip, probes):
+        reached_ttl = NativeTracer._get_reached_ttl(probes)
+        traceroute = trparse.Traceroute(address, destination_ip)
+        hop = None
+        for ttl, _, future, send_time in probes:
+            # Hops after the destination only hold duplicate destination replies
+            if reached_ttl is not None and ttl > reached_ttl:
+                break
+            if hop is None or hop.idx != ttl:
+                hop = trparse.Hop(ttl)
+                traceroute.add_hop(hop)
+
+            if _answered(future):
+                reply = future.result()
+                rtt = Decimal(max(reply.receive_time - send_time, 0) * 1000).quantize(Decimal('0.001'))
+                if reply.icmp_type == ICMP_DEST_UNREACHABLE and not (reply.reached and reply.icmp_code == 3):
+                    annotation = UNREACHABLE_ANNOTATIONS.get(reply.icmp_code, '!{0}'.format(reply.icmp_code))
+                else:
+                    annotation = None
+                probe = trparse.Probe(name=reply.ip, ip=reply.ip, rtt=rtt, annotation=annotation)
+            else:
+                probe = trparse.Probe()
+            hop.add_probe(probe)
+            traceroute.update_global_rtt(probe.rtt)
+        return traceroute
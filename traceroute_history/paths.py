@@ -0,0 +1,48 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+paths computes the canonical representation of the path a traceroute took, so two traceroutes took the same path
+when their path hashes are equal
+
+"""
+
+__intname__ = 'traceroute_history.paths'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022051701'
+
+import hashlib
+from traceroute_history import trparse
+
+# Marks hops where no probe got an answer
+TIMEOUT_MARKER = '*'
+
+
+def get_path_vector(traceroute: trparse.Traceroute):
+    """
+    Ordered hop vector, every hop being the sorted set of IPs that answered its probes
+    Sorting makes paths through equal cost multipath (ECMP) routers identical whatever the order probes answered in
+
+    :return: (tuple)(tuple)(str) one tuple of IPs per hop, (TIMEOUT_MARKER,) for hops without answer
+    """
+    vector = []
+    for hop in traceroute.hops:
+        ips = sorted(set(probe.ip for probe in hop.probes if probe.ip and probe.rtt is not None))
+        vector.append(tuple(ips) if ips else (TIMEOUT_MARKER,))
+    return tuple(vector)
+
+
+def get_path_hash(traceroute: trparse.Traceroute):
+    """
+    :return: (str) sha1 hex digest of the path vector, None if there is no traceroute
+    """
+    if traceroute is None:
+        return None
+    canonical_path = '|'.join(','.join(ips) for ips in get_path_vector(traceroute))
+    return hashlib.sha1(canonical_path.encode('utf-8')).hexdigest()
@@ -0,0 +1,327 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+probe_engine runs traceroute probes as asyncio subprocesses (or with the in-process native_traceroute backend), so a
+single event loop can hold thousands of in-flight probes instead of blocking one scheduler thread per probe
+
+"""
+
+__intname__ = 'traceroute_history.probe_engine'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022051001'
+
+import os
+import socket
+import asyncio
+import threading
+from time import monotonic
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+from traceroute_history import trparse, native_traceroute, resolver
+
+logger = getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT_PROBES = 256
+DEFAULT_PROBE_TIMEOUT = 300
+
+# os backend runs the system traceroute / tracert binary, native backend uses native_traceroute
+BACKENDS = ('os', 'native')
+DEFAULT_BACKEND = 'os'
+
+# asyncio.current_task only exists since Python 3.7
+try:
+    _current_task = asyncio.current_task
+except AttributeError:
+    _current_task = asyncio.Task.current_task
+
+
+class ProbeResult(object):
+    """
+    Outcome of a single traceroute probe
+    Native probes come with an already parsed traceroute object, their raw output is only rendered when requested
+    """
+    def __init__(self, address, exit_code, output=None, duration=None, traceroute=None):
+        self.address = address
+        self.exit_code = exit_code
+        self._output = output
+        self.duration = duration
+        self.traceroute = traceroute
+
+    @property
+    def output(self):
+        if self._output is None and self.traceroute is not None:
+            self._output = trparse.dumps(self.traceroute)
+        return self._output
+
+    def __repr__(self):
+        return 'ProbeResult for {0}: exit_code={1}, duration={2}'.format(self.address, self.exit_code, self.duration)
+
+
+def get_traceroute_command(address):
+    """
+    Builds the traceroute command for current OS, as an argument list so no shell is ever involved
+    Probes are numeric, since hostname resolution is done afterwards by the cached resolver
+
+    :param address: (str) address
+    :return: (list, str) command arguments, output encoding
+    """
+    if os.name == 'nt':
+        # Ugly hack se we get actual characters encoding right from cmd.exe
+        # Also encodes "well" cp850 using cp437 parameter
+        return ['tracert', '-d', address], 'cp437'
+    return ['traceroute', '-n', address], 'utf-8'
+
+
+async def _reap_process(process):
+    """
+    Kills a process and drains its pipes so the subprocess transport gets closed
+    """
+    try:
+        process.kill()
+    except ProcessLookupError:
+        # Process already exited
+        pass
+    await process.communicate()
+
+
+class RateLimiter(object):
+    """
+    Spaces probe starts so no more than rate probes start per second, must be used from within a single event loop
+    """
+    def __init__(self, rate: float):
+        self.spacing = 1 / rate
+        self._next_slot = 0
+
+    async def wait(self):
+        now = monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.spacing
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class ProbeEngine(object):
+    """
+    Runs traceroute subprocesses on a dedicated asyncio event loop thread
+
+    Probes are submitted from any thread with submit(), which never blocks. At most max_concurrent_probes run at once,
+    the others wait on a semaphore inside the loop. Every probe is killed after probe_timeout seconds.
+    Result callbacks are executed in a small thread pool, so blocking work (eg database writes) never stalls the loop.
+    When a hostname_resolver is given, hop names are resolved after each probe, out of the concurrency slot.
+    When max_probes_per_second is given, probe starts are spaced so load stays smooth whatever the number of targets.
+    """
+    def __init__(self, max_concurrent_probes: int = DEFAULT_MAX_CONCURRENT_PROBES,
+                 probe_timeout: int = DEFAULT_PROBE_TIMEOUT, callback_workers: int = 4,
+                 backend: str = DEFAULT_BACKEND, native_protocol: str = native_traceroute.DEFAULT_PROTOCOL,
+                 native_max_hops: int = native_traceroute.DEFAULT_MAX_HOPS,
+                 native_timeout: float = native_traceroute.DEFAULT_HOP_TIMEOUT,
+                 hostname_resolver: resolver.HostnameResolver = None, max_probes_per_second: float = None):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown probe backend "{0}".'.format(backend))
+        self.max_concurrent_probes = max_concurrent_probes
+        self.probe_timeout = probe_timeout
+        self.callback_workers = callback_workers
+        self.backend = backend
+        self.native_protocol = native_protocol
+        self.native_max_hops = native_max_hops
+        self.native_timeout = native_timeout
+        self.hostname_resolver = hostname_resolver
+        self.max_probes_per_second = max_probes_per_second
+        self._rate_limiter = None
+        self._native_tracer = None
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._callback_executor = None
+        self._tasks = set()
+
+    @property
+    def running(self):
+        return self._loop is not None and self._loop.is_running()
+
+    @property
+    def in_flight(self):
+        """
+        Number of probes currently running or waiting for a concurrency slot
+        """
+        return len(self._tasks)
+
+    def start(self):
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._callback_executor = ThreadPoolExecutor(max_workers=self.callback_workers)
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(started,), name='probe_engine', daemon=True)
+        self._thread.start()
+        started.wait()
+        logger.debug('Probe engine started with {0} concurrent probes and {1}s timeout.'.format(
+            self.max_concurrent_probes, self.probe_timeout))
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrent_probes)
+        if self.max_probes_per_second:
+            self._rate_limiter = RateLimiter(self.max_probes_per_second)
+        if self.backend == 'native':
+            self._native_tracer = native_traceroute.NativeTracer(loop=self._loop)
+        self._loop.call_soon(started.set)
+        try:
+            self._loop.run_forever()
+            # Let killed subprocess transports run their pending close callbacks
+            self._loop.run_until_complete(asyncio.sleep(0.1))
+        finally:
+            if self._native_tracer:
+                self._native_tracer.close()
+            self._loop.close()
+
+    async def _execute(self, args, encoding):
+        spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                                     stderr=asyncio.subprocess.STDOUT))
+        try:
+            process = await asyncio.shield(spawn)
+        except asyncio.CancelledError:
+            # Cancelled while spawning, the process may exist already
+            process = await spawn
+            await _reap_process(process)
+            raise
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), timeout=self.probe_timeout)
+        except BaseException:
+            # Timeouts and cancellations must never leave an orphan traceroute process behind
+            await _reap_process(process)
+            raise
+        return process.returncode, stdout.decode(encoding, errors='replace')
+
+    async def _os_probe(self, address):
+        args, encoding = get_traceroute_command(address)
+        try:
+            exit_code, output = await self._execute(args, encoding)
+        except asyncio.TimeoutError:
+            return -1, 'Traceroute to address "{0}" timed out after {1} seconds.'.format(address, self.probe_timeout)
+        except OSError as exc:
+            return 127, 'Cannot execute {0}: {1}'.format(args[0], exc)
+        return exit_code, output
+
+    async def _native_probe(self, address):
+        try:
+            traceroute = await asyncio.wait_for(
+                self._native_tracer.traceroute(address, protocol=self.native_protocol, max_hops=self.native_max_hops,
+                                               timeout=self.native_timeout), timeout=self.probe_timeout)
+        except asyncio.TimeoutError:
+            return -1, 'Traceroute to address "{0}" timed out after {1} seconds.'.format(address,
+                                                                                       self.probe_timeout), None
+        except socket.gaierror as exc:
+            return 2, 'Cannot resolve address "{0}": {1}'.format(address, exc), None
+        except PermissionError:
+            return 1, 'Native traceroute needs root privileges or CAP_NET_RAW capability.', None
+        except OSError as exc:
+            return 1, 'Native traceroute to address "{0}" failed: {1}'.format(address, exc), None
+        return 0, None, traceroute
+
+    async def _resolve_names(self, address, traceroute, output):
+        if traceroute is None:
+            try:
+                traceroute = trparse.loads(output)
+            except (trparse.ParseError, IndexError):
+                logger.debug('Cannot parse traceroute output for "{0}", hostnames will not be resolved.'.format(
+                    address))
+                return None
+        return await self.hostname_resolver.fill_names(traceroute)
+
+    async def probe(self, address: str):
+        """
+        Runs a traceroute to address, must be called from within the engine loop
+
+        :param address: (str) address
+        :return: (ProbeResult)
+        """
+        task = _current_task()
+        self._tasks.add(task)
+        traceroute = None
+        try:
+            if self._rate_limiter:
+                await self._rate_limiter.wait()
+            async with self._semaphore:
+                start_time = monotonic()
+                if self.backend == 'native':
+                    exit_code, output, traceroute = await self._native_probe(address)
+                else:
+                    exit_code, output = await self._os_probe(address)
+                duration = monotonic() - start_time
+
+            if exit_code == 0 and self.hostname_resolver:
+                traceroute = await self._resolve_names(address, traceroute, output)
+                if traceroute is not None:
+                    # Stored output gets rendered from the traceroute object, including hostnames
+                    output = None
+        finally:
+            self._tasks.discard(task)
+
+        if exit_code != 0:
+            logger.error(
+                'Traceroute to address: "{0}" failed with exit code {1}. Command output:'.format(address, exit_code))
+            logger.error(output)
+        return ProbeResult(address, exit_code, output, duration, traceroute=traceroute)
+
+    async def _probe_and_callback(self, address, callback):
+        result = await self.probe(address)
+        await self._loop.run_in_executor(self._callback_executor, self._run_callback, callback, result)
+        return result
+
+    def submit(self, address: str, callback=None):
+        """
+        Thread safe, non blocking probe submission
+
+        :param address: (str) address
+        :param callback: (callable) Optional function called with the ProbeResult, from the callback thread pool
+        :return: (concurrent.futures.Future) future that resolves to a ProbeResult once the callback has run,
+                 cancelling it kills the probe
+        """
+        if self._loop is None:
+            raise RuntimeError('Probe engine is not started')
+        if callback:
+            coroutine = self._probe_and_callback(address, callback)
+        else:
+            coroutine = self.probe(address)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    @staticmethod
+    def _run_callback(callback, result):
+        try:
+            callback(result)
+        except Exception:
+            logger.error('Probe callback for address "{0}" failed.'.format(result.address), exc_info=True)
+
+    async def _cancel_all(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return len(tasks)
+
+    def stop(self, timeout: int = 10):
+        """
+        Cancels all in-flight probes (killing their processes) and stops the engine loop
+        """
+        if self._loop is None:
+            return
+        try:
+            cancelled = asyncio.run_coroutine_threadsafe(self._cancel_all(), self._loop).result(timeout)
+            if cancelled:
+                logger.info('Cancelled {0} in-flight probes.'.format(cancelled))
+        except Exception:
+            logger.warning('Could not cancel all in-flight probes.', exc_info=True)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._callback_executor.shutdown(wait=True)
+        self._loop = None
+        self._thread = None
@@ -0,0 +1,356 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+probe_scheduler decides when targets get probed
+All recurring jobs (probes, housekeeping) live in a single deadline ordered heap, instead of one scheduler job
+object set per target
+In staggered mode, every target gets a deterministic phase within the interval, derived from its name, so probes are
+spread evenly over the interval instead of all firing at the same second
+Phases are anchored to wall clock time (unix epoch), so a target keeps its offset across restarts
+
+"""
+
+__intname__ = 'traceroute_history.probe_scheduler'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022051301'
+
+import math
+import heapq
+import hashlib
+import random
+import threading
+from time import monotonic, time
+from typing import Callable
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor
+
+logger = getLogger(__name__)
+
+# burst mode probes all targets at startup, then every interval at the same time
+SCHEDULING_MODES = ('staggered', 'burst')
+DEFAULT_SCHEDULING_MODE = 'staggered'
+
+
+def get_target_phase(name: str, interval: float):
+    """
+    Deterministic offset of a target within the interval, see get_first_due
+    The same target always gets the same phase, and phases of many targets are uniformly distributed
+
+    :param name: (str) target name
+    :param interval: (float) interval in seconds
+    :return: (float) offset in seconds, between 0 and interval
+    """
+    if interval <= 0:
+        return 0
+    digest = hashlib.sha1(name.encode('utf-8')).digest()
+    # Millisecond resolution so small intervals still spread well
+    return (int.from_bytes(digest[:8], 'big') % int(interval * 1000)) / 1000
+
+
+def get_first_due(name: str, interval: float, now: float = None):
+    """
+    Seconds until the next wall clock time whose offset within the interval (counted from the unix epoch) is the target
+    phase, so the target runs at the same offset whatever the process start time
+
+    :param now: (float) unix timestamp, defaults to current time
+    :return: (float) seconds, between 0 and interval
+    """
+    if interval <= 0:
+        return 0
+    if now is None:
+        now = time()
+    return (get_target_phase(name, interval) - now) % interval
+
+
+class ScheduledEntry(object):
+    """
+    A recurring job of the scheduler, lag values are in seconds
+    """
+    def __init__(self, key, function, interval, kwargs=None, priority=0, jitter=None):
+        self.key = key
+        self.function = function
+        self.kwargs = kwargs or {}
+        self.interval = interval
+        self.priority = priority
+        self.jitter = jitter
+        self.next_due = None
+        self.generation = 0
+        self.running = False
+        self.runs = 0
+        self.missed_deadlines = 0
+        self.last_lag = 0
+        self.max_lag = 0
+
+    def __repr__(self):
+        return 'ScheduledEntry {0}: interval={1}, priority={2}, runs={3}, missed={4}'.format(
+            self.key, self.interval, self.priority, self.runs, self.missed_deadlines)
+
+
+class ProbeScheduler(object):
+    """
+    Deadline driven scheduler keeping every entry in a single heap ordered by next due time slot, then priority
+    Adding, removing or rescheduling an entry and dispatching a run are all O(log n)
+
+    A single thread sleeps until the next deadline and hands due entries to a worker pool
+    Entries dispatched later than misfire_grace_time after their deadline count as missed deadlines, runs that
+    would pile up (scheduler lagging more than an interval, or previous run still going) are coalesced
+    clock returns the current time in seconds, deadlines and lags are computed with it
+    """
+    def __init__(self, max_workers: int = 4, misfire_grace_time: float = 1, resolution: float = 0.1,
+                 clock: Callable = monotonic):
+        self.max_workers = max_workers
+        self._clock = clock
+        self.resolution = resolution
+        self.misfire_grace_time = misfire_grace_time
+        self._heap = []
+        self._entries = {}
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._stopped = True
+        self.dispatched = 0
+        self.missed_deadlines = 0
+        self.total_lag = 0
+        self.max_lag = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _push(self, entry, delay: float = 0):
+        # Caller must hold the condition lock
+        # delay (eg jitter) only moves this dispatch, entry.next_due stays on the interval grid
+        entry.generation += 1
+        self._sequence += 1
+        dispatch_due = entry.next_due + delay
+        # Deadlines are grouped in slots of resolution seconds, so priorities apply between entries of a same slot
+        slot = math.ceil(dispatch_due / self.resolution)
+        heapq.heappush(self._heap, (slot, entry.priority, self._sequence, entry.key, entry.generation, dispatch_due))
+        # Drop stale heap items once they outnumber live entries
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [item for item in self._heap
+                          if item[3] in self._entries and self._entries[item[3]].generation == item[4]]
+            heapq.heapify(self._heap)
+        self._condition.notify()
+
+    def add(self, key, function, interval: float, kwargs: dict = None, first_due: float = 0, priority: int = 0,
+            jitter: float = None):
+        """
+        Adds (or replaces) a recurring entry
+
+        :param key: (str) unique entry key
+        :param function: (callable) function to run, called with kwargs
+        :param interval: (float) seconds between runs
+        :param kwargs: (dict) function keyword arguments
+        :param first_due: (float) seconds from now until first run
+        :param priority: (int) entries due at the same time run by ascending priority
+        :param jitter: (float) optional random delay added to each run, without shifting following deadlines
+        :return: (ScheduledEntry)
+        """
+        entry = ScheduledEntry(key, function, interval, kwargs=kwargs, priority=priority, jitter=jitter)
+        with self._condition:
+            previous_entry = self._entries.get(key)
+            if previous_entry:
+                entry.generation = previous_entry.generation
+            self._entries[key] = entry
+            entry.next_due = self._clock() + first_due
+            self._push(entry)
+        return entry
+
+    def remove(self, key):
+        with self._condition:
+            entry = self._entries.pop(key, None)
+            if entry:
+                # Heap item becomes stale and gets skipped
+                entry.generation += 1
+        return entry
+
+    def reschedule(self, key, interval: float = None, next_due: float = None):
+        """
+        Changes interval and / or next run time of an entry
+
+        :param interval: (float) new interval in seconds
+        :param next_due: (float) seconds from now until next run, defaults to one (new) interval after last deadline
+        """
+        with self._condition:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if interval is not None:
+                if next_due is None:
+                    # Keep the last deadline as reference, so shortening an interval applies right away
+                    entry.next_due = entry.next_due - entry.interval + interval
+                entry.interval = interval
+            if next_due is not None:
+                entry.next_due = self._clock() + next_due
+            self._push(entry)
+        return entry
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def get_entries(self):
+        with self._condition:
+            return list(self._entries.values())
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                'entries': len(self._entries),
+                'dispatched': self.dispatched,
+                'missed_deadlines': self.missed_deadlines,
+                'average_lag': self.total_lag / self.dispatched if self.dispatched else 0,
+                'max_lag': self.max_lag,
+                'next_due_in': self._heap[0][0] * self.resolution - self._clock() if self._heap else None
+            }
+
+    def start(self):
+        if not self._stopped:
+            return
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='probe_scheduler')
+        self._thread = threading.Thread(target=self._run, name='probe_scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, wait: bool = True):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    def _pop_due_entry(self):
+        """
+        Waits for the next due entry, returns (entry, dispatch deadline), or (None, None) when the scheduler is stopped
+        Caller must hold the condition lock
+        """
+        while not self._stopped:
+            if not self._heap:
+                self._condition.wait()
+                continue
+            slot, _, _, key, generation, dispatch_due = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is None or entry.generation != generation:
+                heapq.heappop(self._heap)
+                continue
+            delay = slot * self.resolution - self._clock()
+            if delay > 0:
+                self._condition.wait(delay)
+                continue
+            heapq.heappop(self._heap)
+            return entry, dispatch_due
+        return None, None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                entry, dispatch_due = self._pop_due_entry()
+                if entry is None:
+                    return
+                now = self._clock()
+                lag = now - dispatch_due
+                entry.last_lag = lag
+                entry.max_lag = max(entry.max_lag, lag)
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+                self.dispatched += 1
+                if lag > self.misfire_grace_time:
+                    entry.missed_deadlines += 1
+                    self.missed_deadlines += 1
+
+                if entry.running:
+                    logger.warning('Previous run of "{0}" still running, skipping this run.'.format(entry.key))
+                else:
+                    entry.running = True
+                    entry.runs += 1
+                    self._executor.submit(self._run_entry, entry)
+
+                # Fixed rate scheduling, coalescing runs that were missed entirely
+                entry.next_due += entry.interval
+                if entry.next_due <= now:
+                    entry.next_due = now + entry.interval - (now - entry.next_due) % entry.interval
+                self._push(entry, delay=random.uniform(0, entry.jitter) if entry.jitter else 0)
+
+    @staticmethod
+    def _run_entry(entry):
+        try:
+            entry.function(**entry.kwargs)
+        except Exception:
+            logger.error('Scheduled job "{0}" failed.'.format(entry.key), exc_info=True)
+        finally:
+            entry.running = False
+
+
+class AdaptiveIntervalController(object):
+    """
+    Adapts per-target probe intervals to path stability
+    A target whose path changed is probed every min_interval, while it flaps
+    After backoff_after consecutive unchanged probes, the interval is multiplied by backoff_factor, up to max_interval
+    Thread safe
+    """
+    def __init__(self, base_interval: int, min_interval: int, max_interval: int, backoff_factor: float = 2,
+                 backoff_after: int = 3):
+        self.base_interval = min(max(base_interval, min_interval), max_interval)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.backoff_after = backoff_after
+        self._intervals = {}
+        self._stable_counts = {}
+        self._lock = threading.Lock()
+
+    def _bound(self, interval):
+        return int(min(max(interval, self.min_interval), self.max_interval))
+
+    def seed(self, name: str, interval: int):
+        """
+        Restores a previously effective interval, eg after a restart
+        """
+        with self._lock:
+            self._intervals[name] = self._bound(interval)
+
+    def get_interval(self, name: str):
+        with self._lock:
+            return self._intervals.get(name, self.base_interval)
+
+    def get_intervals(self):
+        with self._lock:
+            return dict(self._intervals)
+
+    def update(self, name: str, changed: bool):
+        """
+        Feeds the result of a probe
+
+        :param name: (str) target name
+        :param changed: (bool) did the path (or rtt) change since previous probe
+        :return: (int) new interval, or None if it did not change
+        """
+        with self._lock:
+            interval = self._intervals.get(name, self.base_interval)
+            if changed:
+                self._stable_counts[name] = 0
+                new_interval = self.min_interval
+            else:
+                stable_count = self._stable_counts.get(name, 0) + 1
+                if stable_count >= self.backoff_after:
+                    new_interval = self._bound(interval * self.backoff_factor)
+                    stable_count = 0
+                else:
+                    new_interval = interval
+                self._stable_counts[name] = stable_count
+            self._intervals[name] = new_interval
+        return new_interval if new_interval != interval else None
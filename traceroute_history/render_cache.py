@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+render_cache keeps rendered traceroute diffs in memory, keyed by target, latest traceroute id and formatting
+Rendered output only changes when a new traceroute gets stored, which changes the key. Writers of the same process
+drop outdated entries right away through crud traceroute listeners, other processes (eg the web UI) notice new
+traceroutes through a version counter, being the highest traceroute id
+
+"""
+
+__intname__ = 'traceroute_history.render_cache'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022052101'
+
+import threading
+from collections import OrderedDict
+from logging import getLogger
+from sqlalchemy.orm import Session
+from traceroute_history import crud
+
+logger = getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+
+
+class RenderCache(object):
+    """
+    LRU cache of rendered strings, evicting least recently used entries once their total size exceeds max_size
+    Sizes are counted in characters, thread safe
+    """
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # Highest traceroute id seen, and latest traceroute id of targets that were looked up since
+        self._version = None
+        self._latest_ids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value: str):
+        if value is None or len(value) > self.max_size:
+            return
+        with self._lock:
+            previous_value = self._entries.pop(key, None)
+            if previous_value is not None:
+                self._size -= len(previous_value)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_size:
+                _, evicted_value = self._entries.popitem(last=False)
+                self._size -= len(evicted_value)
+
+    def get_or_render(self, key, render):
+        """
+        :param render: (callable) called without arguments to render the value on cache miss
+        """
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.put(key, value)
+        return value
+
+    def invalidate_target(self, target_id: int):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == target_id]:
+                self._size -= len(self._entries.pop(key))
+            self._latest_ids.pop(target_id, None)
+
+    def on_new_traceroute(self, target_id: int, traceroute_id: int):
+        """
+        crud traceroute listener, see crud.add_traceroute_listener
+        """
+        self.invalidate_target(target_id)
+        with self._lock:
+            self._latest_ids[target_id] = traceroute_id
+            if self._version is not None and traceroute_id > self._version:
+                self._version = traceroute_id
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._latest_ids.clear()
+            self._version = None
+
+    def get_latest_traceroute_id(self, db: Session, target_id: int):
+        """
+        Latest traceroute id of a target, only read from database when a traceroute was stored since last call, by
+        any process
+
+        :return: (int) traceroute id, None if target has no traceroute
+        """
+        version = crud.get_traceroute_version(db=db)
+        with self._lock:
+            if version != self._version:
+                self._latest_ids.clear()
+                self._version = version
+            elif target_id in self._latest_ids:
+                return self._latest_ids[target_id]
+        latest_id = crud.get_latest_traceroute_id(db=db, target_id=target_id)
+        with self._lock:
+            if self._version == version:
+                self._latest_ids[target_id] = latest_id
+        return latest_id
@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+resolver resolves hop addresses to hostnames after numeric probing
+Lookups are batched, run concurrently on the probe engine loop, and share a TTL / LRU cache (with negative caching)
+across all targets, so hops shared by many targets are only resolved once
+
+"""
+
+__intname__ = 'traceroute_history.resolver'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022051201'
+
+import asyncio
+import socket
+from time import monotonic
+from collections import OrderedDict
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_NEGATIVE_CACHE_TTL = 300
+DEFAULT_LOOKUP_TIMEOUT = 2
+DEFAULT_MAX_CONCURRENT_LOOKUPS = 32
+
+
+class HostnameResolver(object):
+    """
+    Asynchronous reverse DNS resolver with a shared cache
+
+    Successful lookups are kept cache_ttl seconds, failed or timed out lookups negative_cache_ttl seconds
+    The least recently used entries are evicted once cache_size is reached
+    Must be used from a single event loop
+    """
+    def __init__(self, cache_size: int = DEFAULT_CACHE_SIZE, cache_ttl: int = DEFAULT_CACHE_TTL,
+                 negative_cache_ttl: int = DEFAULT_NEGATIVE_CACHE_TTL, lookup_timeout: float = DEFAULT_LOOKUP_TIMEOUT,
+                 max_concurrent_lookups: int = DEFAULT_MAX_CONCURRENT_LOOKUPS):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.lookup_timeout = lookup_timeout
+        self.max_concurrent_lookups = max_concurrent_lookups
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._semaphore = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_cached(self, ip: str):
+        """
+        :return: (bool, str) found in cache, hostname (None on negative cache entries)
+        """
+        try:
+            name, expires = self._cache[ip]
+        except KeyError:
+            return False, None
+        if expires < monotonic():
+            del self._cache[ip]
+            return False, None
+        self._cache.move_to_end(ip)
+        return True, name
+
+    def _store(self, ip, name):
+        ttl = self.cache_ttl if name else self.negative_cache_ttl
+        self._cache[ip] = (name, monotonic() + ttl)
+        self._cache.move_to_end(ip)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _lookup(self, ip):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_lookups)
+        async with self._semaphore:
+            try:
+                name, _ = await asyncio.wait_for(
+                    asyncio.get_event_loop().getnameinfo((ip, 0), socket.NI_NAMEREQD), timeout=self.lookup_timeout)
+            except (socket.herror, socket.gaierror, asyncio.TimeoutError, OSError):
+                name = None
+        self._store(ip, name)
+        return name
+
+    async def resolve(self, ip: str):
+        found, name = self.get_cached(ip)
+        if found:
+            self.hits += 1
+            return name
+        self.misses += 1
+        # Concurrent requests for the same address share a single lookup
+        future = self._in_flight.get(ip)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup(ip))
+            self._in_flight[ip] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(ip, None))
+        return await asyncio.shield(future)
+
+    async def resolve_many(self, ips):
+        """
+        Resolves a batch of addresses concurrently
+
+        :param ips: (iterable)(str) IP addresses, duplicates are resolved once
+        :return: (dict) ip: hostname or None
+        """
+        unique_ips = list(OrderedDict.fromkeys(ip for ip in ips if ip))
+        names = await asyncio.gather(*[self.resolve(ip) for ip in unique_ips])
+        return dict(zip(unique_ips, names))
+
+    async def fill_names(self, traceroute):
+        """
+        Sets hostnames of all probes of a trparse.Traceroute object, unresolvable hops keep their IP as name
+        """
+        probes = [probe for hop in traceroute.hops for probe in hop.probes if probe.ip]
+        names = await self.resolve_many(probe.ip for probe in probes)
+        for probe in probes:
+            probe.name = names.get(probe.ip) or probe.ip
+        return traceroute
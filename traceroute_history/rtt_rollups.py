@@ -0,0 +1,177 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+rtt_rollups aggregates raw rtt series into hourly and daily statistics (min / max / mean / p95 / loss) per target and
+per hop, so long range charts read a few hundred rows instead of millions of samples
+Rollups are incremental, only buckets closed since the last run are computed, and every tier has its own retention
+Samples written late into closed buckets, eg replayed from the spool after an outage, mark the rollups of their target
+dirty from that bucket on, so the next run computes them again
+
+"""
+
+__intname__ = 'traceroute_history.rtt_rollups'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022052001'
+
+import math
+from time import time
+from logging import getLogger
+from sqlalchemy.orm import Session
+from traceroute_history import crud, models, rtt_series
+
+logger = getLogger(__name__)
+
+HOURLY = 3600
+DAILY = 86400
+RESOLUTIONS = (HOURLY, DAILY)
+# Seconds after the end of a bucket before it gets rolled up, so buffered samples have been flushed
+DEFAULT_GRACE = 300
+# Daily rollups are computed from raw series, which must hence be kept long enough
+MIN_RTT_SERIES_KEEP_DAYS = 2
+# Charts spanning more than this read daily rollups instead of hourly ones
+MAX_HOURLY_SPAN = 31 * DAILY
+
+
+def get_percentile(sorted_values, percentile: float):
+    """
+    Nearest rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(percentile / 100 * len(sorted_values)) - 1, 0)]
+
+
+def aggregate_samples(samples):
+    """
+    Computes statistics of a list of samples of a single hop
+
+    :param samples: (list)(rtt_series.RttSample)
+    :return: (dict) sample_count, rtt_min, rtt_max, rtt_mean, rtt_p95, loss
+    """
+    answered = [sample for sample in samples if sample.avg is not None]
+    averages = sorted(sample.avg for sample in answered)
+    return {
+        'sample_count': len(samples),
+        'rtt_min': min(sample.min for sample in answered) if answered else None,
+        'rtt_max': max(sample.max for sample in answered) if answered else None,
+        'rtt_mean': sum(averages) / len(averages) if averages else None,
+        'rtt_p95': get_percentile(averages, 95),
+        'loss': sum(sample.loss for sample in samples) / len(samples)
+    }
+
+
+def build_rollups(target_id: int, resolution: int, samples):
+    """
+    Groups samples by bucket and hop, target statistics (ttl 0) come from the last hop of every probe
+
+    :param samples: (list)(rtt_series.RttSample) samples ordered by time then ttl
+    :return: (list)(models.RttRollup)
+    """
+    buckets = {}
+    for sample in samples:
+        bucket_start = sample.timestamp - sample.timestamp % resolution
+        hops = buckets.setdefault(bucket_start, {})
+        hops.setdefault(sample.ttl, []).append(sample)
+        # Samples of a probe share their timestamp, the last one is the highest ttl
+        last_hops = hops.setdefault(0, [])
+        if last_hops and last_hops[-1].timestamp == sample.timestamp:
+            last_hops[-1] = sample
+        else:
+            last_hops.append(sample)
+
+    rollups = []
+    for bucket_start, hops in buckets.items():
+        for ttl, hop_samples in hops.items():
+            rollups.append(models.RttRollup(target_id=target_id, resolution=resolution, bucket_start=bucket_start,
+                                            ttl=ttl, **aggregate_samples(hop_samples)))
+    return rollups
+
+
+def mark_late_samples(db: Session, target_id: int, bucket_start: int, now: float = None, grace: int = DEFAULT_GRACE):
+    """
+    Marks rollups of a target dirty when samples were written to a raw series bucket which may already be rolled up,
+    does not commit
+    Meant as rtt_series.RttSeriesWriter on_write callback
+    """
+    if now is None:
+        now = time()
+    for resolution in RESOLUTIONS:
+        if bucket_start - bucket_start % resolution + resolution <= now - grace:
+            crud.mark_rtt_rollups_dirty(db=db, target_id=target_id, resolution=resolution, earliest=bucket_start)
+
+
+def roll_up(db: Session, resolution: int, now: float = None, grace: int = DEFAULT_GRACE):
+    """
+    Rolls up raw series of all targets into buckets of given resolution, from the last rolled up bucket of every target,
+    or from its earliest dirty bucket, up to the last closed bucket, then commits
+
+    :return: (int) number of created rollups
+    """
+    if now is None:
+        now = time()
+    end = int(now - grace) - int(now - grace) % resolution
+    last_buckets = crud.get_last_rtt_rollups(db=db, resolution=resolution)
+    dirty_rollups = crud.get_dirty_rtt_rollups(db=db, resolution=resolution)
+    count = 0
+    for target_id, first_bucket in crud.get_rtt_series_target_ids(db=db).items():
+        if target_id in last_buckets:
+            start = last_buckets[target_id] + resolution
+        else:
+            start = first_bucket - first_bucket % resolution
+        if target_id in dirty_rollups:
+            # Never go back before the first complete bucket still having raw series, older rollups would lose samples
+            first_complete_bucket = first_bucket + (-first_bucket) % resolution
+            dirty_start = dirty_rollups[target_id] - dirty_rollups[target_id] % resolution
+            start = min(start, max(dirty_start, first_complete_bucket))
+        if start >= end:
+            continue
+        samples = rtt_series.get_samples(db=db, target_id=target_id, start=start, end=end)
+        rollups = build_rollups(target_id, resolution, samples)
+        crud.replace_rtt_rollups(db=db, target_id=target_id, resolution=resolution, start=start, end=end,
+                                 rollups=rollups)
+        count += len(rollups)
+    # Dirty buckets not closed yet get rolled up like any other once they are
+    crud.clear_dirty_rtt_rollups(db=db, resolution=resolution, dirty_rollups=dirty_rollups)
+    db.commit()
+    return count
+
+
+def apply_retention(db: Session, rtt_series_keep_days: int = None, hourly_keep_days: int = None,
+                    daily_keep_days: int = None, now: float = None):
+    """
+    Deletes raw series and rollups older than their tier retention, then commits
+    A retention of None or 0 keeps data forever, raw series are kept at least MIN_RTT_SERIES_KEEP_DAYS
+
+    :return: (dict) number of deleted rows per tier
+    """
+    if now is None:
+        now = time()
+    deleted = {}
+    if rtt_series_keep_days:
+        keep_days = max(rtt_series_keep_days, MIN_RTT_SERIES_KEEP_DAYS)
+        deleted['raw'] = crud.delete_rtt_series(db=db, before=int(now - keep_days * DAILY))
+    if hourly_keep_days:
+        deleted['hourly'] = crud.delete_rtt_rollups(db=db, resolution=HOURLY, before=int(now - hourly_keep_days * DAILY))
+    if daily_keep_days:
+        deleted['daily'] = crud.delete_rtt_rollups(db=db, resolution=DAILY, before=int(now - daily_keep_days * DAILY))
+    db.commit()
+    return deleted
+
+
+def get_rollups(db: Session, target_id: int, start: float, end: float, ttl: int = 0):
+    """
+    Reads rollups of a target hop for a chart, with hourly resolution up to MAX_HOURLY_SPAN, daily resolution above
+
+    :param ttl: (int) hop, 0 for the target itself
+    :return: (list)(models.RttRollup)
+    """
+    resolution = HOURLY if end - start <= MAX_HOURLY_SPAN else DAILY
+    return crud.get_rtt_rollups(db=db, target_id=target_id, resolution=resolution,
+                                start=int(start) - int(start) % resolution, end=int(end), ttl=ttl)
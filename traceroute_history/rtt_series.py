@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+rtt_series records per hop rtt of every probe, whether the path changed or not
+Samples are packed into one binary blob per target and per hour, instead of one row per sample, and are buffered in
+memory so database writes happen in batches
+
+"""
+
+__intname__ = 'traceroute_history.rtt_series'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022051901'
+
+import struct
+import threading
+from time import time
+from typing import Callable, NamedTuple
+from logging import getLogger
+from sqlalchemy.orm import Session
+from traceroute_history import trparse, crud
+
+logger = getLogger(__name__)
+
+BUCKET_DURATION = 3600
+# Seconds within bucket, ttl, min / avg / max rtt in tenths of ms, loss percentage, 10 bytes per hop sample
+SAMPLE_STRUCT = struct.Struct('<HBHHHB')
+RTT_SCALE = 10
+# Stored rtt when no probe answered, higher rtts are capped just below
+NO_RTT = 0xFFFF
+DEFAULT_MAX_BUFFERED_SAMPLES = 10000
+
+
+class RttSample(NamedTuple):
+    timestamp: int
+    ttl: int
+    min: float
+    avg: float
+    max: float
+    loss: int
+
+
+def get_bucket_start(timestamp: float):
+    return int(timestamp) - int(timestamp) % BUCKET_DURATION
+
+
+def get_hop_stats(traceroute: trparse.Traceroute):
+    """
+    :return: (list)(tuple) (ttl, min, avg, max, loss percentage) of every hop, rtts are None when no probe answered
+    """
+    stats = []
+    for hop in traceroute.hops:
+        rtts = [float(probe.rtt) for probe in hop.probes if probe.rtt is not None]
+        loss = round(100 * (len(hop.probes) - len(rtts)) / len(hop.probes)) if hop.probes else 100
+        if rtts:
+            stats.append((hop.idx, min(rtts), sum(rtts) / len(rtts), max(rtts), loss))
+        else:
+            stats.append((hop.idx, None, None, None, loss))
+    return stats
+
+
+def _pack_rtt(rtt):
+    if rtt is None:
+        return NO_RTT
+    return min(int(round(rtt * RTT_SCALE)), NO_RTT - 1)
+
+
+def _unpack_rtt(rtt):
+    if rtt == NO_RTT:
+        return None
+    return rtt / RTT_SCALE
+
+
+def pack_samples(bucket_start: int, timestamp: float, traceroute: trparse.Traceroute):
+    """
+    :return: (bytes) packed samples of all hops of traceroute
+    """
+    offset = int(timestamp) - bucket_start
+    data = bytearray()
+    for ttl, rtt_min, rtt_avg, rtt_max, loss in get_hop_stats(traceroute):
+        data += SAMPLE_STRUCT.pack(offset, min(ttl, 255), _pack_rtt(rtt_min), _pack_rtt(rtt_avg), _pack_rtt(rtt_max),
+                                   loss)
+    return bytes(data)
+
+
+def unpack_samples(bucket_start: int, data: bytes):
+    """
+    :return: (list)(RttSample) samples of a bucket, rtts in ms with 0.1ms precision, None when no probe answered
+    """
+    samples = []
+    for offset, ttl, rtt_min, rtt_avg, rtt_max, loss in SAMPLE_STRUCT.iter_unpack(data):
+        samples.append(RttSample(bucket_start + offset, ttl, _unpack_rtt(rtt_min), _unpack_rtt(rtt_avg),
+                                 _unpack_rtt(rtt_max), loss))
+    return samples
+
+
+class RttSeriesWriter(object):
+    """
+    Buffers packed samples per (target, bucket) until flush(), thread safe
+    flush() should be called regularly, it is called automatically once max_buffered_samples are waiting
+    on_write(db=, target_id=, bucket_start=) is called for every written bucket, within the flush transaction
+    """
+    def __init__(self, max_buffered_samples: int = DEFAULT_MAX_BUFFERED_SAMPLES, on_write: Callable = None):
+        self.max_buffered_samples = max_buffered_samples
+        self.on_write = on_write
+        self._buffer = {}
+        self._buffered_samples = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.flushed_samples = 0
+
+    @property
+    def buffered_samples(self):
+        return self._buffered_samples
+
+    def record(self, target_id: int, traceroute: trparse.Traceroute, timestamp: float = None):
+        """
+        Records rtt of every hop of traceroute
+
+        :return: (bool) True if the buffer is full and should be flushed
+        """
+        if timestamp is None:
+            timestamp = time()
+        bucket_start = get_bucket_start(timestamp)
+        data = pack_samples(bucket_start, timestamp, traceroute)
+        with self._lock:
+            self._buffer.setdefault((target_id, bucket_start), bytearray()).extend(data)
+            self._buffered_samples += len(data) // SAMPLE_STRUCT.size
+            return self._buffered_samples >= self.max_buffered_samples
+
+    def flush(self, db: Session):
+        """
+        Appends buffered samples to their bucket rows, in a single transaction
+
+        :return: (int) number of written samples
+        """
+        with self._flush_lock:
+            with self._lock:
+                buffer = self._buffer
+                samples = self._buffered_samples
+                self._buffer = {}
+                self._buffered_samples = 0
+            if not buffer:
+                return 0
+            try:
+                for (target_id, bucket_start), data in buffer.items():
+                    crud.append_rtt_series(db=db, target_id=target_id, bucket_start=bucket_start, data=bytes(data),
+                                           sample_count=len(data) // SAMPLE_STRUCT.size)
+                    if self.on_write:
+                        self.on_write(db=db, target_id=target_id, bucket_start=bucket_start)
+                db.commit()
+            except Exception:
+                db.rollback()
+                # Keep samples for next flush
+                with self._lock:
+                    for key, data in buffer.items():
+                        self._buffer[key] = data + self._buffer.get(key, bytearray())
+                    self._buffered_samples += samples
+                raise
+            self.flushed_samples += samples
+            logger.debug('Flushed {0} rtt samples of {1} series.'.format(samples, len(buffer)))
+            return samples
+
+
+def get_samples(db: Session, target_id: int, start: float = None, end: float = None, ttl: int = None):
+    """
+    Reads rtt samples of a target
+
+    :param start: (float) optional unix timestamp of first sample
+    :param end: (float) optional unix timestamp after last sample
+    :param ttl: (int) optional hop
+    :return: (list)(RttSample) samples ordered by time then ttl
+    """
+    samples = []
+    for series in crud.get_rtt_series(db=db, target_id=target_id,
+                                      start=get_bucket_start(start) if start is not None else None, end=end):
+        for sample in unpack_samples(series.bucket_start, series.data):
+            if start is not None and sample.timestamp < start:
+                continue
+            if end is not None and sample.timestamp >= end:
+                continue
+            if ttl is not None and sample.ttl != ttl:
+                continue
+            samples.append(sample)
+    return samples
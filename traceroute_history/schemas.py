@@ -77,6 +77,7 @@ class TargetCreate(TargetBase):
 
 class Target(TargetBase):
     id: int
+    probe_interval: Optional[int] = Field(None, description='Effective probe interval in seconds, when using adaptive intervals')
     creation_date: datetime.datetime = Field(None, description='Creation date, is set automagically')
     update_date: datetime.datetime = Field(None, description='Record update date, is set automagically')
 
@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+spool keeps probe results on local disk while the database is unavailable, so they can be replayed once it is back
+Records are appended to a single file, each being a length, crc32 and timestamp header followed by a JSON payload
+Appends are fsynced in batches, a torn record at the end of the file (eg after a crash) is detected by its crc and
+dropped on next open
+The replay offset lives in a separate file, replaced atomically and only moved once records are committed to database,
+so records are replayed at least once
+Records are replayed in timestamp order, which may differ from spool order, so the offset file also lists records past
+the offset that were already replayed, they are skipped by later replays
+
+"""
+
+__intname__ = 'traceroute_history.spool'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022052601'
+
+import os
+import json
+import mmap
+import zlib
+import struct
+import threading
+from time import monotonic
+from typing import NamedTuple
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Payload length, crc32 of timestamp and payload, unix timestamp
+RECORD_HEADER = struct.Struct('<IId')
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+# Appends are fsynced once this many records are waiting, or after sync_interval seconds
+DEFAULT_SYNC_RECORDS = 100
+DEFAULT_SYNC_INTERVAL = 1
+
+
+class SpoolRecord(NamedTuple):
+    timestamp: float
+    record: dict
+    # Position of the record in spool file
+    start: int
+
+
+def pack_record(timestamp: float, payload: bytes):
+    packed_timestamp = struct.pack('<d', timestamp)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(packed_timestamp + payload), timestamp) + payload
+
+
+def get_replayed_offset(remaining_records, end: int):
+    """
+    Replay offset once all records but remaining_records are stored
+    Records are replayed in timestamp order which may differ from spool order, the offset stops at the first remaining
+    record in spool order
+
+    :param remaining_records: (list)(SpoolRecord) records not stored yet
+    :param end: (int) offset returned by Spool.read_pending()
+    """
+    if not remaining_records:
+        return end
+    return min(record.start for record in remaining_records)
+
+
+def scan_records(data, offset: int = 0):
+    """
+    Reads records from offset up to the end of data, or up to the first torn or corrupted record
+
+    :param data: (bytes-like) spool content, eg an mmap
+    :return: (list, int) (timestamp, payload, start offset) records, offset right after the last valid record
+    """
+    records = []
+    size = len(data)
+    while offset + RECORD_HEADER.size <= size:
+        length, crc, timestamp = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > size:
+            break
+        payload = bytes(data[offset + RECORD_HEADER.size:end])
+        if zlib.crc32(struct.pack('<d', timestamp) + payload) != crc:
+            break
+        records.append((timestamp, payload, offset))
+        offset = end
+    return records, offset
+
+
+class Spool(object):
+    """
+    Append only spool file of JSON records, with bounded size, thread safe
+    Records that would make the file grow above max_size are dropped
+    """
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE, sync_records: int = DEFAULT_SYNC_RECORDS,
+                 sync_interval: float = DEFAULT_SYNC_INTERVAL):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.max_size = max_size
+        self.sync_records = sync_records
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._fd = None
+        self._size = 0
+        self._offset = 0
+        # Start of records past _offset that were already replayed
+        self._delivered = set()
+        self._pending = 0
+        self._unsynced = 0
+        self._last_sync = monotonic()
+        self.appended = 0
+        self.replayed = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._pending
+
+    @property
+    def size(self):
+        return self._size
+
+    def open(self):
+        """
+        Opens (or creates) the spool, drops a torn record left at the end of the file
+        """
+        with self._lock:
+            if self._fd is not None:
+                return
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o600)
+            size = os.fstat(self._fd).st_size
+            offset, delivered = self._read_offset()
+            if offset > size:
+                # Spool got truncated after a full replay, before the offset was reset
+                offset, delivered = 0, set()
+            records, end = self._scan(offset, size)
+            if end < size:
+                logger.warning('Dropping {0} bytes of torn or corrupted records at the end of spool "{1}".'.format(
+                    size - end, self.path))
+                os.ftruncate(self._fd, end)
+                os.fsync(self._fd)
+            self._size = end
+            self._offset = offset
+            self._delivered = delivered & {start for _, _, start in records}
+            self._pending = len(records) - len(self._delivered)
+            os.lseek(self._fd, 0, os.SEEK_END)
+            if self._pending:
+                logger.info('Spool "{0}" has {1} records waiting for replay.'.format(self.path, self._pending))
+
+    def close(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_offset(self):
+        """
+        :return: (int, set) replay offset, start of records past the offset that were already replayed
+        """
+        try:
+            with open(self.offset_path, 'r') as file_handle:
+                # Offset on first line, delivered record starts on the second one
+                lines = file_handle.read().split('\n')
+            offset = int(lines[0].strip() or 0)
+            delivered = {int(start) for start in lines[1].split()} if len(lines) > 1 else set()
+            return offset, delivered
+        except FileNotFoundError:
+            return 0, set()
+        except ValueError:
+            logger.error('Bogus spool offset file "{0}", replaying whole spool.'.format(self.offset_path))
+            return 0, set()
+
+    def _write_offset(self, offset: int, delivered=()):
+        temp_path = self.offset_path + '.tmp'
+        with open(temp_path, 'w') as file_handle:
+            file_handle.write('{0}\n{1}'.format(offset, ' '.join(str(start) for start in sorted(delivered))))
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+        os.replace(temp_path, self.offset_path)
+
+    def _scan(self, offset: int, size: int):
+        # Caller must hold the lock
+        if size <= offset:
+            return [], offset
+        with mmap.mmap(self._fd, size, access=mmap.ACCESS_READ) as data:
+            return scan_records(data, offset)
+
+    def append(self, record: dict, timestamp: float):
+        """
+        :param record: (dict) JSON serializable record
+        :return: (bool) False if the record was dropped because the spool is full
+        """
+        data = pack_record(timestamp, json.dumps(record).encode('utf-8'))
+        with self._lock:
+            if self._fd is None:
+                raise RuntimeError('Spool "{0}" is not open'.format(self.path))
+            if self._size + len(data) > self.max_size:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 1000 == 0:
+                    logger.error('Spool "{0}" is full, dropped {1} records so far.'.format(self.path, self.dropped))
+                return False
+            os.write(self._fd, data)
+            self._size += len(data)
+            self._pending += 1
+            self._unsynced += 1
+            self.appended += 1
+            if self._unsynced >= self.sync_records or monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+        return True
+
+    def _sync(self):
+        # Caller must hold the lock
+        if self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+        self._last_sync = monotonic()
+
+    def sync(self):
+        with self._lock:
+            if self._fd is not None:
+                self._sync()
+
+    def read_pending(self):
+        """
+        :return: (list, int) SpoolRecord of records waiting for replay sorted by timestamp, and the offset to pass to
+                 commit() once they are stored, see get_replayed_offset()
+        """
+        with self._lock:
+            if self._fd is None:
+                raise RuntimeError('Spool "{0}" is not open'.format(self.path))
+            records, end = self._scan(self._offset, self._size)
+            delivered = set(self._delivered)
+        # Stable sort, records of a same timestamp keep their spool order
+        return sorted([SpoolRecord(timestamp, json.loads(payload.decode('utf-8')), start)
+                       for timestamp, payload, start in records if start not in delivered],
+                      key=lambda record: record.timestamp), end
+
+    def commit(self, offset: int, delivered=()):
+        """
+        Marks records up to offset as replayed, the spool file is emptied once everything got replayed
+
+        :param delivered: (iterable)(int) start of replayed records, those past offset are skipped by later replays
+        """
+        with self._lock:
+            offset = max(offset, self._offset)
+            records, _ = self._scan(self._offset, offset)
+            newly_delivered = {start for _, _, start in records if start not in self._delivered}
+            beyond_offset = {start for start in delivered if start >= offset} - self._delivered
+            if offset == self._offset and not beyond_offset:
+                return
+            self._pending -= len(newly_delivered) + len(beyond_offset)
+            self.replayed += len(newly_delivered) + len(beyond_offset)
+            self._delivered = {start for start in self._delivered if start >= offset} | beyond_offset
+            if offset >= self._size:
+                # Truncate first, an offset beyond the end of file is reset on next open
+                os.ftruncate(self._fd, 0)
+                os.fsync(self._fd)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                self._size = 0
+                offset = 0
+                self._unsynced = 0
+                self._delivered = set()
+            self._write_offset(offset, self._delivered)
+            self._offset = offset
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'pending': self._pending,
+                'size': self._size,
+                'appended': self.appended,
+                'replayed': self.replayed,
+                'dropped': self.dropped
+            }
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+traceroute_history is a quick tool to make traceroute / tracert calls, and store it's results into a database if it
+differs from last call.
+
+traceroute_cache keeps the last stored traceroute of every target in memory, already parsed, so comparing a new probe
+with the previous one needs neither a database read nor parsing the previous raw output again
+
+"""
+
+__intname__ = 'traceroute_history.traceroute_cache'
+__author__ = 'Orsiris de Jong'
+__copyright__ = 'Copyright (C) 2020-2022 Orsiris de Jong'
+__licence__ = 'BSD 3 Clause'
+__version__ = '0.1.0'
+__build__ = '2022051601'
+
+import threading
+from typing import NamedTuple, Optional
+from logging import getLogger
+from sqlalchemy.orm import Session
+from traceroute_history import trparse, crud, paths
+
+logger = getLogger(__name__)
+
+
+def parse_traceroute(raw_traceroute: str):
+    """
+    :return: (trparse.Traceroute) parsed traceroute, or None if raw_traceroute is not parseable (eg failed probe)
+    """
+    try:
+        return trparse.loads(raw_traceroute)
+    except (trparse.ParseError, IndexError, TypeError, AttributeError):
+        return None
+
+
+class LastTraceroute(NamedTuple):
+    """
+    Last stored traceroute of a target
+    traceroute_id is None when the target has no traceroute yet, traceroute is None when it is not parseable
+    """
+    target_id: int
+    traceroute_id: Optional[int] = None
+    traceroute: Optional[trparse.Traceroute] = None
+    path_hash: Optional[str] = None
+
+
+class LastTracerouteCache(object):
+    """
+    Target name indexed LastTraceroute entries, thread safe
+    Must be updated by whoever stores a traceroute, see store()
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get(self, name: str):
+        return self._entries.get(name)
+
+    def store(self, name: str, target_id: int, traceroute_id: int = None,
+              traceroute: trparse.Traceroute = None, path_hash: str = None):
+        if path_hash is None:
+            path_hash = paths.get_path_hash(traceroute)
+        entry = LastTraceroute(target_id=target_id, traceroute_id=traceroute_id, traceroute=traceroute,
+                               path_hash=path_hash)
+        with self._lock:
+            previous_entry = self._entries.get(name)
+            # Never go back to an older traceroute, eg when a slow database read races with a write
+            if previous_entry and previous_entry.traceroute_id and traceroute_id \
+                    and previous_entry.traceroute_id > traceroute_id:
+                return previous_entry
+            self._entries[name] = entry
+        return entry
+
+    def remove(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def warm(self, db: Session):
+        """
+        Loads last traceroute of all targets, with their hops, in a few bulk queries
+
+        :return: (int) number of cached targets
+        """
+        count = 0
+        for target, traceroute in crud.get_last_traceroute_per_target(db=db):
+            if traceroute:
+                # Built from stored hops, no parsing needed
+                self.store(target.name, target.id, traceroute.id, traceroute.to_trparse(), traceroute.path_hash)
+            else:
+                self.store(target.name, target.id)
+            count += 1
+        logger.debug('Cached last traceroute of {0} targets.'.format(count))
+        return count
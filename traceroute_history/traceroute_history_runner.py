@@ -21,17 +21,23 @@ import os
 import sys
 import getopt
 import ofunctions.logger_utils
-from apscheduler.schedulers.background import BackgroundScheduler
-from time import sleep
+from time import sleep, time
 from sqlalchemy import and_
 import sqlalchemy.exc
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import Future, wait as wait_futures
 from command_runner import command_runner
+import io
+import csv
 import json
+import base64
+import binascii
 from decimal import Decimal
-from traceroute_history import config_management, trparse, schemas, models, crud
+from traceroute_history import config_management, trparse, schemas, models, crud, probe_engine, \
+    native_traceroute, resolver, probe_scheduler, traceroute_cache, paths, rtt_series, rtt_rollups, render_cache, \
+    ingest_queue, spool
 from pydantic import ValidationError
-from traceroute_history.database import load_database, db_scoped_session
+from traceroute_history.database import load_database, db_scoped_session, db_session, run_write
 
 # colorama is not mandatory
 try:
@@ -42,8 +48,21 @@ except ImportError:
     pass
 
 CONFIG_FILE = 'traceroute_history.conf'
+CONFIG_SERVICE = None
+# Last stored traceroute of every target, see warm_last_traceroutes
+LAST_TRACEROUTES = traceroute_cache.LastTracerouteCache()
+# Rtt samples of every probe, waiting to be written, see flush_rtt_series
+RTT_SERIES = rtt_series.RttSeriesWriter(on_write=rtt_rollups.mark_late_samples)
+# Rendered traceroute diffs, outdated as soon as a traceroute gets stored, see get_target_diff
+RENDER_CACHE = render_cache.RenderCache()
+crud.add_traceroute_listener(lambda target_id, traceroute_id: RENDER_CACHE.on_new_traceroute(target_id, traceroute_id))
+# Write-behind queue of probe results, set up by execute(), see submit_traceroute_update
+INGEST_QUEUE = None
+# Probe results waiting for the database to be available again, set up by execute(), see replay_spool
+SPOOL = None
 
 LOG_FILE = os.path.join(os.path.dirname(__file__), os.path.splitext(os.path.basename(__file__))[0]) + '.log'
+SPOOL_FILE = os.path.join(os.path.dirname(__file__), 'traceroute_history.spool')
 logger = ofunctions.logger_utils.logger_get_logger(log_file=LOG_FILE)
 
 
@@ -85,23 +104,29 @@ def format_string(string: str, formatting: str='console'):
         return string
 
 
+def _load_traceroute(traceroute):
+    if isinstance(traceroute, trparse.Traceroute):
+        return traceroute
+    return trparse.loads(traceroute)
+
+
 def analyze_traceroutes(current_tr: str, previous_tr: str, rtt_detection_threshold: int=0):
     """
     Analyses two traceroutes for diffent hops, also checks for rtt increase
     Returns list of different hops and increased rtt times
 
-    :param current_tr: (str) raw traceroute output
-    :param previous_tr: (str) raw traceroute output
+    :param current_tr: (str) raw traceroute output, or already parsed trparse.Traceroute object
+    :param previous_tr: (str) raw traceroute output, or already parsed trparse.Traceroute object
     :return: (list) list of different indexes, or where rtt difference is higher than detection threshold
     """
     try:
-        current_tr_object = trparse.loads(current_tr)
+        current_tr_object = _load_traceroute(current_tr)
     except trparse.InvalidHeader:
         logger.warning('Cannot parse current tr')
         return None, None
 
     try:
-        previous_tr_object = trparse.loads(previous_tr)
+        previous_tr_object = _load_traceroute(previous_tr)
     except trparse.InvalidHeader:
         logger.warning('Cannot parse previous tr')
         return None, None
@@ -148,15 +173,11 @@ def traceroutes_difference_preformatted(tr1: models.Traceroute, tr2: models.Trac
     :return: (str) diff colorred traceroute outputs
     """
 
-    try:
-        config = config_management.load_config(CONFIG_FILE)
-        rtt_detection_threshold = int(config['TRACEROUTE_HISTORY']['rtt_detection_threshold'])
-    except KeyError:
-        rtt_detection_threshold = 0
-    except TypeError:
-        logger.warning('Bogus rtt_detection_threshold value.')
-        rtt_detection_threshold = 0
-    different_hops, increased_rtt = analyze_traceroutes(tr1.raw_traceroute, tr2.raw_traceroute, rtt_detection_threshold=rtt_detection_threshold)
+    rtt_detection_threshold = get_config_service().get().rtt_detection_threshold
+    # Stored hops spare parsing, traceroutes without hops are parsed from their raw output
+    different_hops, increased_rtt = analyze_traceroutes(tr1.to_trparse() or tr1.raw_traceroute,
+                                                        tr2.to_trparse() or tr2.raw_traceroute,
+                                                        rtt_detection_threshold=rtt_detection_threshold)
 
 
 
@@ -188,22 +209,14 @@ def traceroutes_difference_preformatted(tr1: models.Traceroute, tr2: models.Trac
 
 def os_traceroute(address):
     """
-    Launches actuel traceroute binary
+    Launches actuel traceroute binary synchronously, without any shell
 
     :param address: (str) address
     :return: (str) raw traceroute output
     """
     if address:
-        if os.name == 'nt':
-            executable = 'tracert'
-            # Ugly hack se we get actual characters encoding right from cmd.exe
-            # Also encodes "well" cp850 using cp437 parameter
-            encoding = 'cp437'
-        else:
-            executable = 'traceroute'
-            encoding = 'utf-8'
-        command = '{0} {1}'.format(executable, address)
-        exit_code, output = command_runner(command, shell=True, encoding=encoding)
+        command, encoding = probe_engine.get_traceroute_command(address)
+        exit_code, output = command_runner(command, shell=False, encoding=encoding)
         if exit_code != 0:
             logger.error(
                 'Traceroute to address: "{0}" failed with exit code {1}. Command output:'.format(address, exit_code))
@@ -212,74 +225,335 @@ def os_traceroute(address):
     return 1, 'Bogus address given.'
 
 
-def update_traceroute_database(target: schemas.TargetCreate):
+def compress_history():
     """
-    Executes tracert for given name, and updates database accordingly
-
-    :param target_name: (str) target user friendly name (can be anything)
-    :param address: (str) hostname in fqdn, ipv4 or ipv6 format
-    :param groups: (list)(str) list of groups to which this target belongs
-    :return:
+    Compresses raw output of traceroutes stored by previous versions
     """
+    count = run_write(crud.compress_raw_traceroutes)
+    logger.info('Compressed {0} traceroutes.'.format(count))
+    if count:
+        logger.info('Disk space is only given back after database maintenance (eg VACUUM with sqlite, OPTIMIZE TABLE with mysql).')
+    return count
 
-    config = config_management.load_config(CONFIG_FILE)
 
+def warm_last_traceroutes():
+    """
+    Loads the last traceroute of all targets into LAST_TRACEROUTES with a single query
+    """
     with db_scoped_session() as db:
         try:
-            # Create groups if not exist
-            tgt_groups = []
-            if target.groups:
-                for group in target.groups:
-                    grp = crud.get_group(db=db, name=group.name)
-                    if not grp:
-                        grp = crud.create_group(db=db, group=group)
-                        logger.info('Created new group "{0}".'.format(group.name))
-                    tgt_groups.append(grp)
-
-            # Create targets if not exist
-            tgt = crud.get_target(db=db, name=target.name)
-            if not tgt:
-                target.groups = tgt_groups
-                target = crud.create_target(db=db, target=target)
-                logger.info('Created new target "{0}".'.format(target.name))
-            else:
-                target = tgt
-
-            # Get traceroute
-            exit_code, raw_traceroute = os_traceroute(target.address)
-            if exit_code == 0:
-                previous_traceroute = crud.get_traceroutes_by_target(db=db, target_name=target.name, limit=1)
-                if previous_traceroute:
-                    try:
-                        rtt_detection_threshold = int(config['TRACEROUTE_HISTORY']['rtt_detection_threshold'])
-                    except KeyError:
-                        rtt_detection_threshold = 0
-                    except TypeError:
-                        logger.warning('Bogus rtt_detection_threshold value.')
-                        rtt_detection_threshold = 0
-                    different_hops, increased_rtt = analyze_traceroutes(raw_traceroute, previous_traceroute[0].raw_traceroute, rtt_detection_threshold=rtt_detection_threshold)
-                    # Special case where previous traceroute is failed (traceroute binary missing) or unparseable
-                    if different_hops == None and increased_rtt == None:
-                        current_traceroute = schemas.TracerouteCreate(raw_traceroute=raw_traceroute)
-                        crud.create_target_traceroute(db=db, traceroute=current_traceroute, target_id=target.id)
-                        logger.info('Created traceroute for target "{0}" since previous traceroute is unparseable.'.format(target.name))
-                    elif different_hops or increased_rtt:
-                        current_traceroute = schemas.TracerouteCreate(raw_traceroute=raw_traceroute)
-                        crud.create_target_traceroute(db=db, traceroute=current_traceroute, target_id=target.id)
-                        logger.info('Updating traceroute for target "{0}".'.format(target.name))
-                    else:
-                        logger.debug('Current traceroute is identical to previous one for target "{0}". Nothing to do.'.format(target.name))
+            count = LAST_TRACEROUTES.warm(db=db)
+            logger.info('Loaded last traceroute of {0} targets.'.format(count))
+        except sqlalchemy.exc.OperationalError as exc:
+            logger.error('Cannot load last traceroutes, they will be read on first probe: {0}.'.format(exc))
+
+
+def _load_last_traceroute(db, target: schemas.TargetCreate):
+    """
+    Creates target and its groups if they don't exist, and caches its last traceroute
+
+    :return: (LastTraceroute)
+    """
+    # Create groups if not exist
+    tgt_groups = []
+    if target.groups:
+        for group in target.groups:
+            grp = crud.get_group(db=db, name=group.name)
+            if not grp:
+                grp = crud.create_group(db=db, group=group, commit=False)
+                logger.info('Created new group "{0}".'.format(group.name))
+            tgt_groups.append(grp)
+
+    # Create targets if not exist
+    tgt = crud.get_target(db=db, name=target.name)
+    if not tgt:
+        new_target = target.copy()
+        new_target.groups = tgt_groups
+        tgt = crud.create_target(db=db, target=new_target, commit=False)
+        logger.info('Created new target "{0}".'.format(tgt.name))
+
+    previous_traceroute = crud.get_traceroutes_by_target(db=db, target_id=tgt.id, limit=1)
+    if previous_traceroute:
+        return LAST_TRACEROUTES.store(target.name, tgt.id, previous_traceroute[0].id,
+                                      previous_traceroute[0].to_trparse(), previous_traceroute[0].path_hash)
+    return LAST_TRACEROUTES.store(target.name, tgt.id)
+
+
+def _get_update_job(target: schemas.TargetCreate, probe_result: probe_engine.ProbeResult, creation_date=None,
+                    on_changed=None):
+    """
+    :param creation_date: (datetime) optional UTC creation date of stored traceroute, eg when replaying the spool
+    :param on_changed: (callable) optional, called with db and changed within the job when the probe succeeded
+    :return: (tuple) ingest job comparing the traceroute to the last stored one of target and storing it if it
+             differs, and the parsed traceroute (None if not parseable)
+    """
+    rtt_detection_threshold = get_config_service().get().rtt_detection_threshold
+    exit_code = probe_result.exit_code
+    current_traceroute = None
+    if exit_code == 0:
+        # Native probes are already parsed, previous traceroute is already parsed in cache
+        current_traceroute = probe_result.traceroute or traceroute_cache.parse_traceroute(probe_result.output)
+
+    def _update(db):
+        """
+        Runs in the batch transaction, crud functions must not commit
+
+        :return: (tuple) changed, target_id
+        """
+        changed = None
+        last_traceroute = LAST_TRACEROUTES.get(target.name)
+        if last_traceroute is None:
+            # Unknown target, or cache not warmed
+            last_traceroute = _load_last_traceroute(db, target)
+
+        def _store_traceroute(traceroute=None):
+            current_traceroute = schemas.TracerouteCreate(raw_traceroute=probe_result.output)
+            db_traceroute = crud.create_target_traceroute(db=db, traceroute=current_traceroute,
+                                                          target_id=last_traceroute.target_id,
+                                                          parsed_traceroute=traceroute, creation_date=creation_date,
+                                                          commit=False)
+            LAST_TRACEROUTES.store(target.name, last_traceroute.target_id, db_traceroute.id, traceroute,
+                                   db_traceroute.path_hash)
+
+        if exit_code == 0:
+            if last_traceroute.traceroute_id is not None:
+                # Special case where previous traceroute is failed (traceroute binary missing) or unparseable
+                if current_traceroute is None or last_traceroute.traceroute is None:
+                    _store_traceroute(current_traceroute)
+                    logger.info('Created traceroute for target "{0}" since previous traceroute is unparseable.'.format(target.name))
+                    changed = True
+                # Path changes are a hash compare, hops only need comparing for rtt checks
+                elif paths.get_path_hash(current_traceroute) != last_traceroute.path_hash:
+                    _store_traceroute(current_traceroute)
+                    logger.info('Updating traceroute for target "{0}", path changed.'.format(target.name))
+                    changed = True
+                elif rtt_detection_threshold and analyze_traceroutes(current_traceroute, last_traceroute.traceroute, rtt_detection_threshold=rtt_detection_threshold)[1]:
+                    _store_traceroute(current_traceroute)
+                    logger.info('Updating traceroute for target "{0}", rtt increased.'.format(target.name))
+                    changed = True
                 else:
-                    current_traceroute = schemas.TracerouteCreate(raw_traceroute=raw_traceroute)
-                    crud.create_target_traceroute(db=db, traceroute=current_traceroute, target_id=target.id)
-                    logger.info('Created traceroute for target "{0}".'.format(target.name))
+                    logger.debug('Current traceroute is identical to previous one for target "{0}". Nothing to do.'.format(target.name))
+                    changed = False
             else:
-                logger.error('Cannot get traceroute for target "{0}".'.format(target.name))
-                current_traceroute = schemas.TracerouteCreate(raw_traceroute=raw_traceroute)
-                crud.create_target_traceroute(db=db, traceroute=current_traceroute, target_id=target.id)
+                _store_traceroute(current_traceroute)
+                logger.info('Created traceroute for target "{0}".'.format(target.name))
+                # Nothing to compare against yet
+                changed = False
+        else:
+            logger.error('Cannot get traceroute for target "{0}".'.format(target.name))
+            _store_traceroute()
+        if on_changed is not None and changed is not None:
+            on_changed(db, changed)
+        return changed, last_traceroute.target_id
+
+    return _update, current_traceroute
+
+
+def _record_rtt_series(target_id: int, traceroute: trparse.Traceroute, timestamp: float):
+    # Rtt history is kept for every probe, even when the traceroute itself is not stored
+    if traceroute is not None and RTT_SERIES.record(target_id, traceroute, timestamp=timestamp):
+        flush_rtt_series()
+
+
+def _spool_probe_result(target: schemas.TargetCreate, probe_result: probe_engine.ProbeResult, timestamp: float):
+    """
+    Keeps a probe result in SPOOL until the database can be written again
+
+    :return: (bool) True if spooled
+    """
+    if SPOOL is None:
+        return False
+    record = {
+        'target': {'name': target.name, 'address': str(target.address),
+                   'groups': [group.name for group in target.groups or []]},
+        'exit_code': probe_result.exit_code,
+        'output': probe_result.output
+    }
+    try:
+        return SPOOL.append(record, timestamp)
+    except OSError as exc:
+        logger.error('Cannot spool probe result of target "{0}": {1}.'.format(target.name, exc))
+        return False
+
+
+def submit_traceroute_update(target: schemas.TargetCreate, probe_result: probe_engine.ProbeResult = None,
+                             on_changed=None):
+    """
+    Compares a traceroute to the last stored one of target, and stores it if it differs
+    The database work goes through INGEST_QUEUE when running, so it gets committed along with other probe results
+    Results that cannot be written because of a database error are kept in SPOOL, later results are spooled as well
+    until the spool got replayed, so traceroutes are always stored in probe order
+
+    :param target: (TargetCreate) target schema, with optional groups
+    :param probe_result: (ProbeResult) result from the probe engine, if None, a synchronous traceroute is executed
+    :param on_changed: (callable) optional, called with db and changed within the same unit of work, so its own
+                       writes get committed along with the traceroute
+    :return: (concurrent.futures.Future) future resolving to True if the path or rtt changed since previous
+             traceroute, False if not, None if probe failed or its result got spooled
+    """
+    # Get traceroute, before any database work so a synchronous probe never holds the database writer
+    if probe_result is None:
+        exit_code, raw_traceroute = os_traceroute(str(target.address))
+        probe_result = probe_engine.ProbeResult(target.address, exit_code, raw_traceroute)
+    probe_time = time()
+    future = Future()
+    if SPOOL is not None and len(SPOOL) and _spool_probe_result(target, probe_result, probe_time):
+        future.set_result(None)
+        return future
+
+    update, current_traceroute = _get_update_job(target, probe_result, on_changed=on_changed)
+
+    def _done(update_future):
+        try:
+            changed, target_id = update_future.result()
         except sqlalchemy.exc.OperationalError as exc:
             logger.error('sqlalchemy operation error: {0}.'.format(exc))
             logger.error('Trace:', exc_info=True)
+            # Database and cache may disagree now
+            LAST_TRACEROUTES.remove(target.name)
+            if _spool_probe_result(target, probe_result, probe_time):
+                logger.info('Spooled probe result of target "{0}" until database is available.'.format(target.name))
+            future.set_result(None)
+            return
+        except Exception as exc:
+            future.set_exception(exc)
+            return
+        _record_rtt_series(target_id, current_traceroute, probe_time)
+        future.set_result(changed)
+
+    if INGEST_QUEUE is not None and INGEST_QUEUE.running:
+        INGEST_QUEUE.put(update).add_done_callback(_done)
+    else:
+        update_future = Future()
+        try:
+            update_future.set_result(ingest_queue.run_now(update))
+        except Exception as exc:
+            update_future.set_exception(exc)
+        _done(update_future)
+    return future
+
+
+def replay_spool(batch_size: int = ingest_queue.DEFAULT_BATCH_SIZE):
+    """
+    Stores spooled probe results in original timestamp order, batch_size results per transaction
+    Stops at the first database error, remaining results are replayed on next run
+
+    :return: (int) number of replayed results
+    """
+    if SPOOL is None or not len(SPOOL):
+        return 0
+    records, end = SPOOL.read_pending()
+    logger.info('Replaying {0} spooled probe results.'.format(len(records)))
+    count = 0
+    while count < len(records):
+        batch = records[count:count + batch_size]
+        jobs = []
+        traceroutes = []
+        for record in batch:
+            target = record.record['target']
+            tgt = schemas.TargetCreate(name=target['name'], address=target['address'],
+                                       groups=[schemas.GroupCreate(name=group) for group in target['groups']] or None)
+            update, current_traceroute = _get_update_job(
+                tgt, probe_engine.ProbeResult(tgt.address, record.record['exit_code'], record.record['output']),
+                creation_date=datetime.utcfromtimestamp(record.timestamp))
+            jobs.append((update, {}))
+            traceroutes.append(current_traceroute)
+        try:
+            results = run_write(ingest_queue.run_jobs, jobs=jobs)
+        except sqlalchemy.exc.OperationalError as exc:
+            # Cached last traceroutes may reference rolled back rows
+            LAST_TRACEROUTES.clear()
+            logger.error('Cannot replay spooled probe results, will retry on next run: {0}.'.format(exc))
+            break
+        for record, traceroute, (_, target_id) in zip(batch, traceroutes, results):
+            _record_rtt_series(target_id, traceroute, record.timestamp)
+        count += len(batch)
+        # Records of this batch past the offset are remembered, so a later replay does not store them twice
+        SPOOL.commit(spool.get_replayed_offset(records[count:], end), delivered=[record.start for record in batch])
+    if count:
+        logger.info('Replayed {0} spooled probe results, {1} remaining.'.format(count, len(SPOOL)))
+    return count
+
+
+def update_traceroute_database(target: schemas.TargetCreate, probe_result: probe_engine.ProbeResult = None):
+    """
+    Executes tracert for given name, and updates database accordingly, waits for the result to be committed
+
+    :param target: (TargetCreate) target schema, with optional groups
+    :param probe_result: (ProbeResult) result from the probe engine, if None, a synchronous traceroute is executed
+    :return: (bool) True if the path or rtt changed since previous traceroute, False if not, None if probe failed
+    """
+    return submit_traceroute_update(target, probe_result=probe_result).result()
+
+
+def flush_rtt_series():
+    """
+    Writes buffered rtt samples to database
+    """
+    try:
+        run_write(RTT_SERIES.flush)
+    except sqlalchemy.exc.OperationalError as exc:
+        logger.error('Cannot write rtt samples, will retry on next flush: {0}.'.format(exc))
+
+
+def rollup_rtt_series(rtt_series_keep_days: int = None, hourly_keep_days: int = None, daily_keep_days: int = None):
+    """
+    Rolls up rtt series into hourly and daily statistics, then deletes data older than each tier retention
+    """
+    try:
+        for resolution in rtt_rollups.RESOLUTIONS:
+            count = run_write(rtt_rollups.roll_up, resolution=resolution)
+            logger.debug('Created {0} rtt rollups of {1}s.'.format(count, resolution))
+        deleted = run_write(rtt_rollups.apply_retention, rtt_series_keep_days=rtt_series_keep_days,
+                            hourly_keep_days=hourly_keep_days, daily_keep_days=daily_keep_days)
+        for tier, count in deleted.items():
+            if count:
+                logger.info('Deleted {0} old {1} rtt rows.'.format(count, tier))
+    except sqlalchemy.exc.OperationalError as exc:
+        logger.error('Cannot roll up rtt series, will retry on next run: {0}.'.format(exc))
+
+
+def adapt_probe_interval(db, target_name: str, changed: bool, scheduler: probe_scheduler.ProbeScheduler,
+                         interval_controller: probe_scheduler.AdaptiveIntervalController):
+    """
+    Feeds a probe outcome to the adaptive interval controller, and reschedules the target probe if its interval changed
+    Runs within the probe unit of work, the effective interval is stored along with the probe result so it survives
+    restarts
+    """
+    new_interval = interval_controller.update(target_name, changed)
+    if new_interval is None:
+        return
+    if changed:
+        logger.info('Path change for target "{0}", probing every {1} seconds.'.format(target_name, new_interval))
+    else:
+        logger.info('Stable path for target "{0}", probing every {1} seconds.'.format(target_name, new_interval))
+    scheduler.reschedule('probe:' + target_name, interval=new_interval)
+    crud.update_target_probe_interval(db=db, name=target_name, probe_interval=new_interval, commit=False)
+
+
+def probe_target(engine: probe_engine.ProbeEngine, target: schemas.TargetCreate,
+                 scheduler: probe_scheduler.ProbeScheduler = None,
+                 interval_controller: probe_scheduler.AdaptiveIntervalController = None):
+    """
+    Submits a traceroute probe for target to the probe engine, without waiting for it
+    The database gets updated once the probe finishes
+
+    :param engine: (ProbeEngine) running probe engine
+    :param target: (TargetCreate) target schema
+    :param scheduler: (ProbeScheduler) scheduler holding the target probe entry, needed for adaptive intervals
+    :param interval_controller: (AdaptiveIntervalController) optional adaptive interval controller
+    :return: (concurrent.futures.Future) probe future
+    """
+    on_changed = None
+    if interval_controller and scheduler:
+        def on_changed(db, changed):
+            adapt_probe_interval(db, target.name, changed, scheduler, interval_controller)
+
+    def _callback(probe_result):
+        # Does not wait for the result to be written, so callback workers keep up with the probes
+        submit_traceroute_update(target, probe_result=probe_result, on_changed=on_changed)
+
+    return engine.submit(str(target.address), callback=_callback)
 
 
 def get_last_traceroutes(target_name, limit=1):
@@ -298,64 +572,250 @@ def get_last_traceroutes(target_name, limit=1):
 
 
 def get_last_traceroutes_formatted(name, limit=1, formatting='console'):
-    traceroutes = get_last_traceroutes(name, limit=limit)
-    if traceroutes is False:
-        logger.warning('Target "{0}" has been requested but does not exist in database.'.format(name))
-        return 'Target not found in database.'
-    if traceroutes:
-        output = 'Target has {0} tracreoute entries.'.format(len(traceroutes))
-        length = len(traceroutes)
-        if len(traceroutes) > 1:
-            output = output + traceroutes_difference_preformatted(traceroutes[0], traceroutes[1])
-            for i in range(length - 2):
-                output = output + traceroutes[i + 2].__repr__()
+    # Hops are loaded while formatting, which must hence happen within the unit of work
+    with db_scoped_session() as db:
+        traceroutes = crud.get_traceroutes_by_target(db=db, target_name=name, limit=limit)
+        if traceroutes is False:
+            logger.warning('Target "{0}" has been requested but does not exist in database.'.format(name))
+            return 'Target not found in database.'
+        if traceroutes:
+            output = 'Target has {0} tracreoute entries.'.format(len(traceroutes))
+            length = len(traceroutes)
+            if len(traceroutes) > 1:
+                output = output + traceroutes_difference_preformatted(traceroutes[0], traceroutes[1])
+                for i in range(length - 2):
+                    output = output + traceroutes[i + 2].__repr__()
+            else:
+                for traceroute in traceroutes:
+                    output = output + traceroute.__repr__()
         else:
-            for traceroute in traceroutes:
-                output = output + traceroute.__repr__()
-    else:
-        output = traceroutes
+            output = traceroutes
 
     return format_string(output, formatting)
 
 
 def list_targets(include_tr: bool=False, formatting: str='console'):
+    """
+    Lists all targets with their last two traceroutes
+    Runs a constant number of queries whatever the number of targets, rtts come from stored hops without parsing
+    """
 
     with db_scoped_session() as db:
         output = []
 
-        targets = crud.get_targets(db=db)
+        targets = crud.get_targets_with_groups(db=db)
+        # Hops are only needed to highlight differences
+        traces_by_target = {}
+        for traceroute in crud.get_last_traceroutes_per_target(db=db, limit=2, with_hops=include_tr):
+            traces_by_target.setdefault(traceroute.target_id, []).append(traceroute)
+        rtts = crud.get_last_traceroute_rtts(db=db, limit=2)
+
         for target in targets:
-            groups = crud.get_groups_by_target(db=db, target_id=target.id)
-            traces = get_last_traceroutes(target.name, limit=2)
-            try:
-                current_tr = traces[0]
-                current_tr_object = trparse.loads(current_tr.raw_traceroute)
-                current_rtt = float(current_tr_object.global_rtt)
-            # TypeError may happen if the traceroute could not be done, hence global.rtt does not contain an int type str
-            except (IndexError, trparse.ParseError, TypeError):
-                current_rtt = None
-            try:
-                previous_tr = traces[1]
-                previous_tr_object = trparse.loads(previous_tr.raw_traceroute)
-                previous_rtt = float(previous_tr_object.global_rtt)
-            except (IndexError, trparse.ParseError, TypeError):
-                previous_tr = None
-                previous_rtt = None
-
-            target = {'id': target.id, 'name': target.name, 'address': target.address, 'groups': [group.name for group in groups],
+            traces = traces_by_target.get(target.id, [])
+            # Failed traceroutes have no hops hence no rtt
+            current_tr = traces[0] if traces else None
+            previous_tr = traces[1] if len(traces) > 1 else None
+            current_rtt = rtts.get(current_tr.id) if current_tr else None
+            previous_rtt = rtts.get(previous_tr.id) if previous_tr else None
+
+            target = {'id': target.id, 'name': target.name, 'address': target.address, 'groups': [group.name for group in target.groups],
+                           'probe_interval': target.probe_interval,
                            'current_rtt': current_rtt, 'previous_rtt': previous_rtt,
-                           'last_probe': current_tr.creation_date }
+                           'last_probe': current_tr.creation_date if current_tr else None}
             if include_tr:
-                if previous_tr:
-                    target['current_tr'] = format_string(traceroutes_difference_preformatted(current_tr, previous_tr), formatting)
+                if current_tr:
+                    target['current_tr'] = RENDER_CACHE.get_or_render(
+                        _get_render_key(target['id'], current_tr.id, formatting),
+                        lambda: _render_traceroutes(current_tr, previous_tr, formatting))
                 else:
-                    target['current_tr'] = format_string(current_tr.raw_traceroute, formatting)
+                    target['current_tr'] = None
 
 
             output.append(target)
         return output
 
 
+def encode_page_cursor(sort: str, descending: bool, value, target_id: int):
+    return base64.urlsafe_b64encode(json.dumps([sort, descending, value, target_id]).encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(cursor: str, sort: str, descending: bool):
+    """
+    :return: (tuple) (sort value, target id) keyset of cursor
+    """
+    try:
+        cursor_sort, cursor_descending, value, target_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise ValueError('Bogus page cursor.')
+    if cursor_sort != sort or cursor_descending != descending:
+        raise ValueError('Page cursor does not match requested sort order.')
+    return value, target_id
+
+
+# Traceroute cursors hold naive UTC dates, so they compare the same way on every database backend
+TRACEROUTE_CURSOR_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def encode_traceroute_cursor(descending: bool, creation_date: datetime, traceroute_id: int):
+    if creation_date.tzinfo is not None:
+        creation_date = creation_date.astimezone(timezone.utc).replace(tzinfo=None)
+    return encode_page_cursor('creation_date', descending, creation_date.strftime(TRACEROUTE_CURSOR_DATE_FORMAT),
+                              traceroute_id)
+
+
+def decode_traceroute_cursor(cursor: str, descending: bool):
+    """
+    :return: (tuple) (creation_date as datetime, traceroute id) keyset of a traceroute page cursor
+    """
+    creation_date, traceroute_id = decode_page_cursor(cursor, 'creation_date', descending)
+    try:
+        return datetime.strptime(creation_date, TRACEROUTE_CURSOR_DATE_FORMAT), traceroute_id
+    except (TypeError, ValueError):
+        raise ValueError('Bogus page cursor.')
+
+
+def get_targets_page(db, limit: int = 50, cursor: str = None, sort: str = 'name', descending: bool = False,
+                     group: str = None, status: str = None, search: str = None, min_rtt_delta: float = None):
+    """
+    Keyset paginated version of list_targets, without traceroutes, see get_target_diff
+    Cost of a page does not depend on the page number
+
+    :param cursor: (str) next_cursor of previous page
+    :return: (dict) targets, next_cursor which is None on last page
+    """
+    after = decode_page_cursor(cursor, sort, descending) if cursor else None
+    rows = crud.get_target_page(db=db, limit=limit + 1, after=after, sort=sort, descending=descending, group=group,
+                                status=status, search=search, min_rtt_delta=min_rtt_delta)
+    output = []
+    for row in rows[:limit]:
+        output.append({'id': row.Target.id, 'name': row.Target.name, 'address': row.Target.address,
+                       'groups': [group.name for group in row.Target.groups],
+                       'probe_interval': row.Target.probe_interval,
+                       'current_rtt': row.current_rtt, 'previous_rtt': row.previous_rtt,
+                       'rtt_delta': row.rtt_delta, 'last_probe': row.last_probe,
+                       'last_traceroute_id': row.last_traceroute_id})
+    next_cursor = None
+    if len(rows) > limit:
+        last_row = rows[limit - 1]
+        next_cursor = encode_page_cursor(sort, descending, last_row.sort_value, last_row.Target.id)
+    return {'targets': output, 'next_cursor': next_cursor}
+
+
+def list_targets_page(**kwargs):
+    """
+    get_targets_page with its own session
+    """
+    with db_scoped_session() as db:
+        return get_targets_page(db, **kwargs)
+
+
+def _get_render_key(target_id: int, traceroute_id: int, formatting: str):
+    # Highlighted hops also depend on the rtt threshold, which may be reloaded
+    return target_id, traceroute_id, formatting, get_config_service().get().rtt_detection_threshold
+
+
+def _render_traceroutes(current_tr: models.Traceroute, previous_tr: models.Traceroute, formatting: str):
+    if previous_tr:
+        return format_string(traceroutes_difference_preformatted(current_tr, previous_tr), formatting)
+    return format_string(current_tr.raw_traceroute, formatting)
+
+
+def render_target_diff(db, target_id: int, formatting: str = 'web'):
+    """
+    Last traceroute of a target, with differences to the previous one highlighted
+    Served from RENDER_CACHE with a single query as long as no traceroute got stored
+
+    :return: (str) formatted traceroute, None if target has no traceroute, False if target does not exist
+    """
+    latest_id = RENDER_CACHE.get_latest_traceroute_id(db=db, target_id=target_id)
+    if latest_id is None:
+        return None if crud.get_target(db=db, id=target_id) else False
+    key = _get_render_key(target_id, latest_id, formatting)
+    rendered = RENDER_CACHE.get(key)
+    if rendered is None:
+        traces = crud.get_traceroutes_by_target(db=db, target_id=target_id, limit=2)
+        if not traces:
+            return False if traces is None else None
+        rendered = _render_traceroutes(traces[0], traces[1] if len(traces) > 1 else None, formatting)
+        RENDER_CACHE.put(_get_render_key(target_id, traces[0].id, formatting), rendered)
+    return rendered
+
+
+def get_target_diff(target_id: int, formatting: str = 'web'):
+    """
+    render_target_diff with its own session
+    """
+    with db_scoped_session() as db:
+        return render_target_diff(db, target_id, formatting=formatting)
+
+
+def get_traceroutes_page(db, target_id: int = None, limit: int = 100, cursor: str = None, descending: bool = True):
+    """
+    Keyset paginated traceroutes, newest first unless descending is False
+
+    :param cursor: (str) next_cursor of previous page
+    :return: (list, str) traceroutes, next_cursor which is None on last page
+    """
+    after = decode_traceroute_cursor(cursor, descending) if cursor else None
+    traceroutes = crud.get_traceroute_page(db=db, target_id=target_id, limit=limit + 1, after=after,
+                                           descending=descending)
+    next_cursor = None
+    if len(traceroutes) > limit:
+        traceroutes = traceroutes[:limit]
+        next_cursor = encode_traceroute_cursor(descending, traceroutes[-1].creation_date, traceroutes[-1].id)
+    return traceroutes, next_cursor
+
+
+STREAM_FORMATS = ('ndjson', 'csv')
+
+
+STREAM_COLUMNS = ('id', 'target_id', 'creation_date', 'raw_traceroute')
+
+
+def format_traceroute_rows(rows, output_format: str, header: bool = False):
+    """
+    :param rows: (iterable)(tuple) id, target_id, creation_date, raw_traceroute rows
+    :param header: (bool) starts with the CSV header line
+    :return: (str) NDJSON lines or CSV rows
+    """
+    if output_format not in STREAM_FORMATS:
+        raise ValueError('Unknown stream format "{0}".'.format(output_format))
+    buffer = io.StringIO()
+    if output_format == 'csv':
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(STREAM_COLUMNS)
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            buffer.write(json.dumps(dict(zip(STREAM_COLUMNS, row)), default=str))
+            buffer.write('\n')
+    return buffer.getvalue()
+
+
+def stream_traceroutes(output_format: str = 'ndjson', target_id: int = None, cursor: str = None,
+                       descending: bool = True, batch_size: int = 500):
+    """
+    Yields traceroutes as NDJSON lines or CSV rows, one batch of lines at a time, memory use does not depend on the
+    number of traceroutes
+    """
+    if output_format not in STREAM_FORMATS:
+        raise ValueError('Unknown stream format "{0}".'.format(output_format))
+    after = decode_traceroute_cursor(cursor, descending) if cursor else None
+    header = True
+    with db_session() as db:
+        rows = []
+        for row in crud.iter_traceroute_rows(db=db, target_id=target_id, after=after, descending=descending,
+                                             batch_size=batch_size):
+            rows.append(row)
+            if len(rows) == batch_size:
+                yield format_traceroute_rows(rows, output_format, header=header)
+                header = False
+                rows = []
+        if rows or header:
+            yield format_traceroute_rows(rows, output_format, header=header)
+
+
 def delete_old_traceroutes(target_name: str, days: int, keep: int):
     """
     Deletes old traceroute data if days have passed, but always keep at least limit entries
@@ -366,7 +826,7 @@ def delete_old_traceroutes(target_name: str, days: int, keep: int):
     :return:
     """
 
-    with db_scoped_session() as db:
+    def _delete(db):
         target = crud.get_target(db=db, name=target_name)
         if not target:
             return None
@@ -377,22 +837,146 @@ def delete_old_traceroutes(target_name: str, days: int, keep: int):
 
             # TODO: IS NOT CRUD CONVERTED
 
-            # Subquery is needed because we cannot use delete() on a query with a limit
-            subquery = db.query(models.Traceroute.id).filter(and_(models.Traceroute.target == target,
+            # Ids are fetched first because we cannot use delete() on a query with a limit
+            traceroute_ids = [traceroute_id for traceroute_id, in db.query(models.Traceroute.id).filter(and_(models.Traceroute.target == target,
                                                                   models.Traceroute.creation_date < (datetime.now() - timedelta(
                                                                     days=days)))).order_by(models.Traceroute.id.desc()).limit(
-                num_records_to_delete).subquery()
-            records = db.query(models.Traceroute).filter(models.Traceroute.id.in_(subquery)).delete(synchronize_session='fetch')
+                num_records_to_delete)]
+            records = crud.delete_traceroutes(db=db, traceroute_ids=traceroute_ids)
             logger.info('Deleted {0} old records for target "{1}".'.format(records, target_name))
 
+    return run_write(_delete)
+
 
 def remove_target(target_name):
     config = config_management.load_config(CONFIG_FILE)
     config_management.remove_target_from_config(config, target_name)
     delete_old_traceroutes(target_name, 0, 0)
+    LAST_TRACEROUTES.remove(target_name)
     return config_management.save_config(CONFIG_FILE, config)
 
 
+def log_scheduler_stats(scheduler: probe_scheduler.ProbeScheduler):
+    stats = scheduler.get_stats()
+    logger.info('Scheduler has {0} entries, ran {1} jobs with {2} missed deadlines, average lag {3:.3f}s, '
+                'max lag {4:.3f}s.'.format(stats['entries'], stats['dispatched'], stats['missed_deadlines'],
+                                           stats['average_lag'], stats['max_lag']))
+
+
+def log_ingest_stats(queue: ingest_queue.IngestQueue):
+    stats = queue.get_stats()
+    logger.info('Ingest queue has {0} waiting jobs (max {1}, {2} blocked puts), wrote {3} jobs in {4} batches, '
+                'average flush latency {5:.3f}s, max flush latency {6:.3f}s.'.format(
+                    stats['depth'], stats['max_depth'], stats['blocked_puts'], stats['jobs'], stats['batches'],
+                    stats['average_flush_latency'], stats['max_flush_latency']))
+
+
+def get_config_service():
+    """
+    Returns the shared ConfigService for current CONFIG_FILE
+    """
+    global CONFIG_SERVICE
+
+    if CONFIG_SERVICE is None or CONFIG_SERVICE.config_file != CONFIG_FILE:
+        CONFIG_SERVICE = config_management.ConfigService(CONFIG_FILE)
+    return CONFIG_SERVICE
+
+
+def get_target_schema(target: config_management.TargetConfig):
+    """
+    :return: (TargetCreate) target schema with its groups, or None if target is invalid
+    """
+    try:
+        groups = [schemas.GroupCreate(name=group_name) for group_name in target.groups] or None
+        return schemas.TargetCreate(name=target.name, address=target.address, groups=groups)
+    except ValidationError as exc:
+        logger.error('Bogus target "{0}" given: {1}.'.format(target.name, exc))
+        return None
+
+
+def schedule_target(scheduler: probe_scheduler.ProbeScheduler, target: config_management.TargetConfig,
+                    engine: probe_engine.ProbeEngine, interval: int, scheduling_mode: str,
+                    scheduling_jitter: int = None, delete_history_days: int = None, minimum_keep: int = None,
+                    interval_controller: probe_scheduler.AdaptiveIntervalController = None,
+                    reseed_interval: bool = False):
+    """
+    Adds (or replaces) probe and housekeeping scheduler entries of a target
+
+    :param reseed_interval: (bool) with adaptive intervals, restart from the configured interval of a known target,
+                            eg when its configured interval changed
+    """
+    tgt = get_target_schema(target)
+    if tgt is None:
+        return
+    job_kwargs = {
+        'engine': engine,
+        'target': tgt
+    }
+
+    # Targets may override the global interval and have a priority (lower runs first)
+    target_interval = target.interval or interval
+
+    if interval_controller:
+        job_kwargs['scheduler'] = scheduler
+        job_kwargs['interval_controller'] = interval_controller
+        if reseed_interval or target.name not in interval_controller.get_intervals():
+            # Per target intervals become the target's starting point
+            interval_controller.seed(target.name, target_interval)
+        target_interval = interval_controller.get_interval(target.name)
+
+    if scheduling_mode == 'staggered':
+        # Spread targets over the interval, first probe happens at the target's wall clock phase
+        probe_first_due = probe_scheduler.get_first_due(target.name, target_interval)
+        housekeeping_first_due = probe_scheduler.get_first_due(target.name, 3600)
+    else:
+        # Immediate start, programmed start afterwards
+        probe_first_due = housekeeping_first_due = 0
+
+    scheduler.add('probe:' + target.name, probe_target, target_interval, kwargs=job_kwargs,
+                  first_due=probe_first_due, priority=target.priority, jitter=scheduling_jitter)
+    if delete_history_days:
+        delete_kwargs = {
+            'target_name': target.name,
+            'days': delete_history_days,
+            'keep': minimum_keep
+        }
+        # Housekeeping yields to probes due at the same time
+        scheduler.add('housekeeping:' + target.name, delete_old_traceroutes, 3600, kwargs=delete_kwargs,
+                      first_due=housekeeping_first_due, priority=10)
+
+
+def unschedule_target(scheduler: probe_scheduler.ProbeScheduler, target_name: str):
+    scheduler.remove('probe:' + target_name)
+    scheduler.remove('housekeeping:' + target_name)
+
+
+def reconcile_targets(scheduler: probe_scheduler.ProbeScheduler, previous_targets, targets, **schedule_settings):
+    """
+    Brings scheduler entries in line with a new target list
+    New and changed targets get (re)scheduled, removed ones unscheduled, unchanged ones keep their schedule
+
+    :param previous_targets: (iterable)(TargetConfig) targets currently scheduled
+    :param targets: (iterable)(TargetConfig) wanted targets
+    :param schedule_settings: schedule_target arguments
+    """
+    previous_targets = {target.name: target for target in previous_targets}
+    targets = {target.name: target for target in targets}
+    for target_name in previous_targets.keys() - targets.keys():
+        unschedule_target(scheduler, target_name)
+        logger.info('Target "{0}" removed from schedule.'.format(target_name))
+    for target_name, target in targets.items():
+        previous_target = previous_targets.get(target_name)
+        if previous_target == target:
+            continue
+        if previous_target is not None:
+            # Groups or interval settings may have changed, drop housekeeping entry in case it is now disabled
+            unschedule_target(scheduler, target_name)
+            logger.info('Target "{0}" changed, rescheduling.'.format(target_name))
+        # A new configured interval replaces the adapted one
+        schedule_target(scheduler, target, reseed_interval=previous_target is not None and
+                        previous_target.interval != target.interval, **schedule_settings)
+
+
 def execute(daemon=False):
     """
     Execute traceroute updates and housekeeping for all targets
@@ -400,16 +984,17 @@ def execute(daemon=False):
     :param daemon: (bool) Should this run in a loop
     :return:
     """
+    global INGEST_QUEUE
+    global SPOOL
+
     config = config_management.load_config(CONFIG_FILE)
-    targets = config_management.get_targets_from_config(config)
+    config_service = get_config_service()
+    snapshot = config_service.get()
 
-    if len(targets) == 0:
+    if len(snapshot.targets) == 0:
         logger.info('No valid targets given.')
         sys.exit(20)
 
-    scheduler = BackgroundScheduler()
-    scheduler.start()
-
     # Interval between traceroute executions
     try:
         interval = int(config['TRACEROUTE_HISTORY']['interval'])
@@ -434,56 +1019,276 @@ def execute(daemon=False):
         logger.error('Bogus minimum_keep value. Using default.')
         minimum_keep = 100
 
-    for target in targets:
-        target_name = target['name']
-        target_address = target['address']
+    # Retention of raw rtt samples, hourly and daily rollups, 0 keeps them forever
+    rtt_retention = {}
+    for key, default in (('rtt_series_keep_days', 7), ('hourly_keep_days', 90), ('daily_keep_days', 1825)):
         try:
-            group_names = config_management.get_groups_from_config(config, target_name)
-            if group_names:
-                grp = [schemas.GroupCreate(name=grp_name) for grp_name in group_names]
-            else:
-                grp = None
-            tgt = schemas.TargetCreate(name=str(target_name), address=target_address, groups=grp)
-
-            job_kwargs = {
-                'target': tgt
-            }
-
-            delete_kwargs = {
-                'target_name': target_name,
-                'days': delete_history_days,
-                'keep': minimum_keep
-            }
-
-            # Immediate start
-            scheduler.add_job(update_traceroute_database, None, [], job_kwargs, name='startup-' + target_name,
-                              id='startup-' + target_name)
-            # Programmed start afterwards
-            scheduler.add_job(update_traceroute_database, 'interval', [], job_kwargs, seconds=interval,
-                              name=target_name, id=target_name)
+            rtt_retention[key] = int(config['TRACEROUTE_HISTORY'][key])
+        except KeyError:
+            rtt_retention[key] = default
+        except (TypeError, ValueError):
+            logger.error('Bogus {0} value. Using default.'.format(key))
+            rtt_retention[key] = default
+
+    # Probe results are written in batches of ingest_batch_size, or whatever arrived within ingest_batch_interval ms
+    try:
+        ingest_batch_size = int(config['TRACEROUTE_HISTORY']['ingest_batch_size'])
+    except KeyError:
+        ingest_batch_size = ingest_queue.DEFAULT_BATCH_SIZE
+    except (TypeError, ValueError):
+        logger.error('Bogus ingest_batch_size value. Using default.')
+        ingest_batch_size = ingest_queue.DEFAULT_BATCH_SIZE
+    try:
+        ingest_batch_interval = int(config['TRACEROUTE_HISTORY']['ingest_batch_interval']) / 1000
+    except KeyError:
+        ingest_batch_interval = ingest_queue.DEFAULT_BATCH_INTERVAL
+    except (TypeError, ValueError):
+        logger.error('Bogus ingest_batch_interval value. Using default.')
+        ingest_batch_interval = ingest_queue.DEFAULT_BATCH_INTERVAL
+    try:
+        ingest_queue_size = int(config['TRACEROUTE_HISTORY']['ingest_queue_size'])
+    except KeyError:
+        ingest_queue_size = ingest_queue.DEFAULT_MAX_QUEUE_SIZE
+    except (TypeError, ValueError):
+        logger.error('Bogus ingest_queue_size value. Using default.')
+        ingest_queue_size = ingest_queue.DEFAULT_MAX_QUEUE_SIZE
 
-            if delete_history_days:
-                scheduler.add_job(delete_old_traceroutes, None, [], delete_kwargs,
-                                  name='startup-housekeeping-' + target_name, id='startup-housekeeping-' + target_name)
-                scheduler.add_job(delete_old_traceroutes, 'interval', [], delete_kwargs, hours=1,
-                                  name='housekeeping-' + target_name, id='housekeeping-' + target_name)
+    # Probe results are spooled on disk while the database is unavailable
+    try:
+        spool_file = config['TRACEROUTE_HISTORY']['spool_file'] or SPOOL_FILE
+    except KeyError:
+        spool_file = SPOOL_FILE
+    try:
+        spool_max_size = int(config['TRACEROUTE_HISTORY']['spool_max_size']) * 1024 * 1024
+    except KeyError:
+        spool_max_size = spool.DEFAULT_MAX_SIZE
+    except (TypeError, ValueError):
+        logger.error('Bogus spool_max_size value. Using default.')
+        spool_max_size = spool.DEFAULT_MAX_SIZE
+    try:
+        spool_replay_interval = int(config['TRACEROUTE_HISTORY']['spool_replay_interval'])
+    except KeyError:
+        spool_replay_interval = 30
+    except (TypeError, ValueError):
+        logger.error('Bogus spool_replay_interval value. Using default.')
+        spool_replay_interval = 30
 
-            # TODO add regular config file reloading job ?
+    try:
+        max_concurrent_probes = int(config['TRACEROUTE_HISTORY']['max_concurrent_probes'])
+    except KeyError:
+        max_concurrent_probes = probe_engine.DEFAULT_MAX_CONCURRENT_PROBES
+    except (TypeError, ValueError):
+        logger.error('Bogus max_concurrent_probes value. Using default.')
+        max_concurrent_probes = probe_engine.DEFAULT_MAX_CONCURRENT_PROBES
+    try:
+        probe_timeout = int(config['TRACEROUTE_HISTORY']['probe_timeout'])
+    except KeyError:
+        probe_timeout = probe_engine.DEFAULT_PROBE_TIMEOUT
+    except (TypeError, ValueError):
+        logger.error('Bogus probe_timeout value. Using default.')
+        probe_timeout = probe_engine.DEFAULT_PROBE_TIMEOUT
 
-        except KeyError as exc:
-            logger.error('Failed to read configuration for target "{0}": {1}.'.format(target_name, exc))
-            logger.error(exc)
-        except ValidationError as exc:
-            logger.error('Bogus target "{0}" given: {1}.'.format(target_name, exc))
+    try:
+        probe_backend = config['TRACEROUTE_HISTORY']['probe_backend']
+    except KeyError:
+        probe_backend = probe_engine.DEFAULT_BACKEND
+    if probe_backend not in probe_engine.BACKENDS:
+        logger.error('Bogus probe_backend value. Using default.')
+        probe_backend = probe_engine.DEFAULT_BACKEND
+    try:
+        native_protocol = config['TRACEROUTE_HISTORY']['native_protocol']
+    except KeyError:
+        native_protocol = native_traceroute.DEFAULT_PROTOCOL
+    if native_protocol not in native_traceroute.PROTOCOLS:
+        logger.error('Bogus native_protocol value. Using default.')
+        native_protocol = native_traceroute.DEFAULT_PROTOCOL
+    try:
+        native_max_hops = int(config['TRACEROUTE_HISTORY']['native_max_hops'])
+    except KeyError:
+        native_max_hops = native_traceroute.DEFAULT_MAX_HOPS
+    except (TypeError, ValueError):
+        logger.error('Bogus native_max_hops value. Using default.')
+        native_max_hops = native_traceroute.DEFAULT_MAX_HOPS
 
-    run_once = True
     try:
-        while daemon or run_once:
-            run_once = False
-            sleep(1)
+        resolve_hostnames = config['TRACEROUTE_HISTORY'].getboolean('resolve_hostnames', fallback=True)
+    except ValueError:
+        logger.error('Bogus resolve_hostnames value. Using default.')
+        resolve_hostnames = True
+    try:
+        dns_cache_ttl = int(config['TRACEROUTE_HISTORY']['dns_cache_ttl'])
+    except KeyError:
+        dns_cache_ttl = resolver.DEFAULT_CACHE_TTL
+    except (TypeError, ValueError):
+        logger.error('Bogus dns_cache_ttl value. Using default.')
+        dns_cache_ttl = resolver.DEFAULT_CACHE_TTL
+    try:
+        dns_negative_cache_ttl = int(config['TRACEROUTE_HISTORY']['dns_negative_cache_ttl'])
+    except KeyError:
+        dns_negative_cache_ttl = resolver.DEFAULT_NEGATIVE_CACHE_TTL
+    except (TypeError, ValueError):
+        logger.error('Bogus dns_negative_cache_ttl value. Using default.')
+        dns_negative_cache_ttl = resolver.DEFAULT_NEGATIVE_CACHE_TTL
+    try:
+        dns_cache_size = int(config['TRACEROUTE_HISTORY']['dns_cache_size'])
+    except KeyError:
+        dns_cache_size = resolver.DEFAULT_CACHE_SIZE
+    except (TypeError, ValueError):
+        logger.error('Bogus dns_cache_size value. Using default.')
+        dns_cache_size = resolver.DEFAULT_CACHE_SIZE
+
+    if resolve_hostnames:
+        hostname_resolver = resolver.HostnameResolver(cache_size=dns_cache_size, cache_ttl=dns_cache_ttl,
+                                                      negative_cache_ttl=dns_negative_cache_ttl)
+    else:
+        hostname_resolver = None
+
+    try:
+        scheduling_mode = config['TRACEROUTE_HISTORY']['scheduling_mode']
+    except KeyError:
+        scheduling_mode = probe_scheduler.DEFAULT_SCHEDULING_MODE
+    if scheduling_mode not in probe_scheduler.SCHEDULING_MODES:
+        logger.error('Bogus scheduling_mode value. Using default.')
+        scheduling_mode = probe_scheduler.DEFAULT_SCHEDULING_MODE
+    try:
+        scheduling_jitter = int(config['TRACEROUTE_HISTORY']['scheduling_jitter'])
+    except KeyError:
+        scheduling_jitter = None
+    except (TypeError, ValueError):
+        logger.error('Bogus scheduling_jitter value. Deactivating jitter.')
+        scheduling_jitter = None
+    try:
+        max_probes_per_second = float(config['TRACEROUTE_HISTORY']['max_probes_per_second'])
+    except KeyError:
+        max_probes_per_second = None
+    except (TypeError, ValueError):
+        logger.error('Bogus max_probes_per_second value. Deactivating probe rate limit.')
+        max_probes_per_second = None
+
+    try:
+        adaptive_interval = config['TRACEROUTE_HISTORY'].getboolean('adaptive_interval', fallback=False)
+    except ValueError:
+        logger.error('Bogus adaptive_interval value. Deactivating adaptive intervals.')
+        adaptive_interval = False
+    try:
+        min_interval = int(config['TRACEROUTE_HISTORY']['min_interval'])
+    except KeyError:
+        min_interval = max(interval // 10, 60)
+    except (TypeError, ValueError):
+        logger.error('Bogus min_interval value. Using default.')
+        min_interval = max(interval // 10, 60)
+    try:
+        max_interval = int(config['TRACEROUTE_HISTORY']['max_interval'])
+    except KeyError:
+        max_interval = interval * 4
+    except (TypeError, ValueError):
+        logger.error('Bogus max_interval value. Using default.')
+        max_interval = interval * 4
+    try:
+        interval_backoff_factor = float(config['TRACEROUTE_HISTORY']['interval_backoff_factor'])
+    except KeyError:
+        interval_backoff_factor = 2
+    except (TypeError, ValueError):
+        logger.error('Bogus interval_backoff_factor value. Using default.')
+        interval_backoff_factor = 2
+    try:
+        interval_backoff_after = int(config['TRACEROUTE_HISTORY']['interval_backoff_after'])
+    except KeyError:
+        interval_backoff_after = 3
+    except (TypeError, ValueError):
+        logger.error('Bogus interval_backoff_after value. Using default.')
+        interval_backoff_after = 3
+
+    engine = probe_engine.ProbeEngine(max_concurrent_probes=max_concurrent_probes, probe_timeout=probe_timeout,
+                                      backend=probe_backend, native_protocol=native_protocol,
+                                      native_max_hops=native_max_hops, hostname_resolver=hostname_resolver,
+                                      max_probes_per_second=max_probes_per_second)
+    warm_last_traceroutes()
+    SPOOL = spool.Spool(spool_file, max_size=spool_max_size)
+    try:
+        SPOOL.open()
+    except OSError as exc:
+        logger.error('Cannot open spool "{0}", probe results will be lost while database is unavailable: {1}.'.format(
+            spool_file, exc))
+        SPOOL = None
+    # Results spooled before last stop
+    replay_spool(batch_size=ingest_batch_size)
+    # Cached last traceroutes may reference rolled back rows after a failed batch, they get read again from database
+    INGEST_QUEUE = ingest_queue.IngestQueue(batch_size=ingest_batch_size, batch_interval=ingest_batch_interval,
+                                            max_queue_size=ingest_queue_size, on_rollback=LAST_TRACEROUTES.clear)
+    INGEST_QUEUE.start()
+    engine.start()
+
+    scheduler = None
+    interval_controller = None
+    if daemon:
+        scheduler = probe_scheduler.ProbeScheduler()
+        scheduler.start()
+        if adaptive_interval:
+            interval_controller = probe_scheduler.AdaptiveIntervalController(
+                interval, min_interval=min_interval, max_interval=max_interval,
+                backoff_factor=interval_backoff_factor, backoff_after=interval_backoff_after)
+            # Restore intervals that were in effect before restart
+            with db_scoped_session() as db:
+                for db_target in crud.get_targets(db=db):
+                    if db_target.probe_interval:
+                        interval_controller.seed(db_target.name, db_target.probe_interval)
+
+    if not daemon:
+        # Single run, probes are executed concurrently by the engine, we'll wait for them below
+        pending_probes = []
+        for target in snapshot.targets:
+            tgt = get_target_schema(target)
+            if tgt is None:
+                continue
+            pending_probes.append(probe_target(engine, tgt))
+            if delete_history_days:
+                delete_old_traceroutes(target.name, delete_history_days, minimum_keep)
+    else:
+        schedule_settings = {
+            'engine': engine,
+            'interval': interval,
+            'scheduling_mode': scheduling_mode,
+            'scheduling_jitter': scheduling_jitter,
+            'delete_history_days': delete_history_days,
+            'minimum_keep': minimum_keep,
+            'interval_controller': interval_controller
+        }
+        reconcile_targets(scheduler, (), snapshot.targets, **schedule_settings)
+        # Targets added, changed or removed from config files get rescheduled without restart
+        config_service.add_listener(
+            lambda old_snapshot, new_snapshot: reconcile_targets(scheduler, old_snapshot.targets,
+                                                                 new_snapshot.targets, **schedule_settings))
+        scheduler.add('config-reload', config_service.reload, config_service.check_interval,
+                      first_due=config_service.check_interval, priority=10)
+        scheduler.add('scheduler-stats', log_scheduler_stats, 600, kwargs={'scheduler': scheduler}, first_due=600)
+        scheduler.add('ingest-stats', log_ingest_stats, 600, kwargs={'queue': INGEST_QUEUE}, first_due=600)
+        if SPOOL:
+            scheduler.add('spool-replay', replay_spool, spool_replay_interval, kwargs={'batch_size': ingest_batch_size},
+                          first_due=spool_replay_interval, priority=10)
+        scheduler.add('rtt-series-flush', flush_rtt_series, 60, first_due=60, priority=10)
+        scheduler.add('rtt-rollups', rollup_rtt_series, 3600, kwargs=rtt_retention, first_due=600, priority=20)
+
+    try:
+        if daemon:
+            while True:
+                sleep(1)
+        else:
+            wait_futures(pending_probes)
     except KeyboardInterrupt:
         logger.info('Interrupted by keyboard')
-        scheduler.shutdown()
+    finally:
+        if scheduler:
+            scheduler.stop(wait=False)
+        engine.stop()
+        # Write probe results still waiting in queue
+        INGEST_QUEUE.stop()
+        replay_spool(batch_size=ingest_batch_size)
+        if SPOOL:
+            SPOOL.close()
+        flush_rtt_series()
+    if not daemon:
+        rollup_rtt_series(**rtt_retention)
 
 
 def help_():
@@ -504,6 +1309,8 @@ def help_():
     print('--remove-target=name                 Removes given target from configuration and deletes target data from database')
     print('--list-targets                       Extract a list of current targets in database"')
     print('--init-db                            Initialize a fresh database.')
+    print('--upgrade-db                         Apply pending schema migrations to an existing database.')
+    print('--compress-history                   Compress raw traceroutes stored by previous versions.')
     sys.exit()
 
 
@@ -516,7 +1323,7 @@ def main(argv):
                                 ['config=', 'get-traceroutes-for=', 'list-targets',
                                  'remove-target=',
                                  'daemon', 'update-now',
-                                 'init-db', 'help'])
+                                 'init-db', 'upgrade-db', 'compress-history', 'help'])
     except getopt.GetoptError:
         help_()
         sys.exit(9)
@@ -543,11 +1350,15 @@ def main(argv):
             logger.warn('This program should probably be run as root so traceroute can work.')
 
     initialize = False
+    upgrade = False
     for opt, arg in opts:
         if opt == '--init-db':
             initialize = True
+        if opt == '--upgrade-db':
+            upgrade = True
 
-    load_database(config, initialize=initialize)
+    # All writes of the runner go through a single writer with sqlite
+    load_database(config, initialize=initialize, writer=True, upgrade=upgrade)
 
     opt_found = False
     for opt, arg in opts:
@@ -567,6 +1378,9 @@ def main(argv):
         if opt == '--remove-target':
             res = remove_target(arg)
             sys.exit(res)
+        if opt == '--compress-history':
+            compress_history()
+            sys.exit(0)
         if opt == '--daemon':
             opt_found = True
             execute(daemon=True)
@@ -190,6 +190,29 @@ def load(data):
     return loads(data.read())
 
 
+def dumps(traceroute, max_hops=None):
+    """Renders a Traceroute object as unix traceroute output that loads() can parse back"""
+    lines = ["traceroute to {} ({}), {} hops max".format(traceroute.dest_name, traceroute.dest_ip,
+                                                        max_hops or len(traceroute.hops))]
+    for hop in traceroute.hops:
+        text = "{:>2d} ".format(hop.idx)
+        last_ip = None
+        for probe in hop.probes:
+            if probe.rtt is None:
+                text += " *"
+                continue
+            if probe.ip != last_ip:
+                if probe.asn is not None:
+                    text += " [AS{:d}]".format(probe.asn)
+                text += " {} ({})".format(probe.name or probe.ip, probe.ip)
+                last_ip = probe.ip
+            text += "  {:.3f} ms".format(probe.rtt)
+            if probe.annotation:
+                text += " {:s}".format(probe.annotation)
+        lines.append(text)
+    return "\n".join(lines) + "\n"
+
+
 class ParseError(Exception):
     pass
 
@@ -21,14 +21,16 @@ import sys
 import os
 import getopt
 from typing import List
-from fastapi import Depends, FastAPI, Request, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import Depends, FastAPI, Request, Response, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 import uvicorn
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import psutil
 import ofunctions.logger_utils
-from traceroute_history.database import load_database, get_db
+from traceroute_history import database
+from traceroute_history.database import load_database, load_async_database, get_async_db, get_async_write_db
 from traceroute_history.traceroute_history_runner import config_management, schemas, crud
 from traceroute_history import traceroute_history_runner
 
@@ -78,6 +80,8 @@ cmd_opts(sys.argv[1:])
 
 # Reload config before executing anything else
 config = config_management.load_config(CONFIG_FILE)
+# Runner functions read settings (eg rtt_detection_threshold) from the same file
+traceroute_history_runner.CONFIG_FILE = CONFIG_FILE
 try:
     log_file = config['TRACEROUTE_HISTORY']['log_file']
     logger = ofunctions.logger_utils.logger_get_logger(log_file=log_file)
@@ -106,9 +110,21 @@ try:
 except KeyError:
     sub_directory = ""
 
+# Memory cap of rendered traceroute diffs, in MiB
+try:
+    traceroute_history_runner.RENDER_CACHE.max_size = int(config['UI_SETTINGS']['render_cache_size']) * 1024 * 1024
+except KeyError:
+    pass
+except ValueError:
+    logger.error('Bogus render_cache_size value. Using default.')
+
 # Load database, needs to be done before accessing db_get function
 #config = config_management.load_config('traceroute_history.conf')
 db_load_result = load_database(config)
+# API and GUI routes use async sessions, the runner keeps the sync ones
+# With sqlite production mode, reads use read only connections, so they never compete with the runner's writer
+if db_load_result:
+    db_load_result = load_async_database(config, read_only=True)
 
 # Prepare FastAPI
 app = FastAPI()
@@ -140,86 +156,191 @@ def get_system_data():
 
 """
 Main API functions
-These aren't async since SQLAlchemy does not support async yet
+They run on the event loop with async sessions, sync crud functions being executed through AsyncSession.run_sync,
+so a slow query never holds a thread pool worker
 
 
 """
+async def run_crud(db: AsyncSession, function, schema=None, **kwargs):
+    """
+    Runs a sync crud function on an async session
+
+    :param schema: (pydantic.BaseModel) optional schema results are converted to, while lazy loads are still possible
+    """
+    def _run(session):
+        result = function(session, **kwargs)
+        if schema is None or result is None:
+            return result
+        if isinstance(result, list):
+            return [schema.from_orm(item) for item in result]
+        return schema.from_orm(result)
+
+    return await db.run_sync(_run)
+
+
 @app.post('/target/', response_model=schemas.Target)
-def create_target(target: schemas.TargetCreate, db: Session = Depends(get_db)):
-    db_target = crud.get_target(db=db, name=target.name)
+async def create_target(target: schemas.TargetCreate, db: AsyncSession = Depends(get_async_write_db)):
+    db_target = await run_crud(db, crud.get_target, name=target.name)
     if db_target:
         raise HTTPException(status_code=400, detail='Target already exists')
-    return crud.create_target(db=db, target=target)
+    return await run_crud(db, crud.create_target, schema=schemas.Target, target=target)
 
 @app.get('/targets/', response_model=List[schemas.Target])
-def read_targets(skip: int = 0, limit : int = None, db: Session = Depends(get_db)):
-    targets = crud.get_targets(db=db, skip=skip, limit=limit)
-    return targets
+async def read_targets(skip: int = 0, limit : int = None, db: AsyncSession = Depends(get_async_db)):
+    return await run_crud(db, crud.get_targets, schema=schemas.Target, skip=skip, limit=limit)
 
 @app.get('/target/{id}', response_model=schemas.Target)
-def read_target_by_id(id: int, db: Session = Depends(get_db)):
-    db_target = crud.get_target(db=db, id=id)
+async def read_target_by_id(id: int, db: AsyncSession = Depends(get_async_db)):
+    db_target = await run_crud(db, crud.get_target, schema=schemas.Target, id=id)
     if db_target is None:
         raise HTTPException(status_code=404, detail='Target does not exist')
     return db_target
 
 @app.get('/target/name/{name}', response_model=schemas.Target)
-def read_target_by_name(name: str, db: Session = Depends(get_db)):
-    db_target = crud.get_target(db=db, name=name)
+async def read_target_by_name(name: str, db: AsyncSession = Depends(get_async_db)):
+    db_target = await run_crud(db, crud.get_target, schema=schemas.Target, name=name)
     if db_target is None:
         raise HTTPException(status_code=404, detail='Target does not exist')
     return db_target
 
 @app.delete('/target/{id}')
-def delete_traceroute_by_id(id: int, db: Session = Depends(get_db)):
-    db_operation = crud.delete_target(db=db, id=id)
+async def delete_traceroute_by_id(id: int, db: AsyncSession = Depends(get_async_write_db)):
+    db_operation = await run_crud(db, crud.delete_target, id=id)
     if db_operation is not None:
         raise HTTPException(status_code=404, detail='Target does not exist')
     # deletes return HTTP 200 'null' on success
     return db_operation
 
 @app.delete('/target/name/{name}')
-def delete_traceroute_by_name(name: str, db: Session = Depends(get_db)):
-    db_operation = crud.delete_target(db=db, name=name)
+async def delete_traceroute_by_name(name: str, db: AsyncSession = Depends(get_async_write_db)):
+    db_operation = await run_crud(db, crud.delete_target, name=name)
     if db_operation is not None:
         raise HTTPException(status_code=404, detail='Target does not exist')
     return db_operation
 
 
 @app.post('/group', response_model=schemas.Group)
-def create_group(group: schemas.GroupCreate, db: Session = Depends(get_db)):
-    db_group = crud.get_group(db=db, name=group.name)
+async def create_group(group: schemas.GroupCreate, db: AsyncSession = Depends(get_async_write_db)):
+    db_group = await run_crud(db, crud.get_group, name=group.name)
     if db_group:
         raise HTTPException(status_code=400, detail='Group already exists')
-    return crud.create_group(db=db, group=group)
+    return await run_crud(db, crud.create_group, schema=schemas.Group, group=group)
 
 
 @app.get('/groups', response_model=List[schemas.Group])
-def read_groups(skip: int = 0, limit: int = None, db: Session = Depends(get_db)):
-    groups = crud.get_groups(db=db, skip=skip, limit=limit)
-    return groups
+async def read_groups(skip: int = 0, limit: int = None, db: AsyncSession = Depends(get_async_db)):
+    return await run_crud(db, crud.get_groups, schema=schemas.Group, skip=skip, limit=limit)
 
 @app.get('/group/{id}', response_model=schemas.Group)
-def read_groupby_id(id: int, db: Session = Depends(get_db)):
-    db_group = crud.get_group(db=db, id=id)
+async def read_groupby_id(id: int, db: AsyncSession = Depends(get_async_db)):
+    db_group = await run_crud(db, crud.get_group, schema=schemas.Group, id=id)
     if db_group is None:
         raise HTTPException(status_code=404, detail='Group does not exist')
     return db_group
 
 @app.post('/target/{id}/traceroutes', response_model=schemas.Traceroute)
-def create_traceroute_for_target(id: int, traceroute: schemas.TracerouteCreate, db: Session = Depends(get_db)):
-    return crud.create_target_traceroute(db=db, traceroute=traceroute, target_id=id)
+async def create_traceroute_for_target(id: int, traceroute: schemas.TracerouteCreate,
+                                       db: AsyncSession = Depends(get_async_write_db)):
+    return await run_crud(db, crud.create_target_traceroute, schema=schemas.Traceroute, traceroute=traceroute,
+                          target_id=id)
+
+
+TRACEROUTE_FORMATS = ('json', ) + traceroute_history_runner.STREAM_FORMATS
+STREAM_MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+async def stream_traceroutes(output_format: str, target_id: int = None, cursor: str = None, descending: bool = True,
+                             batch_size: int = 500):
+    """
+    Async version of traceroute_history_runner.stream_traceroutes, reading rows from a streamed result
+    """
+    after = traceroute_history_runner.decode_traceroute_cursor(cursor, descending) if cursor else None
+    statement = crud.get_traceroute_rows_statement(target_id=target_id, after=after, descending=descending)
+    header = True
+    async with database.AsyncSessionLocal() as db:
+        result = await db.stream(statement)
+        async for rows in result.partitions(batch_size):
+            yield traceroute_history_runner.format_traceroute_rows(
+                [crud.decode_traceroute_row(row) for row in rows], output_format, header=header)
+            header = False
+    if header:
+        yield traceroute_history_runner.format_traceroute_rows([], output_format, header=header)
+
+
+async def _read_traceroutes(response: Response, db: AsyncSession, target_id: int = None, limit: int = 100,
+                            cursor: str = None, order: str = 'desc', format: str = 'json'):
+    """
+    json returns a page of traceroutes, the next page cursor being in X-Next-Cursor header
+    ndjson and csv stream all traceroutes (after cursor if given)
+    """
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail='Order must be asc or desc')
+    if format not in TRACEROUTE_FORMATS:
+        raise HTTPException(status_code=400, detail='Format must be one of {0}'.format(', '.join(TRACEROUTE_FORMATS)))
+    try:
+        if format in STREAM_MEDIA_TYPES:
+            # Bogus cursors must be reported before streaming starts
+            if cursor:
+                traceroute_history_runner.decode_traceroute_cursor(cursor, order == 'desc')
+            return StreamingResponse(stream_traceroutes(format, target_id=target_id, cursor=cursor,
+                                                        descending=order == 'desc'),
+                                     media_type=STREAM_MEDIA_TYPES[format])
+
+        def _get_page(session):
+            traceroutes, next_cursor = traceroute_history_runner.get_traceroutes_page(
+                db=session, target_id=target_id, limit=limit, cursor=cursor, descending=order == 'desc')
+            return [schemas.Traceroute.from_orm(traceroute) for traceroute in traceroutes], next_cursor
+
+        traceroutes, next_cursor = await db.run_sync(_get_page)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return traceroutes
 
 
-@app.get('/target/{id}/traceroutes', response_model=schemas.Traceroute)
-def read_traceroutes_for_target(id: int, skip: int = 0, limit: int = None, db: Session = Depends(get_db)):
-    return crud.get_traceroutes_by_target(db=db, target_id=id, skip=skip, limit=limit)
+@app.get('/target/{id}/traceroutes', response_model=List[schemas.Traceroute])
+async def read_traceroutes_for_target(id: int, response: Response, limit: int = Query(100, ge=1, le=1000),
+                                      cursor: str = None, order: str = 'desc', format: str = 'json',
+                                      db: AsyncSession = Depends(get_async_db)):
+    if await run_crud(db, crud.get_target, id=id) is None:
+        raise HTTPException(status_code=404, detail='Target does not exist')
+    return await _read_traceroutes(response, db, target_id=id, limit=limit, cursor=cursor, order=order,
+                                   format=format)
 
 @app.get('/traceroutes', response_model=List[schemas.Traceroute])
-def read_traceroutes(skip: int = 0, limit: int = None, db: Session = Depends(get_db)):
-    traceroutes = crud.get_traceroutes(db=db, skip=skip, limit=limit)
-    print(traceroutes)
-    return traceroutes
+async def read_traceroutes(response: Response, limit: int = Query(100, ge=1, le=1000), cursor: str = None,
+                           order: str = 'desc', format: str = 'json', db: AsyncSession = Depends(get_async_db)):
+    return await _read_traceroutes(response, db, limit=limit, cursor=cursor, order=order, format=format)
+
+
+@app.get('/api/targets')
+async def read_target_page(limit: int = Query(50, ge=1, le=500), cursor: str = None, sort: str = 'name',
+                           order: str = 'asc', group: str = None, status: str = None, search: str = None,
+                           min_rtt_delta: float = None, db: AsyncSession = Depends(get_async_db)):
+    """
+    Keyset paginated target list of the web UI, pass next_cursor of a page to get the next one
+    """
+    if sort not in crud.TARGET_PAGE_SORTS:
+        raise HTTPException(status_code=400, detail='Sort must be one of {0}'.format(', '.join(crud.TARGET_PAGE_SORTS)))
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail='Order must be asc or desc')
+    if status and status not in crud.TARGET_STATUSES:
+        raise HTTPException(status_code=400, detail='Status must be one of {0}'.format(', '.join(crud.TARGET_STATUSES)))
+    try:
+        return await run_crud(db, traceroute_history_runner.get_targets_page, limit=limit, cursor=cursor, sort=sort,
+                              descending=order == 'desc', group=group, status=status, search=search,
+                              min_rtt_delta=min_rtt_delta)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+@app.get('/api/target/{id}/diff')
+async def read_target_diff(id: int, db: AsyncSession = Depends(get_async_db)):
+    diff = await run_crud(db, traceroute_history_runner.render_target_diff, target_id=id, formatting='web')
+    if diff is False:
+        raise HTTPException(status_code=404, detail='Target does not exist')
+    return {'id': id, 'diff': diff}
 
 
 """
@@ -227,14 +348,15 @@ GUI functions
 """
 
 @app.get('/')
-async def index(request: Request):
+async def index(request: Request, db: AsyncSession = Depends(get_async_db)):
     if not config:
         return {'message': 'Config not loaded'}
     if not db_load_result:
         return {'message': 'Cannot access DB: {}'.format(db_load_result)}
-    targets = traceroute_history_runner.list_targets(include_tr=True, formatting='web')
+    # Targets are loaded page by page from /api/targets, diffs from /api/target/{id}/diff
+    groups = [group.name for group in await run_crud(db, crud.get_groups)]
     return templates.TemplateResponse('targets.html',
-                                      {'request': request, 'targets': targets, 'system': get_system_data()})
+                                      {'request': request, 'groups': groups, 'system': get_system_data()})
 
 
 @app.get('/info')